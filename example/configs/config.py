@@ -8,11 +8,9 @@ load_dotenv()
 # VK data
 token_vk = str(os.getenv("GROUP_API_VK"))  # :str. Your VK GROUP API KEY
 group_id = str(os.getenv("GROUP_ID_VK"))  # :str. Your group id
-TEST_ID_VK = int(os.getenv("TEST_ID_VK"))  # :int. Your VK id for running tests
 
 # TG data
 token_tg = str(os.getenv("BOT_API_TG"))  # :str. Your TG bot's API KEY
-TEST_ID_TG = int(os.getenv("TEST_ID_TG"))  # :int. Your TG id for running tests
 
 LOCAL_IP = "127.0.0.1"  # :str. default local ip
 LOCAL_PORT = 8888  # :int. default local port
@@ -6,8 +6,10 @@ from configs.logger import logger
 from configs.transitions.transitions_config import transitions
 from lib.users import (
     get_user_stage,
+    get_users_stages,
     change_user_stage,
     get_user_access_level,
+    get_users_access_levels,
     change_user_access_level,
 )
 
@@ -17,11 +19,13 @@ message_handler = MessageHandler(
     user_stage=Func(
         getter=get_user_stage,  # :Coroutine. A coroutine to get user’s stage. Should contain ‘user_messenger_id’ and ‘user_messenger’ args.
         setter=change_user_stage,  # :Coroutine. A coroutine to change user’s stage. Should contain 'to_stage_id', ‘user_messenger_id’ and ‘user_messenger’ args.
+        getter_many=get_users_stages,  # :Coroutine. [Optional] A coroutine to get stages of many users at once. Should contain 'users' arg (list of (user_messenger_id, user_messenger)) and return a dict with these tuples as keys. Missing users are fetched with 'getter'.
     ),
     # [Optional]
     user_access_level=Func(
         getter=get_user_access_level,  # :Coroutine. [Optional] A coroutine to get user’s access level. Should contain ‘user_messenger_id’ and ‘user_messenger’ args.
         setter=change_user_access_level,  # :Coroutine. [Optional] A coroutine to change user’s access level. Should contain 'to_access_level', ‘user_messenger_id’ and ‘user_messenger’ args.
+        getter_many=get_users_access_levels,  # :Coroutine. [Optional] A coroutine to get access levels of many users at once.
     ),
     # user_file_saver=user_file_saver_coro,  # : Coroutine. [Optional] A coroutine that saves user’s file to the database. Should contain 'file_name', 'file_extension', 'file_tag', 'file_bytes', 'user_messenger_id' and 'user_messenger' args.
     base_config=BASE_CONFIG,  # :BaseConfig. [Optional] specify your base config of BaseConfig class if there are any changes. Defaults to BaseConfig
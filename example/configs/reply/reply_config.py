@@ -21,9 +21,11 @@ messengers.register_messenger(
     ).tg_answer,  # : Coroutine. A function that sends message to the user
     messages_per_second=4,  # :int. Message reply rate in messages per second
 )
+vk_replier = DefaultVkReplier(vk_api=api, config=BASE_CONFIG)
 messengers.register_messenger(
     trigger="vk",
-    reply_func=DefaultVkReplier(vk_api=api, config=BASE_CONFIG).vk_answer,
+    reply_func=vk_replier.vk_answer,
     messages_per_second=4,
+    close_func=vk_replier.close,  # :Coroutine. [Optional] Awaited on shutdown of the server to release the resources of the replier
 )
 messengers.compile()
@@ -32,6 +32,19 @@ async def get_user_stage(user_messenger_id: int, user_messenger: str):
     return result
 
 
+async def get_users_stages(users: list):
+    sql = """SELECT user_messenger_id, user_messenger, user_stage FROM users
+    WHERE (user_messenger_id, user_messenger) IN (
+        SELECT * FROM unnest($1::bigint[], $2::text[])
+    )"""
+    params = ([user[0] for user in users], [user[1] for user in users])
+    rows = await fetch(sql, *params)
+    return {
+        (row["user_messenger_id"], row["user_messenger"]): row["user_stage"]
+        for row in rows
+    }
+
+
 async def change_user_stage(
     to_stage_id: str, user_messenger_id: int, user_messenger: str
 ):
@@ -49,6 +62,19 @@ async def get_user_access_level(user_messenger_id: int, user_messenger: str):
     return result
 
 
+async def get_users_access_levels(users: list):
+    sql = """SELECT user_messenger_id, user_messenger, user_type FROM users
+    WHERE (user_messenger_id, user_messenger) IN (
+        SELECT * FROM unnest($1::bigint[], $2::text[])
+    )"""
+    params = ([user[0] for user in users], [user[1] for user in users])
+    rows = await fetch(sql, *params)
+    return {
+        (row["user_messenger_id"], row["user_messenger"]): row["user_type"]
+        for row in rows
+    }
+
+
 async def change_user_access_level(
     to_access_level: str, user_messenger_id: int, user_messenger: str
 ):
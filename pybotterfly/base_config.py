@@ -20,6 +20,20 @@ class BaseConfig:
         Defaults to True.
     :vartype DEBUG_STATE: bool
 
+    :ivar LOG_LEVEL: The minimum level of the records logged by the
+        DefaultLogger in debug mode. Defaults to "DEBUG".
+    :vartype LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR",
+        "CRITICAL"]
+
+    :ivar LOG_QUEUE_SIZE: An integer that represents the maximum number of
+        records waiting to be written by the QueueLogger. Records logged
+        while the queue is full are dropped. Defaults to 10000.
+    :vartype LOG_QUEUE_SIZE: int
+
+    :ivar LOG_BATCH_SIZE: An integer that represents the maximum number of
+        records the QueueLogger writes at once. Defaults to 100.
+    :vartype LOG_BATCH_SIZE: int
+
     :ivar MAX_BUTTONS_IN_ROW: An integer that represents the maximum number of
         buttons that can be in a single row in a message sent by the bot.
         Defaults to 4.
@@ -38,6 +52,165 @@ class BaseConfig:
     :ivar ALLOWED_FILE_EXTENSIONS: A list of allowed extensions for a file.
     :vartype ALLOWED_FILE_EXTENSIONS: Literal[".png", ".jpg", ".jpeg", ".xls",
         ".xlsx", ".doc", ".docx", ".pdf"]
+
+    :ivar PERSISTENT_CONNECTION: A boolean that indicates whether the clients
+        should keep long-lived framed connections to the server instead of
+        opening a new connection for every message. Defaults to True.
+    :vartype PERSISTENT_CONNECTION: bool
+
+    :ivar SERVER_CONNECTIONS: An integer that represents the amount of
+        persistent connections each client keeps to the server.
+        Defaults to 2.
+    :vartype SERVER_CONNECTIONS: int
+
+    :ivar MAX_IN_FLIGHT_MESSAGES: An integer that represents the maximum
+        number of unacknowledged messages on a single persistent connection.
+        Defaults to 100.
+    :vartype MAX_IN_FLIGHT_MESSAGES: int
+
+    :ivar MAX_MESSAGE_SIZE: An integer that represents the maximum size
+        (in bytes) of a single message received by the server, including
+        its files. Bigger messages are rejected. Defaults to 64 MB.
+    :vartype MAX_MESSAGE_SIZE: int
+
+    :ivar SPOOL_FILE_SIZE: An integer that represents the size (in bytes)
+        starting from which received files are spilled to a temporary file
+        instead of being buffered in memory. Defaults to 1 MB.
+    :vartype SPOOL_FILE_SIZE: int
+
+    :ivar REPLY_MAX_IN_FLIGHT: An integer that represents the maximum number
+        of replies sent at once to a single messenger. Defaults to 100.
+    :vartype REPLY_MAX_IN_FLIGHT: int
+
+    :ivar REPLY_QUEUE_SIZE: An integer that represents the maximum number of
+        replies waiting to be sent to a single messenger. Defaults to 1000.
+    :vartype REPLY_QUEUE_SIZE: int
+
+    :ivar REPLY_OVERFLOW_POLICY: What to do with a new reply when the queue
+        of the messenger is full: "block" waits for free space, "drop_oldest"
+        drops the oldest queued reply, "reject" drops the new reply.
+        Defaults to "block".
+    :vartype REPLY_OVERFLOW_POLICY: Literal["block", "drop_oldest", "reject"]
+
+    :ivar REPLY_COALESCE: A boolean that indicates whether consecutive
+        replies to the same user are merged into a single message where the
+        limits below allow it. Replies to a user are always sent in order.
+        Defaults to False.
+    :vartype REPLY_COALESCE: bool
+
+    :ivar REPLY_MAX_TEXT_LENGTH: An integer that represents the maximum
+        length of the text of a merged reply. Defaults to 4096.
+    :vartype REPLY_MAX_TEXT_LENGTH: int
+
+    :ivar REPLY_MAX_ATTACHMENTS: An integer that represents the maximum
+        number of attachments of a merged reply. Defaults to 10.
+    :vartype REPLY_MAX_ATTACHMENTS: int
+
+    :ivar STATE_CACHE: A boolean that indicates whether the message handler
+        should cache users' stages and access levels in memory and write
+        their changes in batches. Defaults to False.
+    :vartype STATE_CACHE: bool
+
+    :ivar STATE_CACHE_SIZE: An integer that represents the maximum number of
+        users whose states are cached. Defaults to 10000.
+    :vartype STATE_CACHE_SIZE: int
+
+    :ivar STATE_CACHE_TTL: A float that represents the time (in seconds) a
+        cached state read from the database stays valid. Defaults to 60.
+    :vartype STATE_CACHE_TTL: float
+
+    :ivar STATE_FLUSH_INTERVAL: A float that represents the time (in
+        seconds) between batched writes of the changed states. Defaults to 1.
+    :vartype STATE_FLUSH_INTERVAL: float
+
+    :ivar STATE_BATCH_SIZE: An integer that represents the maximum number of
+        users whose states are fetched with a single `getter_many` call.
+        Defaults to 500.
+    :vartype STATE_BATCH_SIZE: int
+
+    :ivar DISPATCHER_WORKERS: An integer that represents the maximum number
+        of messages the server processes at once. Messages of the same user
+        are always processed one after another. Defaults to 100.
+    :vartype DISPATCHER_WORKERS: int
+
+    :ivar SERVER_VIRTUAL_NODES: An integer that represents the amount of
+        points each server takes on the hash ring of a servers list. More
+        points spread users between servers more evenly. Defaults to 100.
+    :vartype SERVER_VIRTUAL_NODES: int
+
+    :ivar SERVER_HEALTH_CHECK_INTERVAL: A float that represents the time
+        (in seconds) between checks of unavailable servers of a servers
+        list. Defaults to 5.
+    :vartype SERVER_HEALTH_CHECK_INTERVAL: float
+
+    :ivar DURABLE_QUEUE_DIR: A string that represents the directory of the
+        durable queue of the clients. Messages are written to the queue
+        and delivered to the server in the background, so they survive
+        server restarts. The queue isn't used if None. Defaults to None.
+    :vartype DURABLE_QUEUE_DIR: str | None
+
+    :ivar DURABLE_QUEUE_SEGMENT_SIZE: An integer that represents the size
+        (in bytes) of a segment file of the durable queue. Delivered
+        segments are deleted. Defaults to 64 MB.
+    :vartype DURABLE_QUEUE_SEGMENT_SIZE: int
+
+    :ivar DURABLE_QUEUE_FSYNC_INTERVAL: A float that represents the time
+        (in seconds) messages are collected for before being synced to the
+        disk together. Defaults to 0.005.
+    :vartype DURABLE_QUEUE_FSYNC_INTERVAL: float
+
+    :ivar DOWNLOAD_MAX_CONCURRENCY: An integer that represents the maximum
+        number of files downloaded at once by a client. Defaults to 5.
+    :vartype DOWNLOAD_MAX_CONCURRENCY: int
+
+    :ivar DOWNLOAD_RETRIES: An integer that represents the number of times
+        a failed download is retried. Defaults to 3.
+    :vartype DOWNLOAD_RETRIES: int
+
+    :ivar DOWNLOAD_TIMEOUT: A float that represents the maximum time (in
+        seconds) of a single download attempt. Defaults to 60.
+    :vartype DOWNLOAD_TIMEOUT: float
+
+    :ivar DOWNLOAD_MAX_SIZE: An integer that represents the maximum size
+        (in bytes) of a downloaded file. Defaults to 50 MB.
+    :vartype DOWNLOAD_MAX_SIZE: int
+
+    :ivar DOWNLOAD_MESSAGE_MAX_SIZE: An integer that represents the maximum
+        total size (in bytes) of the files downloaded for a single message.
+        Files over the budget are reported in `MessageStruct.failed_files`.
+        Defaults to 100 MB.
+    :vartype DOWNLOAD_MESSAGE_MAX_SIZE: int
+
+    :ivar LAZY_FILES: A boolean that represents whether the clients send
+        references to the received files instead of downloading them. The
+        server downloads the files only if a `FileTrigger` matches them,
+        with the `file_resolver` of the messenger. Defaults to False.
+    :vartype LAZY_FILES: bool
+
+    :ivar METRICS: A boolean that represents whether the latencies and
+        counters of the message pipeline are recorded to
+        `pybotterfly.bot.metrics.registry`. Defaults to False.
+    :vartype METRICS: bool
+
+    :ivar METRICS_HOST: A string that represents the host the server
+        serves the metrics on. Defaults to "127.0.0.1".
+    :vartype METRICS_HOST: str
+
+    :ivar METRICS_PORT: An integer that represents the port the server
+        serves the metrics on in the Prometheus text format at `/metrics`.
+        Server workers use the following ports. Defaults to None (the
+        metrics aren't served).
+    :vartype METRICS_PORT: int | None
+
+    :ivar TRACING: A boolean that represents whether the clients assign
+        trace IDs to messages and the steps of processing them are recorded
+        as spans by `pybotterfly.bot.tracing.tracer`. Defaults to False.
+    :vartype TRACING: bool
+
+    :ivar TRACE_FILE: A string that represents the path of the file the
+        spans are appended to as JSON lines. Defaults to None (the latest
+        spans are kept in memory).
+    :vartype TRACE_FILE: str | None
     """
 
     ADDED_MESSENGERS: TypeAlias = Literal["vk", "tg"]
@@ -45,6 +218,11 @@ class BaseConfig:
         "primary", "secondary", "positive", "negative"
     ]
     DEBUG_STATE: bool = True
+    LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = (
+        "DEBUG"
+    )
+    LOG_QUEUE_SIZE = 10000
+    LOG_BATCH_SIZE = 100
     MAX_BUTTONS_IN_ROW = 4
     MAX_BUTTON_ROWS = 9
     MAX_BUTTONS_AMOUNT = 10
@@ -62,3 +240,36 @@ class BaseConfig:
         ".pdf",
     ]
     ALLOWED_FILE_EXTENSIONS_LIST: List[str] = get_args(ALLOWED_FILE_EXTENSIONS)
+    PERSISTENT_CONNECTION: bool = True
+    SERVER_CONNECTIONS = 2
+    MAX_IN_FLIGHT_MESSAGES = 100
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    SPOOL_FILE_SIZE = 1024 * 1024
+    REPLY_MAX_IN_FLIGHT = 100
+    REPLY_QUEUE_SIZE = 1000
+    REPLY_OVERFLOW_POLICY: Literal["block", "drop_oldest", "reject"] = "block"
+    REPLY_COALESCE: bool = False
+    REPLY_MAX_TEXT_LENGTH = 4096
+    REPLY_MAX_ATTACHMENTS = 10
+    STATE_CACHE: bool = False
+    STATE_CACHE_SIZE = 10000
+    STATE_CACHE_TTL = 60.0
+    STATE_FLUSH_INTERVAL = 1.0
+    STATE_BATCH_SIZE = 500
+    DISPATCHER_WORKERS = 100
+    SERVER_VIRTUAL_NODES = 100
+    SERVER_HEALTH_CHECK_INTERVAL = 5.0
+    DURABLE_QUEUE_DIR: str | None = None
+    DURABLE_QUEUE_SEGMENT_SIZE = 64 * 1024 * 1024
+    DURABLE_QUEUE_FSYNC_INTERVAL = 0.005
+    DOWNLOAD_MAX_CONCURRENCY = 5
+    DOWNLOAD_RETRIES = 3
+    DOWNLOAD_TIMEOUT = 60.0
+    DOWNLOAD_MAX_SIZE = 50 * 1024 * 1024
+    DOWNLOAD_MESSAGE_MAX_SIZE = 100 * 1024 * 1024
+    LAZY_FILES: bool = False
+    METRICS: bool = False
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PORT: int | None = None
+    TRACING: bool = False
+    TRACE_FILE: str | None = None
@@ -2,9 +2,36 @@ import dataclasses
 import json
 import ast
 import base64
+import functools
 import importlib
+import struct
 import sys
 import pickle
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Tuple
+
+
+@functools.cache
+def _dataclass_reference(datacls: type) -> str:
+    mod = sys.modules.get(datacls.__module__)
+    if mod is None or not hasattr(mod, datacls.__qualname__):
+        raise ValueError(f"Can't resolve '{datacls!r}' reference")
+    return f"{datacls.__module__}.{datacls.__qualname__}"
+
+
+@functools.cache
+def _resolve_dataclass(ref: str) -> type:
+    try:
+        modname, _, qualname = ref.rpartition(".")
+        module = importlib.import_module(modname)
+        datacls = getattr(module, qualname)
+        if not dataclasses.is_dataclass(datacls) or not isinstance(
+            datacls, type
+        ):
+            raise ValueError
+        return datacls
+    except (ModuleNotFoundError, ValueError, AttributeError):
+        raise ValueError(f"Invalid dataclass reference {ref!r}") from None
 
 
 def dataclass_object_dump(obj) -> dict:
@@ -13,10 +40,7 @@ def dataclass_object_dump(obj) -> dict:
         raise TypeError(
             f"Expected dataclass instance, got '{datacls!r}' object"
         )
-    mod = sys.modules.get(datacls.__module__)
-    if mod is None or not hasattr(mod, datacls.__qualname__):
-        raise ValueError(f"Can't resolve '{datacls!r}' reference")
-    ref = f"{datacls.__module__}.{datacls.__qualname__}"
+    ref = _dataclass_reference(datacls)
     fields = (f.name for f in dataclasses.fields(obj))
     return {**{f: getattr(obj, f) for f in fields}, "__dataclass__": ref}
 
@@ -25,16 +49,10 @@ def dataclass_object_load(dictionary: dict):
     ref = dictionary.pop("__dataclass__", None)
     if ref is None:
         return dictionary
+    datacls = _resolve_dataclass(ref)
     try:
-        modname, _, qualname = ref.rpartition(".")
-        module = importlib.import_module(modname)
-        datacls = getattr(module, qualname)
-        if not dataclasses.is_dataclass(datacls) or not isinstance(
-            datacls, type
-        ):
-            raise ValueError
         return datacls(**dictionary)
-    except (ModuleNotFoundError, ValueError, AttributeError, TypeError):
+    except TypeError:
         raise ValueError(f"Invalid dataclass reference {ref!r}") from None
 
 
@@ -149,3 +167,542 @@ def bytes_to_dataclass(encoded_obj: bytes):
     :return: The dataclass you've encoded
     """
     return str_to_dataclass(bytes_to_str(encoded_obj))
+
+
+@functools.cache
+def _schemas() -> Tuple[Dict[type, Tuple[int, Tuple[str, ...]]], Dict]:
+    from pybotterfly.bot.struct import File, MessageStruct
+    from pybotterfly.bot.returns.message import Return, Returns
+    from pybotterfly.bot.returns.buttons import (
+        Buttons,
+        InlineButtons,
+        _Button,
+        _InlineButton,
+    )
+
+    def _fields(datacls: type) -> Tuple[str, ...]:
+        return tuple(field.name for field in dataclasses.fields(datacls))
+
+    schemas = [
+        (1, MessageStruct, _fields(MessageStruct)),
+        (2, File, _fields(File)),
+        (3, Return, _fields(Return)),
+        (4, Returns, _fields(Returns)),
+        (5, Buttons, ("buttons",)),
+        (6, InlineButtons, ("buttons",)),
+        (7, _Button, ("label", "color", "new_line_after")),
+        (8, _InlineButton, ("label", "color", "payload", "new_line_after")),
+    ]
+    by_class = {cls: (type_id, fields) for type_id, cls, fields in schemas}
+    by_id = {type_id: (cls, fields) for type_id, cls, fields in schemas}
+    return by_class, by_id
+
+
+class BaseCodec(ABC):
+    """
+    Base class of the wire formats used between the clients and the server.
+
+    Every codec except of the legacy one writes its :attr:`version` as the
+    first byte of the encoded message, so the server can decode messages
+    from clients that use different codecs.
+
+    :ivar version: The version byte of the codec.
+    :vartype version: int
+    """
+
+    version: int
+
+    @abstractmethod
+    def encode(self, obj) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes):
+        pass
+
+    def encode_parts(self, obj) -> List[bytes]:
+        """
+        Encode a dataclass to a list of parts that are written to the
+        connection one after another without being joined.
+
+        :param obj: The dataclass to encode.
+
+        :return: The parts of the encoded dataclass.
+        :rtype: List[bytes]
+        """
+        return [self.encode(obj)]
+
+
+class PickleJsonCodec(BaseCodec):
+    """
+    The legacy codec. Encodes dataclasses to JSON with a reference to the
+    dataclass and pickles the resulting string. Files are sent as base64
+    strings.
+    """
+
+    version = pickle.PROTO[0]
+
+    def encode(self, obj) -> bytes:
+        files = getattr(obj, "files", None) or []
+        raw_files = [message_file.file_bytes for message_file in files]
+        try:
+            for message_file in files:
+                if message_file.file_bytes != None:
+                    message_file.file_bytes = file_to_string(
+                        message_file.file_bytes
+                    )
+            return dataclass_to_bytes(obj)
+        finally:
+            for message_file, file_bytes in zip(files, raw_files):
+                message_file.file_bytes = file_bytes
+
+    def decode(self, data: bytes):
+        obj = bytes_to_dataclass(data)
+        for message_file in getattr(obj, "files", None) or []:
+            if isinstance(message_file.file_bytes, str):
+                message_file.file_bytes = string_to_file(
+                    message_file.file_bytes
+                )
+        return obj
+
+
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_INT = 3
+_BIG_INT = 4
+_FLOAT = 5
+_STR = 6
+_BYTES = 7
+_LIST = 8
+_DICT = 9
+_OBJECT = 10
+_BUFFER = 11
+
+_OUT_OF_BAND_SIZE = 1024
+
+_U8 = struct.Struct(">B")
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_I64 = struct.Struct(">q")
+_F64 = struct.Struct(">d")
+_OBJECT_HEADER = struct.Struct(">BB")
+_BINARY_HEADER = struct.Struct(">BII")
+
+
+@dataclasses.dataclass()
+class _PendingBuffer:
+    index: int
+
+
+@dataclasses.dataclass()
+class DeferredBuffers:
+    """
+    Out-of-band buffers of a decoded message that are still being received.
+
+    :param slots: The containers (dataclasses, lists or dicts) and the
+        field names, indexes or keys in them that wait for the buffer with
+        the given index.
+    :type slots: List[Tuple[Any, Any, int]]
+
+    :param value: The decoded message. Replaced by its buffer if the whole
+        message is a single out-of-band buffer.
+    :type value: Any
+    """
+
+    slots: List[Tuple[Any, Any, int]] = dataclasses.field(default_factory=list)
+    value: Any = None
+
+    def fill(self, buffers: List[bytes]) -> None:
+        """
+        Sets the received buffers to the places that wait for them.
+
+        :param buffers: The received out-of-band buffers.
+        :type buffers: List[bytes]
+        """
+        for container, key, index in self.slots:
+            if isinstance(container, (list, dict)):
+                container[key] = buffers[index]
+            else:
+                setattr(container, key, buffers[index])
+
+    def _add_slot(self, container: Any, key: Any, value: Any) -> None:
+        if isinstance(value, _PendingBuffer):
+            self.slots.append((container, key, value.index))
+
+
+class BinaryCodec(BaseCodec):
+    """
+    A compact schema-aware binary codec. Known dataclasses are written as a
+    type ID followed by their fields in declaration order, so neither field
+    names nor class references are sent over the wire. Messages encoded
+    with fewer fields (by an older client) are decoded with the defaults of
+    the missing fields.
+
+    Large bytes values (file attachments) aren't copied into the body of
+    the message. They are sent as separate out-of-band buffers after it:
+
+        version (1 byte) | buffers amount (4 bytes) | body length (4 bytes) |
+        buffer lengths (8 bytes each) | body | buffers
+    """
+
+    version = 1
+
+    def encode(self, obj) -> bytes:
+        return b"".join(self.encode_parts(obj))
+
+    def encode_parts(self, obj) -> List[bytes]:
+        body = bytearray()
+        buffers = []
+        self._write(
+            buffer=body, value=obj, schemas=_schemas()[0], buffers=buffers
+        )
+        head = bytearray(
+            _BINARY_HEADER.pack(self.version, len(buffers), len(body))
+        )
+        for out_of_band in buffers:
+            head += _U64.pack(len(out_of_band))
+        return [bytes(head), bytes(body), *buffers]
+
+    def decode(self, data: bytes):
+        view = memoryview(data)
+        body_length, buffer_lengths = self.read_head(data=view)
+        offset = self.head_size(buffers_amount=len(buffer_lengths))
+        body = view[offset : offset + body_length]
+        offset += body_length
+        buffers = []
+        for length in buffer_lengths:
+            buffers.append(view[offset : offset + length])
+            offset += length
+        return self.decode_parts(body=body, buffers=buffers)
+
+    def head_size(self, buffers_amount: int) -> int:
+        """
+        Returns the size of the head of a message.
+
+        :param buffers_amount: The amount of out-of-band buffers.
+        :type buffers_amount: int
+
+        :return: The size of the head in bytes.
+        :rtype: int
+        """
+        return _BINARY_HEADER.size + buffers_amount * _U64.size
+
+    def buffers_amount(self, data: bytes) -> int:
+        """
+        Reads the amount of out-of-band buffers from the beginning of a
+        message.
+
+        :param data: The beginning of the encoded message.
+        :type data: bytes
+
+        :return: The amount of out-of-band buffers.
+        :rtype: int
+        """
+        return _BINARY_HEADER.unpack_from(data, 0)[1]
+
+    def read_head(self, data: bytes) -> Tuple[int, List[int]]:
+        """
+        Reads the head of a message.
+
+        :param data: The encoded message or its beginning. Should contain
+            the whole head.
+        :type data: bytes
+
+        :return: The length of the body and the lengths of the out-of-band
+            buffers.
+        :rtype: Tuple[int, List[int]]
+
+        :raises ValueError: If the version of the message is not supported.
+        """
+        version, buffers_amount, body_length = _BINARY_HEADER.unpack_from(
+            data, 0
+        )
+        if version != self.version:
+            raise ValueError(f"Unsupported codec version {version}")
+        buffer_lengths = [
+            _U64.unpack_from(data, _BINARY_HEADER.size + num * _U64.size)[0]
+            for num in range(buffers_amount)
+        ]
+        return body_length, buffer_lengths
+
+    def decode_parts(self, body: bytes, buffers: List[bytes]):
+        """
+        Decodes a message from its body and out-of-band buffers.
+
+        :param body: The body of the message.
+        :type body: bytes
+
+        :param buffers: The out-of-band buffers of the message.
+        :type buffers: List[bytes]
+
+        :return: The dataclass you've encoded
+        """
+        value, _ = self._read(
+            view=memoryview(body),
+            offset=0,
+            schemas=_schemas()[1],
+            buffers=buffers,
+        )
+        return value
+
+    def decode_deferred(self, body: bytes) -> Tuple[Any, "DeferredBuffers"]:
+        """
+        Decodes a message from its body before its out-of-band buffers are
+        received. The buffers are set to the decoded dataclasses later with
+        :meth:`DeferredBuffers.fill`.
+
+        :param body: The body of the message.
+        :type body: bytes
+
+        :return: The dataclass you've encoded and its deferred buffers.
+        :rtype: Tuple[Any, DeferredBuffers]
+        """
+        deferred = DeferredBuffers()
+        deferred.value, _ = self._read(
+            view=memoryview(body),
+            offset=0,
+            schemas=_schemas()[1],
+            buffers=deferred,
+        )
+        deferred._add_slot(
+            container=deferred, key="value", value=deferred.value
+        )
+        return deferred.value, deferred
+
+    def _write(
+        self,
+        buffer: bytearray,
+        value: Any,
+        schemas: dict,
+        buffers: list | None,
+    ) -> None:
+        if value is None:
+            buffer.append(_NONE)
+        elif value is True:
+            buffer.append(_TRUE)
+        elif value is False:
+            buffer.append(_FALSE)
+        elif isinstance(value, int):
+            if -(2**63) <= value < 2**63:
+                buffer.append(_INT)
+                buffer += _I64.pack(value)
+            else:
+                encoded = str(value).encode()
+                buffer.append(_BIG_INT)
+                buffer += _U32.pack(len(encoded))
+                buffer += encoded
+        elif isinstance(value, float):
+            buffer.append(_FLOAT)
+            buffer += _F64.pack(value)
+        elif isinstance(value, str):
+            encoded = value.encode()
+            buffer.append(_STR)
+            buffer += _U32.pack(len(encoded))
+            buffer += encoded
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            if buffers != None and len(value) >= _OUT_OF_BAND_SIZE:
+                buffer.append(_BUFFER)
+                buffer += _U32.pack(len(buffers))
+                buffers.append(value)
+            else:
+                buffer.append(_BYTES)
+                buffer += _U32.pack(len(value))
+                buffer += value
+        elif isinstance(value, (list, tuple)):
+            buffer.append(_LIST)
+            buffer += _U32.pack(len(value))
+            for item in value:
+                self._write(
+                    buffer=buffer, value=item, schemas=schemas, buffers=buffers
+                )
+        elif isinstance(value, dict):
+            buffer.append(_DICT)
+            buffer += _U32.pack(len(value))
+            for key, item in value.items():
+                # Keys are always written inline: a key has to be hashable
+                # before its buffer is received.
+                self._write(
+                    buffer=buffer, value=key, schemas=schemas, buffers=None
+                )
+                self._write(
+                    buffer=buffer, value=item, schemas=schemas, buffers=buffers
+                )
+        elif type(value) in schemas:
+            type_id, fields = schemas[type(value)]
+            buffer.append(_OBJECT)
+            buffer += _OBJECT_HEADER.pack(type_id, len(fields))
+            for field_name in fields:
+                self._write(
+                    buffer=buffer,
+                    value=getattr(value, field_name),
+                    schemas=schemas,
+                    buffers=buffers,
+                )
+        else:
+            raise TypeError(f"Can't encode '{type(value)!r}' object")
+
+    def _read(
+        self, view: memoryview, offset: int, schemas: dict, buffers: list
+    ) -> Tuple[Any, int]:
+        tag = view[offset]
+        offset += 1
+        if tag == _NONE:
+            return None, offset
+        if tag == _TRUE:
+            return True, offset
+        if tag == _FALSE:
+            return False, offset
+        if tag == _INT:
+            return _I64.unpack_from(view, offset)[0], offset + _I64.size
+        if tag == _FLOAT:
+            return _F64.unpack_from(view, offset)[0], offset + _F64.size
+        if tag == _BUFFER:
+            index = _U32.unpack_from(view, offset)[0]
+            if isinstance(buffers, DeferredBuffers):
+                return _PendingBuffer(index=index), offset + _U32.size
+            out_of_band = buffers[index]
+            if not isinstance(out_of_band, bytes):
+                out_of_band = bytes(out_of_band)
+            return out_of_band, offset + _U32.size
+        if tag in (_STR, _BIG_INT, _BYTES):
+            length = _U32.unpack_from(view, offset)[0]
+            offset += _U32.size
+            raw = view[offset : offset + length]
+            offset += length
+            if tag == _BYTES:
+                return bytes(raw), offset
+            if tag == _BIG_INT:
+                return int(str(raw, "utf-8")), offset
+            return str(raw, "utf-8"), offset
+        if tag == _LIST:
+            length = _U32.unpack_from(view, offset)[0]
+            offset += _U32.size
+            items = []
+            for _ in range(length):
+                item, offset = self._read(
+                    view=view, offset=offset, schemas=schemas, buffers=buffers
+                )
+                if isinstance(buffers, DeferredBuffers):
+                    buffers._add_slot(
+                        container=items, key=len(items), value=item
+                    )
+                items.append(item)
+            return items, offset
+        if tag == _DICT:
+            length = _U32.unpack_from(view, offset)[0]
+            offset += _U32.size
+            items = {}
+            for _ in range(length):
+                key, offset = self._read(
+                    view=view, offset=offset, schemas=schemas, buffers=buffers
+                )
+                items[key], offset = self._read(
+                    view=view, offset=offset, schemas=schemas, buffers=buffers
+                )
+                if isinstance(buffers, DeferredBuffers):
+                    buffers._add_slot(
+                        container=items, key=key, value=items[key]
+                    )
+            return items, offset
+        if tag == _OBJECT:
+            type_id, fields_amount = _OBJECT_HEADER.unpack_from(view, offset)
+            offset += _OBJECT_HEADER.size
+            if type_id not in schemas:
+                raise ValueError(f"Unknown type ID {type_id}")
+            cls, fields = schemas[type_id]
+            kwargs = {}
+            for num in range(fields_amount):
+                value, offset = self._read(
+                    view=view, offset=offset, schemas=schemas, buffers=buffers
+                )
+                if num < len(fields):
+                    kwargs[fields[num]] = value
+            obj = cls(**kwargs)
+            if isinstance(buffers, DeferredBuffers):
+                for field_name, value in kwargs.items():
+                    buffers._add_slot(
+                        container=obj, key=field_name, value=value
+                    )
+            return obj, offset
+        raise ValueError(f"Unknown tag {tag}")
+
+
+_CODECS: Dict[int, BaseCodec] = {
+    codec.version: codec for codec in (PickleJsonCodec(), BinaryCodec())
+}
+
+
+def encode_message(obj, codec: BaseCodec | None = None) -> bytes:
+    """
+    Encode a dataclass with the given codec.
+
+    :param obj: The dataclass to encode.
+
+    :param codec: The codec to use. Defaults to BinaryCodec.
+    :type codec: BaseCodec | None
+
+    :return: The encoded dataclass.
+    :rtype: bytes
+    """
+    return (codec if codec != None else _CODECS[BinaryCodec.version]).encode(
+        obj
+    )
+
+
+def decode_message(data: bytes, codec: BaseCodec | None = None):
+    """
+    Decode a message with the codec chosen by its version byte.
+
+    :param data: The encoded message.
+    :type data: bytes
+
+    :param codec: An additional codec to check before the built-in ones.
+    :type codec: BaseCodec | None
+
+    :return: The dataclass you've encoded
+
+    :raises ValueError: If the version of the message is unknown.
+    """
+    return get_codec(version=data[0], codec=codec).decode(data)
+
+
+def encode_message_parts(obj, codec: BaseCodec | None = None) -> List[bytes]:
+    """
+    Encode a dataclass with the given codec to a list of parts. File
+    attachments are returned as separate parts, so they don't have to be
+    copied to be written to the connection.
+
+    :param obj: The dataclass to encode.
+
+    :param codec: The codec to use. Defaults to BinaryCodec.
+    :type codec: BaseCodec | None
+
+    :return: The parts of the encoded dataclass.
+    :rtype: List[bytes]
+    """
+    return (
+        codec if codec != None else _CODECS[BinaryCodec.version]
+    ).encode_parts(obj)
+
+
+def get_codec(version: int, codec: BaseCodec | None = None) -> BaseCodec:
+    """
+    Returns the codec for the given version byte.
+
+    :param version: The version byte of the message.
+    :type version: int
+
+    :param codec: An additional codec to check before the built-in ones.
+    :type codec: BaseCodec | None
+
+    :return: The codec for the version.
+    :rtype: BaseCodec
+
+    :raises ValueError: If the version is unknown.
+    """
+    if codec != None and codec.version == version:
+        return codec
+    if version not in _CODECS:
+        raise ValueError(f"Unsupported codec version {version}")
+    return _CODECS[version]
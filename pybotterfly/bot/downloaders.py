@@ -1,19 +1,312 @@
 import asyncio
+import random
 import aiohttp
 
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+
+CHUNK_SIZE = 64 * 1024
+DNS_CACHE_TTL = 300
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10.0
+# Statuses worth retrying, other unsuccessful statuses fail right away
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class DownloadError(RuntimeError):
+    """
+    Raised when a file couldn't be downloaded.
+    """
+
+
+class _RetryableStatus(Exception):
+    pass
+
+
+class DownloadBudget:
+    """
+    The total size of the files that may still be downloaded for a single
+    message. The budget is shared by the concurrent downloads of the
+    message: every download is limited by the budget left when it starts
+    and is charged when it's finished, so the downloaded files never exceed
+    the budget together.
+
+    :param max_size: The maximum total size (in bytes) of the files.
+    :type max_size: int
+    """
+
+    def __init__(self, max_size: int) -> None:
+        if max_size < 0:
+            raise ValueError("Can't use negative values")
+        self._left = max_size
+
+    @property
+    def remaining(self) -> int:
+        """
+        The size (in bytes) left in the budget.
+
+        :rtype: int
+        """
+        return self._left
+
+    def charge(self, size: int) -> bool:
+        """
+        Takes the size of a downloaded file from the budget.
+
+        :param size: The size (in bytes) of the file.
+        :type size: int
+
+        :return: False if the file doesn't fit into the budget anymore (the
+            budget is left intact), True otherwise.
+        :rtype: bool
+        """
+        if size > self._left:
+            return False
+        self._left -= size
+        return True
+
+
+class Downloader:
+    """
+    Downloads files through a shared pool of keep-alive connections.
+
+    At most `DOWNLOAD_MAX_CONCURRENCY` files are downloaded at once by all
+    of the callers. Failed requests and the `RETRY_STATUSES` responses are
+    retried up to `DOWNLOAD_RETRIES` times with exponential backoff and full
+    jitter. Files are read in chunks and the download is stopped as soon
+    as the file exceeds the size limit.
+
+    The session is created on the first download and is bound to the event
+    loop it was created in. A new session is created if the downloader is
+    used from another loop.
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+    """
+
+    def __init__(
+        self,
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+    ) -> None:
+        if (
+            config.DOWNLOAD_MAX_CONCURRENCY <= 0
+            or config.DOWNLOAD_RETRIES < 0
+            or config.DOWNLOAD_TIMEOUT <= 0
+            or config.DOWNLOAD_MAX_SIZE <= 0
+        ):
+            raise ValueError("Can't use negative values")
+        self._max_concurrency = config.DOWNLOAD_MAX_CONCURRENCY
+        self._retries = config.DOWNLOAD_RETRIES
+        self._timeout = config.DOWNLOAD_TIMEOUT
+        self._max_size = config.DOWNLOAD_MAX_SIZE
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def download(
+        self,
+        url: str,
+        max_size: int | None = None,
+        session: aiohttp.ClientSession | None = None,
+        budget: DownloadBudget | None = None,
+    ) -> bytearray:
+        """
+        Downloads the file.
+
+        :param url: The URL of the file.
+        :type url: str
+
+        :param max_size: The maximum size (in bytes) of the file. Defaults
+            to None (BaseConfig.DOWNLOAD_MAX_SIZE).
+        :type max_size: int | None
+
+        :param session: A session to download the file with instead of the
+            shared one. The session isn't closed. Defaults to None.
+        :type session: aiohttp.ClientSession | None
+
+        :param budget: The size budget of the message the file is attached
+            to. The file is limited by the budget left and is charged to it.
+            Defaults to None.
+        :type budget: DownloadBudget | None
+
+        :return: The content of the file.
+        :rtype: bytearray
+
+        :raises DownloadError: If the file exceeds the size limit or the
+            budget, the server responded with an unsuccessful status, or all
+            of the attempts failed.
+        """
+        max_size = max_size if max_size != None else self._max_size
+        if budget != None:
+            if budget.remaining <= 0:
+                raise DownloadError(
+                    f"File {url} exceeds the size budget of the message"
+                )
+            max_size = min(max_size, budget.remaining)
+        content = await self._download(
+            url=url, max_size=max_size, session=session
+        )
+        if budget != None and not budget.charge(len(content)):
+            raise DownloadError(
+                f"File {url} exceeds the size budget of the message"
+            )
+        return content
+
+    async def _download(
+        self,
+        url: str,
+        max_size: int,
+        session: aiohttp.ClientSession | None,
+    ) -> bytearray:
+        self._bind_to_loop()
+        if session == None:
+            session = self._get_session()
+        for attempt in range(self._retries + 1):
+            try:
+                # The slot is released while waiting for the next attempt,
+                # so a failing URL doesn't hold up the other downloads
+                async with self._semaphore:
+                    return await self._fetch(
+                        session=session, url=url, max_size=max_size
+                    )
+            except (
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                _RetryableStatus,
+            ) as err:
+                if attempt == self._retries:
+                    raise DownloadError(
+                        f"Failed to download {url} after "
+                        f"{attempt + 1} attempts: {err!r}"
+                    ) from err
+                delay = random.uniform(
+                    0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+                )
+                self._logger.emit(
+                    "WARNING",
+                    (
+                        "Failed to download %s (attempt %s): %r. Retrying "
+                        "in %.2f seconds"
+                    ),
+                    url,
+                    attempt + 1,
+                    err,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        """
+        Closes the shared session.
+        """
+        if self._session != None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _bind_to_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._session != None and not self._session.closed:
+            self._discard_session(session=self._session, loop=self._loop)
+        self._loop = loop
+        self._session = None
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+    def _discard_session(
+        self,
+        session: aiohttp.ClientSession,
+        loop: asyncio.AbstractEventLoop | None,
+    ) -> None:
+        if loop != None and not loop.is_closed():
+            # A session can only be closed by the loop it was created in
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+        self._logger.emit(
+            "WARNING",
+            (
+                "The session of a closed event loop is dropped without "
+                "closing its connections. Close the downloader before its "
+                "event loop ends"
+            ),
+        )
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session == None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._max_concurrency, ttl_dns_cache=DNS_CACHE_TTL
+                ),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+        return self._session
+
+    async def _fetch(
+        self, session: aiohttp.ClientSession, url: str, max_size: int
+    ) -> bytearray:
+        async with session.get(url) as resp:
+            if resp.status in RETRY_STATUSES:
+                raise _RetryableStatus(f"Status {resp.status}")
+            if resp.status != 200:
+                raise DownloadError(
+                    f"Failed to download {url}: status {resp.status}"
+                )
+            if resp.content_length != None and resp.content_length > max_size:
+                raise DownloadError(
+                    f"File {url} exceeds {max_size} bytes "
+                    f"({resp.content_length} bytes)"
+                )
+            content = bytearray()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                content.extend(chunk)
+                if len(content) > max_size:
+                    raise DownloadError(f"File {url} exceeds {max_size} bytes")
+            # Not copied to bytes, so a file is held in memory only once
+            return content
+
+
+_default_downloader: Downloader | None = None
+
 
 async def download_file(
     url: str, _session: aiohttp.ClientSession | None = None
-) -> bytes:
-    if _session != None:
-        session = _session
-    else:
-        session = aiohttp.ClientSession()
-    async with session:
-        async with asyncio.BoundedSemaphore(5):
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    return await resp.read()
-                else:
-                    await asyncio.sleep(1)
-                    return await download_file(url=url, _session=session)
+) -> bytearray:
+    """
+    Downloads the file with the shared default Downloader.
+
+    :param url: The URL of the file.
+    :type url: str
+
+    :param _session: A session to download the file with instead of the
+        shared one. The session isn't closed. Defaults to None.
+    :type _session: aiohttp.ClientSession | None
+
+    :return: The content of the file.
+    :rtype: bytearray
+
+    :raises DownloadError: If the file couldn't be downloaded.
+    """
+    global _default_downloader
+    if _default_downloader == None:
+        _default_downloader = Downloader()
+    return await _default_downloader.download(url=url, session=_session)
+
+
+async def close_default_downloader() -> None:
+    """
+    Closes the session of the shared default Downloader. Should be called
+    on shutdown if :func:`download_file` was used.
+    """
+    global _default_downloader
+    if _default_downloader != None:
+        await _default_downloader.close()
+        _default_downloader = None
@@ -1,10 +1,20 @@
+import atexit
+import json
+import multiprocessing.util
+import os
+import queue
+import sys
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Literal
+from typing import Literal, TextIO
 from abc import ABC, abstractmethod
 
 from pybotterfly.base_config import BaseConfig
 
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
 
 @dataclass()
 class Log:
@@ -19,16 +29,215 @@ class BaseLogger(ABC):
     def log(self, log: Log):
         pass
 
+    def is_enabled(self, level: str) -> bool:
+        """
+        Checks whether the records of the level are logged. Loggers should
+        override it, so disabled records aren't even formatted.
+
+        :param level: The level of the record.
+        :type level: str
+
+        :rtype: bool
+        """
+        return True
+
+    def emit(
+        self,
+        level: str,
+        text: str,
+        *args,
+        time: datetime | None = None,
+        starts_with: str = "",
+    ) -> None:
+        """
+        Logs a record. The text is formatted with the args (`text % args`)
+        only if the level is enabled, so pass the values as args instead of
+        formatting them beforehand.
+
+        :param level: The level of the record.
+        :type level: str
+
+        :param text: The text of the record, a %-format string if args are
+            given.
+        :type text: str
+
+        :param args: The values to format the text with.
+
+        :param time: The time of the record. Defaults to None (the time of
+            logging).
+        :type time: datetime | None
+
+        :param starts_with: A string printed before the record. Defaults to
+            "".
+        :type starts_with: str
+        """
+        if not self.is_enabled(level):
+            return
+        self.log(
+            log=Log(
+                level=level,
+                text=text % args if args else text,
+                time=time,
+                starts_with=starts_with,
+            )
+        )
+
 
 class DefaultLogger(BaseLogger):
     def __init__(self, config: BaseConfig = BaseConfig) -> None:
         self.config = config
+        self._min_level = LEVELS[config.LOG_LEVEL]
+
+    def is_enabled(self, level: str) -> bool:
+        return self.config.DEBUG_STATE and LEVELS[level] >= self._min_level
 
     def log(self, log: Log):
-        if self.config.DEBUG_STATE:
+        if self.is_enabled(log.level):
             log_str = (
                 f"{log.starts_with}[{log.level}] "
                 f"[{log.time if log.time != None else datetime.now()}]: "
                 f"{log.text}"
             )
             print(log_str)
+
+
+class QueueLogger(BaseLogger):
+    """
+    A logger that never blocks the caller. Records are put into a bounded
+    queue and written by a background thread as JSON lines, in batches of
+    up to `LOG_BATCH_SIZE` records. If the queue is full (the stream is
+    slower than the records come) new records are dropped and counted, and
+    the writer reports the amount of dropped records. A forked process
+    starts its own writer thread.
+
+    Unlike the DefaultLogger, it logs in production mode too: records are
+    filtered by `LOG_LEVEL` only.
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param stream: The stream the records are written to. Defaults to None
+        (sys.stdout).
+    :type stream: TextIO | None
+
+    :ivar dropped: The amount of records dropped because the queue was
+        full.
+    :vartype dropped: int
+    """
+
+    def __init__(
+        self, config: BaseConfig = BaseConfig, stream: TextIO | None = None
+    ) -> None:
+        if config.LOG_QUEUE_SIZE <= 0 or config.LOG_BATCH_SIZE <= 0:
+            raise ValueError("Can't use negative values")
+        self.config = config
+        self._stream = stream if stream != None else sys.stdout
+        self._min_level = LEVELS[config.LOG_LEVEL]
+        self._batch_size = config.LOG_BATCH_SIZE
+        self._closed = False
+        self._start()
+        atexit.register(self.close)
+        # Forked children (server workers) get their own queue and writer
+        # thread, and write the queued records at their exit
+        os.register_at_fork(after_in_child=self._start)
+        multiprocessing.util.register_after_fork(self, QueueLogger._on_fork)
+
+    def _start(self) -> None:
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue(
+            maxsize=self.config.LOG_QUEUE_SIZE
+        )
+        self._writer = threading.Thread(
+            target=self._write_loop, name="QueueLogger", daemon=True
+        )
+        if not self._closed:
+            self._writer.start()
+
+    def _on_fork(self) -> None:
+        # multiprocessing children exit without running atexit handlers
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def is_enabled(self, level: str) -> bool:
+        return not self._closed and LEVELS[level] >= self._min_level
+
+    def log(self, log: Log):
+        if not self.is_enabled(log.level):
+            return
+        try:
+            self._queue.put_nowait(
+                (
+                    log.time if log.time != None else datetime.now(),
+                    log.level,
+                    log.text,
+                )
+            )
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Writes the queued records and stops the writer thread. Records
+        logged after closing are ignored. Called at the exit of the
+        interpreter.
+
+        :param timeout: The maximum time (in seconds) to wait for the
+            queued records to be written. Defaults to 5.
+        :type timeout: float
+        """
+        if self._closed:
+            return
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._writer.join(timeout=max(deadline - time.monotonic(), 0))
+
+    def _write_loop(self) -> None:
+        stopped = False
+        while not stopped:
+            records = [self._queue.get()]
+            while len(records) < self._batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                records = records[: records.index(None)]
+                stopped = True
+            lines = [
+                self._format(time=time, level=level, text=text)
+                for time, level, text in records
+            ]
+            dropped = self.dropped
+            if dropped != self._reported_dropped:
+                lines.append(
+                    self._format(
+                        time=datetime.now(),
+                        level="WARNING",
+                        text=(
+                            f"Dropped {dropped - self._reported_dropped} log "
+                            f"records, the queue was full"
+                        ),
+                    )
+                )
+                self._reported_dropped = dropped
+            try:
+                self._stream.write("".join(lines))
+                self._stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def _format(self, time: datetime, level: str, text: str) -> str:
+        return (
+            json.dumps(
+                {"time": time.isoformat(), "level": level, "text": text},
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
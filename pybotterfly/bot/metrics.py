@@ -0,0 +1,383 @@
+import functools
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Tuple
+
+from pybotterfly.base_config import BaseConfig
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Histograms keep 2 ** SUB_BUCKET_BITS buckets per power of two, so a
+# recorded value is off by less than 1 / 2 ** (SUB_BUCKET_BITS - 1)
+SUB_BUCKET_BITS = 7
+_SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+_SUB_BUCKET_HALF = _SUB_BUCKET_COUNT >> 1
+# Values are recorded in integer units of the resolution (microseconds)
+RESOLUTION = 1e-6
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _bucket_index(units: int) -> int:
+    if units < _SUB_BUCKET_COUNT:
+        return units
+    shift = units.bit_length() - SUB_BUCKET_BITS
+    return shift * _SUB_BUCKET_HALF + (units >> shift)
+
+
+def _bucket_upper_bound(index: int) -> int:
+    if index < _SUB_BUCKET_COUNT:
+        return index
+    shift = index // _SUB_BUCKET_HALF - 1
+    top = index - shift * _SUB_BUCKET_HALF
+    return ((top + 1) << shift) - 1
+
+
+class HdrHistogram:
+    """
+    A histogram of values (durations in seconds) with a fixed relative
+    precision. Values are counted in log-linear buckets, so recording is
+    O(1) and the memory doesn't depend on the amount of values.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._counts: Dict[int, int] = {}
+
+    def observe(self, value: float) -> None:
+        """
+        Records a value.
+
+        :param value: The value (in seconds).
+        :type value: float
+        """
+        index = _bucket_index(max(int(value / RESOLUTION), 0))
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, quantile: float) -> float:
+        """
+        Returns the value below which the given share of the recorded
+        values lies.
+
+        :param quantile: The share of the values, from 0 to 1.
+        :type quantile: float
+
+        :return: The value (in seconds), 0 if nothing was recorded.
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(quantile * self.count, 1)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(_bucket_upper_bound(index) * RESOLUTION, self.max)
+        return self.max
+
+
+class _CounterSeries:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class _Family:
+    kind = ""
+    series_cls: type = object
+
+    def __init__(
+        self, name: str, help_text: str, labels: Tuple[str, ...]
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._series: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values) -> Any:
+        """
+        Returns the series of the given label values, in the order of the
+        label names.
+        """
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            if len(key) != len(self.label_names):
+                raise ValueError(
+                    f"'{self.name}' expects labels {self.label_names}"
+                )
+            series = self._series[key] = self.series_cls()
+        return series
+
+    def items(self) -> List[Tuple[Dict[str, str], Any]]:
+        return [
+            (dict(zip(self.label_names, key)), series)
+            for key, series in self._series.items()
+        ]
+
+
+class Counter(_Family):
+    """
+    A family of counters split by labels.
+    """
+
+    kind = "counter"
+    series_cls = _CounterSeries
+
+    def inc(self, *label_values, amount: int = 1) -> None:
+        """
+        Increases the counter of the given label values.
+        """
+        self.labels(*label_values).inc(amount)
+
+
+class Histogram(_Family):
+    """
+    A family of HDR histograms split by labels.
+    """
+
+    kind = "summary"
+    series_cls = HdrHistogram
+
+    def observe(self, value: float, *label_values) -> None:
+        """
+        Records a value (in seconds) to the histogram of the given label
+        values.
+        """
+        self.labels(*label_values).observe(value)
+
+
+class Metrics:
+    """
+    A registry of counters and histograms. Histograms are exposed in the
+    Prometheus text format as summaries with the `QUANTILES`.
+    """
+
+    def __init__(self) -> None:
+        self._families: Dict[str, _Family] = {}
+
+    def counter(
+        self, name: str, help_text: str, labels: Tuple[str, ...] = ()
+    ) -> Counter:
+        """
+        Returns the counter with the name, registering it if needed.
+
+        :param name: The name of the counter, without the `_total` suffix.
+        :type name: str
+
+        :param help_text: The description of the counter.
+        :type help_text: str
+
+        :param labels: The names of the labels. Defaults to ().
+        :type labels: Tuple[str, ...]
+
+        :rtype: Counter
+        """
+        return self._get(Counter, name, help_text, labels)
+
+    def histogram(
+        self, name: str, help_text: str, labels: Tuple[str, ...] = ()
+    ) -> Histogram:
+        """
+        Returns the histogram with the name, registering it if needed.
+
+        :param name: The name of the histogram.
+        :type name: str
+
+        :param help_text: The description of the histogram.
+        :type help_text: str
+
+        :param labels: The names of the labels. Defaults to ().
+        :type labels: Tuple[str, ...]
+
+        :rtype: Histogram
+        """
+        return self._get(Histogram, name, help_text, labels)
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Returns the current values of the metrics.
+
+        :return: The series of every metric with their labels and values
+            (`value` of counters, `count`, `sum`, `max` and the quantiles
+            of histograms).
+        :rtype: Dict[str, List[Dict[str, Any]]]
+        """
+        snapshot = {}
+        for name, family in self._families.items():
+            series_list = []
+            for labels, series in family.items():
+                if isinstance(family, Counter):
+                    values = {"value": series.value}
+                else:
+                    values = {
+                        "count": series.count,
+                        "sum": series.sum,
+                        "max": series.max,
+                        **{
+                            f"p{quantile * 100:g}": series.percentile(quantile)
+                            for quantile in QUANTILES
+                        },
+                    }
+                series_list.append({"labels": labels, **values})
+            snapshot[name] = series_list
+        return snapshot
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family.help_text}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for labels, series in family.items():
+                if isinstance(family, Counter):
+                    lines.append(
+                        f"{name}_total{_labels(labels)} {series.value}"
+                    )
+                    continue
+                for quantile in QUANTILES:
+                    quantile_labels = {**labels, "quantile": str(quantile)}
+                    lines.append(
+                        f"{name}{_labels(quantile_labels)} "
+                        f"{series.percentile(quantile)!r}"
+                    )
+                lines.append(f"{name}_sum{_labels(labels)} {series.sum!r}")
+                lines.append(f"{name}_count{_labels(labels)} {series.count}")
+        return "\n".join(lines) + "\n"
+
+    def _get(
+        self,
+        family_cls: type,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...],
+    ):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = family_cls(
+                name=name, help_text=help_text, labels=tuple(labels)
+            )
+        elif not isinstance(family, family_cls) or family.label_names != tuple(
+            labels
+        ):
+            raise ValueError(f"Metric '{name}' is already registered")
+        return family
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in labels.items()
+    )
+    return f"{{{pairs}}}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Metrics()
+
+
+def get_metrics(config: BaseConfig = BaseConfig) -> Metrics | None:
+    """
+    Returns the registry the framework records its metrics to, or None if
+    `METRICS` isn't set, so the components skip the measurements.
+
+    :param config: An instance of the BaseConfig class.
+    :type config: BaseConfig
+
+    :rtype: Metrics | None
+    """
+    return registry if config.METRICS else None
+
+
+def timed(
+    func: Callable[..., Awaitable], series: HdrHistogram
+) -> Callable[..., Awaitable]:
+    """
+    Wraps the coroutine function, so the duration of every call is recorded
+    to the histogram.
+
+    :param func: The coroutine function.
+    :type func: Callable[..., Awaitable]
+
+    :param series: The histogram to record the durations to.
+    :type series: HdrHistogram
+
+    :rtype: Callable[..., Awaitable]
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            series.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+class MetricsServer:
+    """
+    Serves the metrics in the Prometheus text format over HTTP at
+    `/metrics`.
+
+    :param metrics: The registry to serve.
+    :type metrics: Metrics
+
+    :param host: The host to listen on.
+    :type host: str
+
+    :param port: The port to listen on.
+    :type port: int
+    """
+
+    def __init__(self, metrics: Metrics, host: str, port: int) -> None:
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._runner: "web.AppRunner | None" = None
+
+    async def start(self) -> None:
+        """
+        Starts listening.
+        """
+        # Imported only when metrics are served
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+
+    async def close(self) -> None:
+        """
+        Stops listening.
+        """
+        if self._runner != None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+
+        return web.Response(
+            body=self._metrics.render().encode(),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
@@ -1 +1,2 @@
 from . import reply_division
+from . import coalescing
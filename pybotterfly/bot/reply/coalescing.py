@@ -0,0 +1,108 @@
+from typing import Any, Dict, List, Set, Tuple
+
+from pybotterfly.bot.returns.message import Return
+
+TEXT_SEPARATOR = "\n\n"
+
+
+def group_by_user(returns: List[Return]) -> List[List[Return]]:
+    """
+    Splits the returns into lists of returns to the same user. The order of
+    the returns of a user is kept.
+
+    :param returns: The returns to split.
+    :type returns: List[Return]
+
+    :return: The lists of returns of every user, in the order of their
+        first returns.
+    :rtype: List[List[Return]]
+    """
+    groups: Dict[Tuple[str, Any], List[Return]] = {}
+    for return_message in returns:
+        groups.setdefault(
+            (return_message.user_messenger, return_message.user_messenger_id),
+            [],
+        ).append(return_message)
+    return list(groups.values())
+
+
+def coalesce_returns(
+    returns: List[Return], max_text_length: int, max_attachments: int
+) -> List[Return]:
+    """
+    Merges consecutive returns to the same user into a single return, so
+    they are sent with fewer messenger calls.
+
+    A return is merged into the previous one if the previous one has no
+    keyboard, the merged text (joined with an empty line) fits into
+    `max_text_length`, the merged attachments fit into `max_attachments`
+    and are all of the same type (Telegram rejects media groups mixing
+    photos and documents), and no text precedes the attachments of the
+    return (messengers show attachments before or under the text of a
+    message). The merged return keeps the keyboards of the last return.
+
+    :param returns: The returns to merge.
+    :type returns: List[Return]
+
+    :param max_text_length: The maximum length of the text of a message.
+    :type max_text_length: int
+
+    :param max_attachments: The maximum amount of attachments of a
+        message.
+    :type max_attachments: int
+
+    :return: The merged returns.
+    :rtype: List[Return]
+    """
+    coalesced: List[Return] = []
+    for return_message in returns:
+        if coalesced and _can_merge(
+            first=coalesced[-1],
+            second=return_message,
+            max_text_length=max_text_length,
+            max_attachments=max_attachments,
+        ):
+            coalesced[-1] = _merge(first=coalesced[-1], second=return_message)
+        else:
+            coalesced.append(return_message)
+    return coalesced
+
+
+def _join_texts(first: str, second: str) -> str:
+    if not first or not second:
+        return first or second
+    return f"{first}{TEXT_SEPARATOR}{second}"
+
+
+def _can_merge(
+    first: Return,
+    second: Return,
+    max_text_length: int,
+    max_attachments: int,
+) -> bool:
+    return (
+        first.user_messenger == second.user_messenger
+        and first.user_messenger_id == second.user_messenger_id
+        and first.keyboard == None
+        and first.inline_keyboard == None
+        and not (first.text and second.attachments)
+        and len(_join_texts(first.text, second.text)) <= max_text_length
+        and len(first.attachments) + len(second.attachments) <= max_attachments
+        and len(_get_tags(first) | _get_tags(second)) <= 1
+    )
+
+
+def _get_tags(return_message: Return) -> Set[str]:
+    return {attachment.tag for attachment in return_message.attachments}
+
+
+def _merge(first: Return, second: Return) -> Return:
+    return Return(
+        user_messenger_id=first.user_messenger_id,
+        user_messenger=first.user_messenger,
+        text=_join_texts(first.text, second.text),
+        keyboard=second.keyboard,
+        inline_keyboard=second.inline_keyboard,
+        attachments=first.attachments + second.attachments,
+        trace_id=first.trace_id,
+    )
@@ -1,4 +1,4 @@
-from asyncio import sleep
+from asyncio import sleep, TimeoutError
 from dataclasses import dataclass
 from io import BytesIO
 from typing import Optional, Union, List
@@ -6,6 +6,8 @@ from typing import Optional, Union, List
 from aiogram.types.input_media import InputFile
 from pybotterfly.bot.returns.message import Return
 from pybotterfly.bot.returns.buttons import Buttons, InlineButtons
+from pybotterfly.bot.struct import File
+from pybotterfly.bot.downloaders import Downloader, DownloadError
 from pybotterfly.base_config import BaseConfig
 
 # Vk async library
@@ -15,7 +17,9 @@ from vkbottle import KeyboardButtonColor as VkKeyboardColor
 from vkbottle import Text as VkText
 
 # Tg async library
+from aiohttp import ClientError
 from aiogram import Bot
+from aiogram.utils.exceptions import TelegramAPIError
 from aiogram.types import InlineKeyboardMarkup as TgInlineKeyboard
 from aiogram.types import InlineKeyboardButton as TgInlineKeyboardButton
 from aiogram.types import ReplyKeyboardMarkup as TgKeyboard
@@ -46,6 +50,7 @@ class DefaultVkReplier:
         self._document_uploader: DocMessagesUploader = DocMessagesUploader(
             api=self.vk_api
         )
+        self._downloader: Downloader = Downloader(config=self.config)
 
     async def vk_answer(self, return_message: Return) -> None:
         """
@@ -66,6 +71,29 @@ class DefaultVkReplier:
             attachment=await self._get_files(message=return_message),
         )
 
+    async def resolve_file(self, message_file: File) -> bytes:
+        """
+        Downloads a file received from VK by its URL. Register it as the
+        `file_resolver` of the messenger if the VK client sends files as
+        references (`LAZY_FILES`).
+
+        :param message_file: The file to download.
+        :type message_file: File
+
+        :return: The content of the file.
+        :rtype: bytes
+
+        :raises DownloadError: If the file couldn't be downloaded.
+        """
+        return await self._downloader.download(url=message_file.reference)
+
+    async def close(self) -> None:
+        """
+        Closes the session files are downloaded with. Register it as the
+        `close_func` of the messenger.
+        """
+        await self._downloader.close()
+
     async def _get_files(self, message: Return) -> None | str:
         if not bool(message.attachments):
             return
@@ -191,6 +219,43 @@ class DefaultTgReplier:
             reply_markup=keyboard if keyboard is not None else None,
         )
 
+    def message_cost(self, return_message: Return) -> int:
+        """
+        Returns the amount of Telegram calls `tg_answer` makes to send the
+        message: the media group of the attachments and the text.
+
+        :param return_message: The message to send.
+        :type return_message: Return
+
+        :rtype: int
+        """
+        return 2 if return_message.attachments else 1
+
+    async def resolve_file(self, message_file: File) -> bytes:
+        """
+        Downloads a file received from Telegram by its `file_id`. Register
+        it as the `file_resolver` of the messenger if the Telegram client
+        sends files as references (`LAZY_FILES`).
+
+        :param message_file: The file to download.
+        :type message_file: File
+
+        :return: The content of the file.
+        :rtype: bytes
+
+        :raises DownloadError: If the file couldn't be downloaded.
+        """
+        file_in_io = BytesIO()
+        try:
+            await self.tg_bot.download_file_by_id(
+                file_id=message_file.reference, destination=file_in_io
+            )
+        except (TelegramAPIError, ClientError, TimeoutError) as err:
+            raise DownloadError(
+                f"Failed to download {message_file.reference}: {err!r}"
+            ) from err
+        return file_in_io.getvalue()
+
     async def _send_files(self, message: Return):
         if not bool(message.attachments):
             return
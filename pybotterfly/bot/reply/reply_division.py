@@ -1,10 +1,52 @@
+import asyncio
+import functools
+import time
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Awaitable, Callable, Dict, Literal
 
 from pybotterfly.bot.returns.message import Return
+from pybotterfly.bot.struct import File, MessageStruct
 from pybotterfly.base_config import BaseConfig
-from pybotterfly.bot.throttlers import ThrottledResource
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.bot.throttlers import (
+    AdaptiveRateController,
+    OverflowPolicy,
+    SharedRateLimiter,
+    ThrottledResource,
+    ThrottlerStats,
+    TokenBucketThrottler,
+)
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+from pybotterfly.bot.metrics import get_metrics, timed
+from pybotterfly.bot.tracing import Tracer, get_tracer, use_trace_id
+
+
+def _traced_reply(
+    func: Callable[[Return], Awaitable], tracer: Tracer, messenger: str
+) -> Callable[[Return], Awaitable]:
+    @functools.wraps(func)
+    async def reply(return_message: Return):
+        with use_trace_id(return_message.trace_id), tracer.span(
+            "reply.send", messenger=messenger
+        ):
+            return await func(return_message)
+
+    return reply
+
+
+def _wait_time_recorder(
+    tracer: Tracer, messenger: str
+) -> Callable[[Return, float], None]:
+    def record(return_message: Return, wait_time: float) -> None:
+        end = time.perf_counter()
+        tracer.record(
+            "reply.throttle_wait",
+            start=end - wait_time,
+            end=end,
+            trace_id=return_message.trace_id,
+            messenger=messenger,
+        )
+
+    return record
 
 
 @dataclass()
@@ -19,15 +61,68 @@ class _Messenger:
     :param messages_per_second: The maximum number of messages the bot can
         send per second.
     :type messages_per_second: int
-    :param _throttler: A ThrottledResource object that throttles the rate at
+    :param throttler: The type of the throttler. Defaults to "fixed".
+    :type throttler: Literal["fixed", "token_bucket"]
+    :param burst: The maximum number of messages the bot can send at once.
+        Used by the "token_bucket" throttler only. Defaults to 1.
+    :type burst: int
+    :param per_chat_rate: The maximum number of messages the bot can send
+        per second to a single chat. Used by the "token_bucket" throttler
+        only. Defaults to None (no limit).
+    :type per_chat_rate: float or None
+    :param per_chat_burst: The maximum number of messages the bot can send
+        at once to a single chat. Used by the "token_bucket" throttler only.
+        Defaults to 1.
+    :type per_chat_burst: int
+    :param max_in_flight: The maximum number of messages sent at once.
+        Defaults to None (BaseConfig.REPLY_MAX_IN_FLIGHT).
+    :type max_in_flight: int or None
+    :param max_queue_size: The maximum number of messages waiting to be
+        sent. Defaults to None (BaseConfig.REPLY_QUEUE_SIZE).
+    :type max_queue_size: int or None
+    :param overflow_policy: What to do with a new message when the queue is
+        full. Defaults to None (BaseConfig.REPLY_OVERFLOW_POLICY).
+    :type overflow_policy: OverflowPolicy or None
+    :param adaptive: Whether the rate adapts to the messenger's rate limit
+        errors. Defaults to False.
+    :type adaptive: bool
+    :param min_messages_per_second: The lowest rate the adaptive rate can
+        fall to. Defaults to None (1/10 of `messages_per_second`).
+    :type min_messages_per_second: float or None
+    :param max_retries: The amount of times a rate limited message is sent
+        again when the rate is adaptive. Defaults to 3.
+    :type max_retries: int
+    :param message_cost: A function that returns the share of the rate
+        limit a message takes. Defaults to None (every message takes 1).
+    :type message_cost: Callable[[Return], int] or None
+    :param file_resolver: A coroutine that downloads a received file by
+        its reference. Defaults to None.
+    :type file_resolver: Callable[[File], Awaitable[bytes]] or None
+    :param close_func: A coroutine that releases the resources of the
+        replier on shutdown. Defaults to None.
+    :type close_func: Callable[[], Awaitable[None]] or None
+    :param _throttler: A throttler object that throttles the rate at
         which messages can be sent. Defaults to None.
-    :type _throttler: ThrottledResource or None
+    :type _throttler: ThrottledResource or TokenBucketThrottler or None
     """
 
     trigger: BaseConfig.ADDED_MESSENGERS
     reply_func: Any
     messages_per_second: int
-    _throttler: ThrottledResource | None = None
+    throttler: Literal["fixed", "token_bucket"] = "fixed"
+    burst: int = 1
+    per_chat_rate: float | None = None
+    per_chat_burst: int = 1
+    max_in_flight: int | None = None
+    max_queue_size: int | None = None
+    overflow_policy: OverflowPolicy | None = None
+    adaptive: bool = False
+    min_messages_per_second: float | None = None
+    max_retries: int = 3
+    message_cost: Callable[[Return], int] | None = None
+    file_resolver: Callable[[File], Awaitable[bytes]] | None = None
+    close_func: Callable[[], Awaitable[None]] | None = None
+    _throttler: ThrottledResource | TokenBucketThrottler | None = None
 
 
 @dataclass()
@@ -72,6 +167,19 @@ class MessengersDivision:
         trigger: BaseConfig.ADDED_MESSENGERS,
         reply_func: Any,
         messages_per_second: int,
+        throttler: Literal["fixed", "token_bucket"] = "fixed",
+        burst: int = 1,
+        per_chat_rate: float | None = None,
+        per_chat_burst: int = 1,
+        max_in_flight: int | None = None,
+        max_queue_size: int | None = None,
+        overflow_policy: OverflowPolicy | None = None,
+        adaptive: bool = False,
+        min_messages_per_second: float | None = None,
+        max_retries: int = 3,
+        message_cost: Callable[[Return], int] | None = None,
+        file_resolver: Callable[[File], Awaitable[bytes]] | None = None,
+        close_func: Callable[[], Awaitable[None]] | None = None,
     ) -> None:
         """
         Registers a new messenger to reply with, along with its trigger, reply
@@ -91,6 +199,75 @@ class MessengersDivision:
         :param messages_per_second: The limit of messages that can be sent per
             second by the messenger.
         :type messages_per_second: int
+
+        :param throttler: The type of the throttler. "fixed" waits
+            1 / `messages_per_second` seconds between messages. "token_bucket"
+            allows bursts after idle periods, serves chats in turn and can
+            limit every chat separately. Defaults to "fixed".
+        :type throttler: Literal["fixed", "token_bucket"]
+
+        :param burst: The maximum number of messages that can be sent at
+            once with the "token_bucket" throttler. Defaults to 1.
+        :type burst: int
+
+        :param per_chat_rate: The limit of messages that can be sent per
+            second to a single chat with the "token_bucket" throttler.
+            Defaults to None (no limit).
+        :type per_chat_rate: float | None
+
+        :param per_chat_burst: The maximum number of messages that can be
+            sent at once to a single chat with the "token_bucket" throttler.
+            Defaults to 1.
+        :type per_chat_burst: int
+
+        :param max_in_flight: The limit of messages that can be sent at once
+            by the messenger. Defaults to None
+            (BaseConfig.REPLY_MAX_IN_FLIGHT).
+        :type max_in_flight: int | None
+
+        :param max_queue_size: The limit of messages that can wait to be
+            sent by the messenger. Defaults to None
+            (BaseConfig.REPLY_QUEUE_SIZE).
+        :type max_queue_size: int | None
+
+        :param overflow_policy: What to do with a new message when the queue
+            is full: "block" waits for free space, "drop_oldest" drops the
+            oldest queued message, "reject" drops the new message. Defaults
+            to None (BaseConfig.REPLY_OVERFLOW_POLICY).
+        :type overflow_policy: OverflowPolicy | None
+
+        :param adaptive: Whether the rate adapts to the messenger's rate
+            limit errors. The rate is halved and the messenger is paused for
+            the requested time after every rate limit error, then the rate
+            grows back to `messages_per_second`. Rate limited messages are
+            sent again. Defaults to False.
+        :type adaptive: bool
+
+        :param min_messages_per_second: The lowest rate the adaptive rate can
+            fall to. Defaults to None (1/10 of `messages_per_second`).
+        :type min_messages_per_second: float | None
+
+        :param max_retries: The amount of times a rate limited message is
+            sent again when the rate is adaptive. Defaults to 3.
+        :type max_retries: int
+
+        :param message_cost: A function that returns the amount of
+            messenger calls `reply_func` makes to send the message, so the
+            message takes as many messages of the rate limit. For example
+            `DefaultTgReplier.message_cost`. Defaults to None (every message
+            takes 1).
+        :type message_cost: Callable[[Return], int] | None
+
+        :param file_resolver: A coroutine that downloads a file received
+            from the messenger by its reference, for clients that send
+            references instead of files (`LAZY_FILES`). For example
+            `DefaultTgReplier.resolve_file`. Defaults to None.
+        :type file_resolver: Callable[[File], Awaitable[bytes]] | None
+
+        :param close_func: A coroutine the server awaits on shutdown to
+            release the resources of the replier, for example
+            `DefaultVkReplier.close`. Defaults to None.
+        :type close_func: Callable[[], Awaitable[None]] | None
         """
 
         if self._compiled:
@@ -99,13 +276,39 @@ class MessengersDivision:
                 f"\nEnsure to add messengers before compiling"
             )
             raise ValueError(error_str)
-        if messages_per_second <= 0:
+        if (
+            messages_per_second <= 0
+            or burst < 1
+            or per_chat_burst < 1
+            or (per_chat_rate != None and per_chat_rate <= 0)
+            or max_retries < 0
+            or (
+                min_messages_per_second != None
+                and not 0 < min_messages_per_second <= messages_per_second
+            )
+        ):
             error_str = f"Can't use negative values"
             raise ValueError(error_str)
+        if throttler not in ("fixed", "token_bucket"):
+            error_str = f"Unknown throttler: '{throttler}'"
+            raise ValueError(error_str)
         new_messenger_to_reply = _Messenger(
             trigger=trigger,
             reply_func=reply_func,
             messages_per_second=messages_per_second,
+            throttler=throttler,
+            burst=burst,
+            per_chat_rate=per_chat_rate,
+            per_chat_burst=per_chat_burst,
+            max_in_flight=max_in_flight,
+            max_queue_size=max_queue_size,
+            overflow_policy=overflow_policy,
+            adaptive=adaptive,
+            min_messages_per_second=min_messages_per_second,
+            max_retries=max_retries,
+            message_cost=message_cost,
+            file_resolver=file_resolver,
+            close_func=close_func,
         )
         if new_messenger_to_reply in self._messengers_to_answer:
             error_str = f"Messenger already registered"
@@ -119,7 +322,7 @@ class MessengersDivision:
 
     def compile(self) -> None:
         """
-        Compiles the registered messengers by initializing a `ThrottledResource`
+        Compiles the registered messengers by initializing a throttler
         for each messenger with the given messages per second rate and reply
         function. This method must be called after all messengers have been
         registered and before starting the client.
@@ -132,27 +335,90 @@ class MessengersDivision:
 
         if self._compiled:
             raise ValueError(f"Messengers already compiled")
+        metrics = get_metrics(config=self.config)
+        tracer = get_tracer(config=self.config)
         for messenger in self._messengers_to_answer:
-            messenger._throttler = ThrottledResource(
-                delay=1.0 / messenger.messages_per_second,
-                func_to_throttle=messenger.reply_func,
-            )
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=(
-                        f"Added throttler for Messenger '{messenger.trigger}' "
-                        f"with rate of {messenger.messages_per_second} "
-                        f"messages per second"
-                    ),
+            reply_func = messenger.reply_func
+            if metrics != None:
+                reply_func = timed(
+                    func=reply_func,
+                    series=metrics.histogram(
+                        "pybotterfly_reply_seconds",
+                        "Time (in seconds) of sending a reply",
+                        labels=("messenger",),
+                    ).labels(messenger.trigger),
                 )
+            if tracer != None:
+                reply_func = _traced_reply(
+                    func=reply_func, tracer=tracer, messenger=messenger.trigger
+                )
+            queue_limits = {
+                "max_in_flight": (
+                    messenger.max_in_flight
+                    if messenger.max_in_flight != None
+                    else self.config.REPLY_MAX_IN_FLIGHT
+                ),
+                "max_queue_size": (
+                    messenger.max_queue_size
+                    if messenger.max_queue_size != None
+                    else self.config.REPLY_QUEUE_SIZE
+                ),
+                "overflow_policy": (
+                    messenger.overflow_policy
+                    if messenger.overflow_policy != None
+                    else self.config.REPLY_OVERFLOW_POLICY
+                ),
+                "rate_controller": (
+                    AdaptiveRateController(
+                        max_rate=messenger.messages_per_second,
+                        min_rate=messenger.min_messages_per_second,
+                        max_retries=messenger.max_retries,
+                    )
+                    if messenger.adaptive
+                    else None
+                ),
+            }
+            if messenger.throttler == "token_bucket":
+                messenger._throttler = TokenBucketThrottler(
+                    rate=messenger.messages_per_second,
+                    func_to_throttle=reply_func,
+                    burst=messenger.burst,
+                    per_recipient_rate=messenger.per_chat_rate,
+                    per_recipient_burst=messenger.per_chat_burst,
+                    **queue_limits,
+                )
+            else:
+                messenger._throttler = ThrottledResource(
+                    delay=1.0 / messenger.messages_per_second,
+                    func_to_throttle=reply_func,
+                    **queue_limits,
+                )
+            messenger._throttler.logger = self._logger
+            if metrics != None:
+                messenger._throttler.wait_time_histogram = metrics.histogram(
+                    "pybotterfly_reply_queue_wait_seconds",
+                    "Time (in seconds) a reply waits in the throttler queue",
+                    labels=("messenger",),
+                ).labels(messenger.trigger)
+            if tracer != None:
+                messenger._throttler.wait_time_callback = _wait_time_recorder(
+                    tracer=tracer, messenger=messenger.trigger
+                )
+            self._logger.emit(
+                "INFO",
+                (
+                    "Added %s%s throttler for Messenger '%s' with rate "
+                    "of %s messages per second"
+                ),
+                messenger.throttler,
+                " adaptive" if messenger.adaptive else "",
+                messenger.trigger,
+                messenger.messages_per_second,
             )
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"[SUCCESS] Messengers compiled successfully\n"),
-                starts_with=f"\n",
-            )
+        self._logger.emit(
+            "INFO",
+            "[SUCCESS] Messengers compiled successfully\n",
+            starts_with=f"\n",
         )
         if not self._compiled:
             self._compiled = True
@@ -170,20 +436,149 @@ class MessengersDivision:
         """
 
         if not self._compiled:
-            self._logger.log(
-                log=Log(level="ERROR", text=(f"Messengers are not compiled"))
-            )
+            self._logger.emit("ERROR", "Messengers are not compiled")
             return
         for existing_messenger in self._messengers_to_answer:
             if existing_messenger.trigger == return_message.user_messenger:
-                await existing_messenger._throttler.query(return_message)
+                await existing_messenger._throttler.query(
+                    return_message,
+                    cost=(
+                        existing_messenger.message_cost(return_message)
+                        if existing_messenger.message_cost != None
+                        else 1
+                    ),
+                )
                 return
-        self._logger.log(
-            log=Log(
-                level="ERROR",
-                text=(
-                    f"Needed messenger "
-                    f"'{return_message.user_messenger}' wasn't registered"
-                ),
-            )
+        self._logger.emit(
+            "ERROR",
+            "Needed messenger '%s' wasn't registered",
+            return_message.user_messenger,
         )
+
+    async def resolve_files(self, message: MessageStruct) -> None:
+        """
+        Downloads the files of the message that were sent as references,
+        concurrently, with the file resolver of the message's messenger.
+        Files that couldn't be downloaded are removed from the message and
+        reported in its `failed_files`.
+
+        :param message: The message which files should be downloaded.
+        :type message: MessageStruct
+        """
+
+        lazy_files = [
+            message_file
+            for message_file in message.files
+            if message_file.is_lazy
+        ]
+        if not lazy_files:
+            return
+        file_resolver = None
+        for existing_messenger in self._messengers_to_answer:
+            if existing_messenger.trigger == message.messenger:
+                file_resolver = existing_messenger.file_resolver
+        if file_resolver == None:
+            self._logger.emit(
+                "ERROR",
+                "File resolver of messenger '%s' wasn't registered",
+                message.messenger,
+            )
+            results = [
+                RuntimeError("file resolver wasn't registered")
+                for _ in lazy_files
+            ]
+        else:
+            results = await asyncio.gather(
+                *(file_resolver(message_file) for message_file in lazy_files),
+                return_exceptions=True,
+            )
+        failed = []
+        for message_file, result in zip(lazy_files, results):
+            if isinstance(result, Exception):
+                self._logger.emit(
+                    "ERROR", "Skipping file %r: %s", message_file, result
+                )
+                failed.append(message_file)
+                message.failed_files.append(
+                    f"{message_file.name}{message_file.ext}: {result}"
+                )
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                message_file.file_bytes = result
+        if failed:
+            # Equal references may be attached twice, so the failed files
+            # are removed by identity
+            message.files = [
+                message_file
+                for message_file in message.files
+                if not any(
+                    message_file is failed_file for failed_file in failed
+                )
+            ]
+
+    def start(self) -> None:
+        """
+        Starts the throttlers of the compiled messengers.
+
+        :return: None
+        :rtype: NoneType
+
+        :raises ValueError: If the messengers aren't compiled.
+        """
+
+        if not self._compiled:
+            raise ValueError(f"Messengers are not compiled")
+        for messenger in self._messengers_to_answer:
+            messenger._throttler.start()
+
+    async def close(self) -> None:
+        """
+        Waits for the replies that are being sent, stops the throttlers and
+        releases the resources of the repliers.
+
+        :return: None
+        :rtype: NoneType
+        """
+
+        for messenger in self._messengers_to_answer:
+            if messenger._throttler != None:
+                await messenger._throttler.close()
+            if messenger.close_func != None:
+                await messenger.close_func()
+
+    def share_rate_limits(self) -> None:
+        """
+        Makes the rate limit of every compiled messenger shared between the
+        processes of the server, so several processes together send no more
+        than `messages_per_second` messages per second. Must be called
+        before the processes are forked.
+
+        :return: None
+        :rtype: NoneType
+
+        :raises ValueError: If the messengers aren't compiled.
+        """
+
+        if not self._compiled:
+            raise ValueError(f"Messengers are not compiled")
+        for messenger in self._messengers_to_answer:
+            messenger._throttler.shared_limiter = SharedRateLimiter(
+                rate=messenger.messages_per_second,
+                burst=messenger.burst,
+            )
+
+    def get_stats(self) -> Dict[str, ThrottlerStats]:
+        """
+        Returns the queue depth, the amount of messages being sent and the
+        wait times of every compiled messenger.
+
+        :return: The stats of the throttlers by messenger trigger.
+        :rtype: Dict[str, ThrottlerStats]
+        """
+
+        return {
+            messenger.trigger: messenger._throttler.stats
+            for messenger in self._messengers_to_answer
+            if messenger._throttler != None
+        }
@@ -1,7 +1,7 @@
 from typing import List
 from dataclasses import dataclass
 from pybotterfly.base_config import BaseConfig
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
 
 
 @dataclass()
@@ -112,11 +112,7 @@ class Buttons:
         self._since_new_line += 1
         self._buttons_amount += 1
         self.buttons.append(_Button(label=label, color=color))
-        self._logger.log(
-            log=Log(
-                level="INFO", text=f"Added button: {str(self.buttons[-1])}"
-            )
-        )
+        self._logger.emit("INFO", "Added button: %s", self.buttons[-1])
 
     def add_line(self) -> None:
         """
@@ -129,12 +125,7 @@ class Buttons:
             self.buttons[-1].new_line_after = True
             self._since_new_line = 0
             self._rows += 1
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=f"Added line after: {self.buttons[-1]}",
-                )
-            )
+            self._logger.emit("INFO", "Added line after: %s", self.buttons[-1])
         else:
             raise ValueError(f"[ERROR] Can't add new line, no buttons in list")
 
@@ -146,11 +137,8 @@ class Buttons:
         :return: None
         """
         if self._buttons_amount > 0:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=f"Last button: {self.buttons[-1]} removed",
-                )
+            self._logger.emit(
+                "INFO", "Last button: %s removed", self.buttons[-1]
             )
             self.buttons.pop(-1)
             if self._since_new_line > 0:
@@ -247,11 +235,7 @@ class InlineButtons:
         self.buttons.append(
             _InlineButton(label=label, color=color, payload=payload)
         )
-        self._logger.log(
-            log=Log(
-                level="INFO", text=f"Added button: {str(self.buttons[-1])}"
-            )
-        )
+        self._logger.emit("INFO", "Added button: %s", self.buttons[-1])
 
     def add_line(self) -> None:
         """
@@ -265,12 +249,7 @@ class InlineButtons:
             self.buttons[-1].new_line_after = True
             self._since_new_line = 0
             self._rows += 1
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=f"Added line after: {self.buttons[-1]}",
-                )
-            )
+            self._logger.emit("INFO", "Added line after: %s", self.buttons[-1])
         else:
             raise ValueError(f"[ERROR] Can't add new line, no buttons in list")
 
@@ -285,11 +264,8 @@ class InlineButtons:
         :return: None
         """
         if self._buttons_amount > 0:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=f"Last button: {self.buttons[-1]} removed",
-                )
+            self._logger.emit(
+                "INFO", "Last button: %s removed", self.buttons[-1]
             )
             self.buttons.pop(-1)
             if self._since_new_line > 0:
@@ -3,6 +3,7 @@ from typing import List, Self
 from pybotterfly.bot.returns.buttons import Buttons, InlineButtons
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.struct import File
+from pybotterfly.bot.tracing import get_trace_id
 
 
 def file_validator(message: str | dict) -> List[File] | None:
@@ -38,6 +39,10 @@ class Return:
 
     :param attachments: Optional files to include with the response.
     :type attachments: List[File] | None
+
+    :param trace_id: The trace ID of the message the response answers.
+        Defaults to the trace ID of the message being processed.
+    :type trace_id: str | None
     """
 
     user_messenger_id: int
@@ -46,6 +51,7 @@ class Return:
     keyboard: Buttons | None = None
     inline_keyboard: InlineButtons | None = None
     attachments: List[File] = field(default_factory=list)
+    trace_id: str | None = field(default_factory=get_trace_id)
 
 
 @dataclass()
@@ -5,10 +5,43 @@ from pybotterfly.base_config import BaseConfig
 
 @dataclass()
 class File:
+    """
+    A data class representing a file attached to a message.
+
+    :param name: The name of the file.
+    :type name: str
+
+    :param ext: The extension of the file.
+    :type ext: BaseConfig.ALLOWED_FILE_EXTENSIONS
+
+    :param tag: The type of the file.
+    :type tag: BaseConfig.ALLOWED_FILE_TYPES
+
+    :param file_bytes: The content of the file. None if the file wasn't
+        downloaded yet. Defaults to None.
+    :type file_bytes: bytes | None
+
+    :param reference: A reference the file can be downloaded by (the URL
+        of a VK file or the `file_id` of a Telegram file). Files that have
+        a reference but no content are downloaded by the server only when
+        a `FileTrigger` matches them. Defaults to None.
+    :type reference: str | None
+    """
+
     name: str
     ext: BaseConfig.ALLOWED_FILE_EXTENSIONS
     tag: BaseConfig.ALLOWED_FILE_TYPES
-    file_bytes: bytes
+    file_bytes: bytes | None = None
+    reference: str | None = None
+
+    @property
+    def is_lazy(self) -> bool:
+        """
+        Whether the file has to be downloaded by its reference.
+
+        :rtype: bool
+        """
+        return self.file_bytes == None and self.reference != None
 
     def __repr__(self) -> str:
         return (
@@ -21,6 +54,7 @@ class File:
             "ext": self.ext,
             "tag": self.tag,
             "file_bytes": self.file_bytes,
+            "reference": self.reference,
         }
 
 
@@ -45,6 +79,14 @@ class MessageStruct:
 
     :param files: List of files attached to the message. Defaults to [].
     :type files: List[File], optional
+
+    :param failed_files: Descriptions of the attached files that couldn't
+        be downloaded (the name of the file and the reason). Defaults to [].
+    :type failed_files: List[str], optional
+
+    :param trace_id: The ID the processing of the message is traced with
+        (see `TRACING`). Defaults to None.
+    :type trace_id: str, optional
     """
 
     user_id: int
@@ -52,3 +94,5 @@ class MessageStruct:
     text: str | None = None
     payload: dict | None = None
     files: List[File] = field(default_factory=list)
+    failed_files: List[str] = field(default_factory=list)
+    trace_id: str | None = None
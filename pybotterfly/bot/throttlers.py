@@ -1,6 +1,29 @@
 import functools
 import asyncio
-from typing import Coroutine, Literal
+import multiprocessing
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Deque,
+    Dict,
+    Literal,
+    Set,
+    Tuple,
+    TypeAlias,
+)
+
+from pybotterfly.bot.logger import BaseLogger
+from pybotterfly.bot.metrics import HdrHistogram
+
+OverflowPolicy: TypeAlias = Literal["block", "drop_oldest", "reject"]
+
+RATE_LIMIT_ERROR_CODES = (6, 9, 29)
+RATE_LIMIT_HTTP_STATUS = 429
 
 
 def throttler_decorator(
@@ -53,7 +76,566 @@ def throttler_decorator(
     return decorator
 
 
-class ThrottledResource:
+def get_rate_limit_delay(err: Exception) -> float | None:
+    """
+    Checks whether the exception was raised because of the messenger's
+    rate limit.
+
+    Recognizes exceptions with a `retry_after` attribute, Telegram's
+    `RetryAfter` flood-wait errors, VK API errors with the codes 6 (too many
+    requests per second), 9 (flood control) and 29 (rate limit reached) and
+    HTTP 429 errors.
+
+    :param err: The exception raised by the throttled coroutine.
+    :type err: Exception
+
+    :return: The time (in seconds) the messenger asked to wait, 0 if the
+        exception is a rate limit error without a hint, or None if it isn't
+        a rate limit error.
+    :rtype: float | None
+    """
+    retry_after = getattr(err, "retry_after", None)
+    if retry_after == None and type(err).__name__ == "RetryAfter":
+        retry_after = getattr(err, "timeout", None)
+    if isinstance(retry_after, (int, float)):
+        return float(retry_after)
+    if getattr(err, "code", None) in RATE_LIMIT_ERROR_CODES:
+        return 0.0
+    if getattr(err, "status", None) == RATE_LIMIT_HTTP_STATUS:
+        return 0.0
+    return None
+
+
+class AdaptiveRateController:
+    """
+    Adapts the rate of a throttler to the rate limits of the messenger
+    (additive increase, multiplicative decrease).
+
+    Every rate limit error cuts the rate by `decrease_factor` and pauses
+    the throttler for the time the messenger asked to wait. Every successful
+    call raises the rate, so it grows by `increase` messages per second each
+    second until it reaches `max_rate` again.
+
+    :param max_rate: The highest rate (in messages per second) to use.
+    :type max_rate: float
+
+    :param min_rate: The lowest rate (in messages per second) to use.
+        Defaults to 1/10 of `max_rate`.
+    :type min_rate: float | None
+
+    :param increase: The amount of messages per second added to the rate
+        every second without rate limit errors. Defaults to 1.
+    :type increase: float
+
+    :param decrease_factor: The factor the rate is multiplied by after a
+        rate limit error. Defaults to 0.5.
+    :type decrease_factor: float
+
+    :param max_retries: The amount of times a rate limited call is retried.
+        Defaults to 3.
+    :type max_retries: int
+
+    :param get_delay: The function that detects rate limit errors. Defaults
+        to get_rate_limit_delay.
+    :type get_delay: Callable[[Exception], float | None]
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        min_rate: float | None = None,
+        increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        max_retries: int = 3,
+        get_delay: Callable[[Exception], float | None] = get_rate_limit_delay,
+    ) -> None:
+        min_rate = min_rate if min_rate != None else max_rate / 10
+        if min_rate <= 0 or max_rate < min_rate or increase <= 0:
+            raise ValueError("Can't use negative values")
+        if not 0 < decrease_factor < 1:
+            raise ValueError("'decrease_factor' should be between 0 and 1")
+        if max_retries < 0:
+            raise ValueError("Can't use negative values")
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.rate = max_rate
+        self._get_delay = get_delay
+        self._paused_until = 0.0
+
+    def get_delay(self, err: Exception) -> float | None:
+        """
+        Checks whether the exception is a rate limit error.
+
+        :param err: The exception raised by the throttled coroutine.
+        :type err: Exception
+
+        :return: The time (in seconds) to wait, or None if the exception
+            isn't a rate limit error.
+        :rtype: float | None
+        """
+        return self._get_delay(err)
+
+    def pause_time(self, now: float) -> float:
+        """
+        Returns the time (in seconds) left until the messenger can be
+        called again.
+
+        :param now: The current time of the monotonic clock.
+        :type now: float
+
+        :rtype: float
+        """
+        return max(0.0, self._paused_until - now)
+
+    def on_success(self) -> None:
+        """
+        Raises the rate after a successful call.
+        """
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_rate_limited(self, retry_after: float) -> None:
+        """
+        Cuts the rate and pauses the calls after a rate limit error.
+
+        :param retry_after: The time (in seconds) the messenger asked to
+            wait.
+        :type retry_after: float
+        """
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + retry_after
+        )
+
+
+class SharedRateLimiter:
+    """
+    A token bucket kept in shared memory, so the rate limit is shared by
+    all of the processes forked after it was created.
+
+    :param rate: The maximum average amount of calls per second of all of
+        the processes.
+    :type rate: float
+
+    :param burst: The maximum amount of calls that can be made at once.
+        Defaults to 1.
+    :type burst: int
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("Can't use negative values")
+        self.rate = rate
+        self.burst = burst
+        context = multiprocessing.get_context("fork")
+        self._lock = context.Lock()
+        self._state = context.RawArray("d", [float(burst), time.monotonic()])
+
+    def try_acquire(self, cost: int = 1) -> float:
+        """
+        Takes `cost` tokens if a token is available. The bucket goes into
+        debt if there are fewer tokens than the cost.
+
+        :param cost: The amount of tokens to take. Defaults to 1.
+        :type cost: int
+
+        :return: 0 if the tokens were taken, otherwise the time (in seconds)
+            until a token is available.
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(
+                self.burst,
+                self._state[0] + (now - self._state[1]) * self.rate,
+            )
+            delay = 0.0
+            if tokens >= 1:
+                tokens -= cost
+            else:
+                delay = (1 - tokens) / self.rate
+            self._state[0], self._state[1] = tokens, now
+        return delay
+
+    async def acquire(self, cost: int = 1) -> None:
+        """
+        Waits until a token is available and takes `cost` tokens.
+
+        :param cost: The amount of tokens to take. Defaults to 1.
+        :type cost: int
+        """
+        while True:
+            delay = self.try_acquire(cost=cost)
+            if delay == 0:
+                return
+            await asyncio.sleep(delay)
+
+
+class QueueOverflowError(RuntimeError):
+    """
+    Raised when a throttler's queue is full and the request was rejected or
+    dropped in favour of a newer one.
+    """
+
+
+@dataclass()
+class ThrottlerStats:
+    """
+    A snapshot of the state of a throttler.
+
+    :param queue_depth: The amount of queued requests.
+    :type queue_depth: int
+
+    :param in_flight: The amount of requests being executed.
+    :type in_flight: int
+
+    :param processed: The amount of requests passed to the throttled
+        coroutine.
+    :type processed: int
+
+    :param dropped: The amount of requests dropped by the "drop_oldest"
+        overflow policy.
+    :type dropped: int
+
+    :param rejected: The amount of requests rejected by the "reject"
+        overflow policy.
+    :type rejected: int
+
+    :param avg_wait_time: The average time (in seconds) requests spent in
+        the queue.
+    :type avg_wait_time: float
+
+    :param max_wait_time: The longest time (in seconds) a request spent in
+        the queue.
+    :type max_wait_time: float
+
+    :param retried: The amount of rate limited requests that were queued
+        again.
+    :type retried: int
+
+    :param rate: The current rate (in requests per second) of the adaptive
+        rate controller, or None if it isn't used.
+    :type rate: float | None
+    """
+
+    queue_depth: int
+    in_flight: int
+    processed: int
+    dropped: int
+    rejected: int
+    avg_wait_time: float
+    max_wait_time: float
+    retried: int = 0
+    rate: float | None = None
+
+
+@dataclass()
+class _QueuedRequest:
+    future: asyncio.Future
+    params: Any
+    queued_at: float
+    attempt: int = 0
+    holds_slot: bool = True
+    cost: int = 1
+
+
+class _BaseThrottler(ABC):
+    """
+    The base class of the throttlers. Limits the amount of queued and
+    executed requests and collects the stats of the queue.
+
+    :param func_to_throttle: The coroutine function that needs to be throttled.
+    :type func_to_throttle: Coroutine
+
+    :param max_in_flight: The maximum amount of requests executed at once.
+        The queue isn't read while the limit is reached. Defaults to None
+        (no limit).
+    :type max_in_flight: int | None
+
+    :param max_queue_size: The maximum amount of queued requests. Defaults
+        to None (no limit).
+    :type max_queue_size: int | None
+
+    :param overflow_policy: What to do with a new request when the queue is
+        full: "block" waits for free space, "drop_oldest" fails the oldest
+        queued request with QueueOverflowError, "reject" raises
+        QueueOverflowError. Defaults to "block".
+    :type overflow_policy: OverflowPolicy
+
+    :param rate_controller: The controller that adapts the rate to the
+        messenger's rate limit errors and retries rate limited requests.
+        Defaults to None.
+    :type rate_controller: AdaptiveRateController | None
+
+    :ivar shared_limiter: A rate limit shared with the other processes of
+        the server. Every request waits for its token besides the limits of
+        the throttler. Defaults to None.
+    :vartype shared_limiter: SharedRateLimiter | None
+
+    :ivar wait_time_histogram: A histogram the time requests spend in the
+        queue is recorded to. Defaults to None.
+    :vartype wait_time_histogram: HdrHistogram | None
+
+    :ivar wait_time_callback: A function called with the parameters of
+        every request and the time it spent in the queue. Defaults to None.
+    :vartype wait_time_callback: Callable[[Any, float], None] | None
+
+    :ivar logger: The logger unexpected errors of the executed requests
+        are logged with. Defaults to None.
+    :vartype logger: BaseLogger | None
+    """
+
+    def __init__(
+        self,
+        func_to_throttle: Coroutine,
+        max_in_flight: int | None = None,
+        max_queue_size: int | None = None,
+        overflow_policy: OverflowPolicy = "block",
+        rate_controller: AdaptiveRateController | None = None,
+    ) -> None:
+        if (max_in_flight != None and max_in_flight <= 0) or (
+            max_queue_size != None and max_queue_size <= 0
+        ):
+            raise ValueError("Can't use negative values")
+        if overflow_policy not in ("block", "drop_oldest", "reject"):
+            raise ValueError(f"Unknown overflow policy: '{overflow_policy}'")
+        self._func = func_to_throttle
+        self._max_in_flight = max_in_flight
+        self._max_queue_size = max_queue_size
+        self._overflow_policy = overflow_policy
+        self._rate_controller = rate_controller
+        self.shared_limiter: SharedRateLimiter | None = None
+        self.wait_time_histogram: HdrHistogram | None = None
+        self.wait_time_callback: Callable[[Any, float], None] | None = None
+        self.logger: BaseLogger | None = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._queue_slots: asyncio.Semaphore | None = None
+        self._in_flight_slots: asyncio.Semaphore | None = None
+        self._queue_depth = 0
+        self._in_flight = 0
+        self._processed = 0
+        self._dropped = 0
+        self._rejected = 0
+        self._retried = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._task = None
+
+    @property
+    def stats(self) -> ThrottlerStats:
+        """
+        The current stats of the throttler.
+        """
+        return ThrottlerStats(
+            queue_depth=self._queue_depth,
+            in_flight=self._in_flight,
+            processed=self._processed,
+            dropped=self._dropped,
+            rejected=self._rejected,
+            avg_wait_time=(
+                self._total_wait_time / self._processed
+                if self._processed
+                else 0.0
+            ),
+            max_wait_time=self._max_wait_time,
+            retried=self._retried,
+            rate=(
+                self._rate_controller.rate
+                if self._rate_controller != None
+                else None
+            ),
+        )
+
+    def start(self):
+        """
+        Starts the work loop task.
+        """
+        self._task = asyncio.create_task(self._work_loop())
+
+    def stop(self):
+        """
+        Stops the work loop task.
+        """
+        self._task.cancel()
+        self._task = None
+
+    async def close(self) -> None:
+        """
+        Stops the work loop task and waits for the requests that are being
+        executed.
+        """
+        if self._task != None:
+            self.stop()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def query(self, params, cost: int = 1):
+        """
+        Queries the throttled resource with the given parameters.
+
+        :param params: The parameters to pass to the throttled function.
+        :type params: Any
+
+        :param cost: The share of the rate limit the query takes, for
+            example the amount of API calls it makes. Defaults to 1.
+        :type cost: int
+
+        :returns: The result of the throttled function.
+        :rtype: Any
+
+        :raises QueueOverflowError: If the queue is full and the overflow
+            policy is "reject", or if the request was dropped by the
+            "drop_oldest" policy.
+        """
+        if cost < 1:
+            raise ValueError("Can't use negative values")
+        await self._reserve_queue_slot()
+        future = asyncio.get_running_loop().create_future()
+        self._queue_depth += 1
+        self._put(
+            _QueuedRequest(
+                future=future,
+                params=params,
+                queued_at=time.monotonic(),
+                cost=cost,
+            )
+        )
+        return await future
+
+    async def _reserve_queue_slot(self) -> None:
+        if self._max_queue_size == None:
+            return
+        if self._queue_slots is None:
+            self._queue_slots = asyncio.Semaphore(self._max_queue_size)
+        if self._queue_slots.locked() and self._overflow_policy == "reject":
+            self._rejected += 1
+            raise QueueOverflowError("Throttler queue is full")
+        while (
+            self._queue_slots.locked()
+            and self._overflow_policy == "drop_oldest"
+        ):
+            request = self._pop_oldest()
+            if request == None:
+                break
+            self._release_queue_slot(request=request)
+            self._dropped += 1
+            if not request.future.done():
+                request.future.set_exception(
+                    QueueOverflowError("Dropped from the full throttler queue")
+                )
+        await self._queue_slots.acquire()
+
+    def _release_queue_slot(self, request: _QueuedRequest) -> None:
+        self._queue_depth -= 1
+        if request.holds_slot and self._queue_slots != None:
+            self._queue_slots.release()
+
+    async def _wait_for_rate_controller(self) -> None:
+        if self._rate_controller == None:
+            return
+        pause_time = self._rate_controller.pause_time(now=time.monotonic())
+        if pause_time > 0:
+            await asyncio.sleep(pause_time)
+
+    async def _dispatch(self, request: _QueuedRequest) -> None:
+        """
+        Passes the dequeued request to the throttled coroutine, waiting
+        while the maximum amount of requests is executed.
+        """
+        self._release_queue_slot(request=request)
+        if request.future.done():
+            return
+        if self._max_in_flight != None:
+            if self._in_flight_slots is None:
+                self._in_flight_slots = asyncio.Semaphore(self._max_in_flight)
+            await self._in_flight_slots.acquire()
+        if self.shared_limiter != None:
+            await self.shared_limiter.acquire(cost=request.cost)
+        if request.attempt == 0:
+            wait_time = time.monotonic() - request.queued_at
+            self._processed += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            if self.wait_time_histogram != None:
+                self.wait_time_histogram.observe(wait_time)
+            if self.wait_time_callback != None:
+                self.wait_time_callback(request.params, wait_time)
+        self._in_flight += 1
+        task = asyncio.create_task(self._single_response(request=request))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_response_done)
+
+    def _on_response_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        err = task.exception()
+        if err != None and self.logger != None:
+            self.logger.emit(
+                "ERROR", "Throttled request failed unexpectedly: %r", err
+            )
+
+    async def _single_response(self, request: _QueuedRequest):
+        """
+        Processes a single response received from the queue. Rate limited
+        requests are queued again if the rate controller allows it.
+
+        Args:
+            request: The queued request with the parameters to pass to the
+                throttled function and the future object to set with its
+                result.
+        """
+        future = request.future
+        try:
+            result = await self._func(request.params)
+        except Exception as err:
+            if not self._retry(request=request, err=err) and not future.done():
+                future.set_exception(err)
+        else:
+            if self._rate_controller != None:
+                self._rate_controller.on_success()
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            if self._in_flight_slots != None:
+                self._in_flight_slots.release()
+
+    def _retry(self, request: _QueuedRequest, err: Exception) -> bool:
+        if self._rate_controller == None:
+            return False
+        retry_after = self._rate_controller.get_delay(err)
+        if retry_after == None:
+            return False
+        self._rate_controller.on_rate_limited(retry_after=retry_after)
+        if (
+            request.attempt >= self._rate_controller.max_retries
+            or request.future.done()
+        ):
+            return False
+        request.attempt += 1
+        request.holds_slot = False
+        self._retried += 1
+        self._queue_depth += 1
+        self._put(request=request, first=True)
+        return True
+
+    @abstractmethod
+    def _put(self, request: _QueuedRequest, first: bool = False) -> None:
+        pass
+
+    @abstractmethod
+    def _pop_oldest(self) -> _QueuedRequest | None:
+        pass
+
+    @abstractmethod
+    async def _work_loop(self):
+        pass
+
+
+class ThrottledResource(_BaseThrottler):
     """
     A class for throttling the usage of a resource.
 
@@ -67,6 +649,23 @@ class ThrottledResource:
     :param func_to_throttle: The coroutine function that needs to be throttled.
     :type func_to_throttle: Coroutine
 
+    :param max_in_flight: The maximum amount of executions at once.
+        Defaults to None (no limit).
+    :type max_in_flight: int | None
+
+    :param max_queue_size: The maximum amount of queued requests. Defaults
+        to None (no limit).
+    :type max_queue_size: int | None
+
+    :param overflow_policy: What to do with a new request when the queue is
+        full. Defaults to "block".
+    :type overflow_policy: OverflowPolicy
+
+    :param rate_controller: The controller that adapts the delay to the
+        messenger's rate limit errors. The delay becomes 1 / current rate
+        of the controller. Defaults to None.
+    :type rate_controller: AdaptiveRateController | None
+
     :ivar _delay: The delay between executions of the coroutine.
     :ivar _func: The coroutine function to throttle.
     :ivar _queue: A queue that stores the parameters for the throttled coroutine.
@@ -82,13 +681,23 @@ class ThrottledResource:
         stop(self): Stops the work loop task.
         query(self, params): Adds a new request to the queue and returns
             the result.
+        stats(self): Returns the current queue depth, in-flight requests and
+            wait times.
         _single_response(self, params, future): Processes a single response
             received from the queue.
         _work_loop(self): Executes a loop that waits for incoming requests
             from the queue and passes them to _single_response().
     """
 
-    def __init__(self, delay: float, func_to_throttle: Coroutine):
+    def __init__(
+        self,
+        delay: float,
+        func_to_throttle: Coroutine,
+        max_in_flight: int | None = None,
+        max_queue_size: int | None = None,
+        overflow_policy: OverflowPolicy = "block",
+        rate_controller: AdaptiveRateController | None = None,
+    ):
         """
         Initialises a ThrottledResource instance.
 
@@ -101,62 +710,318 @@ class ThrottledResource:
         :returns: None
         :rtype: NoneType
         """
+        super().__init__(
+            func_to_throttle=func_to_throttle,
+            max_in_flight=max_in_flight,
+            max_queue_size=max_queue_size,
+            overflow_policy=overflow_policy,
+            rate_controller=rate_controller,
+        )
         self._delay = delay + 0.0001
-        self._func = func_to_throttle
-        self._queue = asyncio.Queue()
-        self._task = None
+        self._queue: Deque[_QueuedRequest] = deque()
+        self._not_empty: asyncio.Event | None = None
 
-    def start(self):
+    def _get_not_empty(self) -> asyncio.Event:
+        if self._not_empty is None:
+            self._not_empty = asyncio.Event()
+        return self._not_empty
+
+    def _put(self, request: _QueuedRequest, first: bool = False) -> None:
+        if first:
+            self._queue.appendleft(request)
+        else:
+            self._queue.append(request)
+        self._get_not_empty().set()
+
+    def _pop_oldest(self) -> _QueuedRequest | None:
+        if not self._queue:
+            return None
+        return self._queue.popleft()
+
+    async def _work_loop(self):
         """
-        Starts the work loop task.
+        Executes a loop that waits for incoming requests from the queue
+        and passes them to _single_response().
         """
-        self._task = asyncio.create_task(self._work_loop())
+        not_empty = self._get_not_empty()
+        while True:
+            if not self._queue:
+                not_empty.clear()
+                await not_empty.wait()
+                continue
+            await self._wait_for_rate_controller()
+            if not self._queue:
+                continue
+            request = self._queue.popleft()
+            await self._dispatch(request)
+            await asyncio.sleep(self._get_delay() * request.cost)
 
-    def stop(self):
-        """
-        Stops the work loop task.
+    def _get_delay(self) -> float:
+        if self._rate_controller == None:
+            return self._delay
+        return max(self._delay, 1.0 / self._rate_controller.rate)
+
+
+class _TokenBucket:
+    """
+    A token bucket that refills with a constant rate up to its capacity.
+
+    :param rate: The amount of tokens added per second.
+    :type rate: float
+
+    :param burst: The capacity of the bucket.
+    :type burst: int
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
         """
-        self._task.cancel()
-        self._task = None
+        Refills the bucket and returns the time (in seconds) until a token
+        is available.
+
+        :param now: The current time of the monotonic clock.
+        :type now: float
 
-    async def query(self, params):
+        :returns: 0 if a token is available, otherwise the time to wait.
+        :rtype: float
         """
-        Queries the throttled resource with the given parameters.
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
 
-        :param params: The parameters to pass to the throttled function.
-        :type params: Any
+    def take(self, amount: int = 1) -> None:
+        """
+        Takes tokens from the bucket. The bucket goes into debt if there
+        are fewer tokens than the amount.
 
-        :returns: The result of the throttled function.
-        :rtype: Any
+        :param amount: The amount of tokens to take. Defaults to 1.
+        :type amount: int
         """
-        future = asyncio.Future()
-        await self._queue.put((future, params))
-        result = await future
-        return result
+        self.tokens -= amount
 
-    async def _single_response(self, params, future):
+    def is_full(self, now: float) -> bool:
         """
-        Processes a single response received from the queue.
+        Checks whether the bucket would be full at the given time.
 
-        Args:
-            params: The parameters to pass to the throttled function.
-            future: The future object to set with the result of the throttled
-                function call.
+        :param now: The current time of the monotonic clock.
+        :type now: float
+
+        :rtype: bool
         """
-        try:
-            result = await self._func(params)
-        except Exception as err:
-            future.set_exception(err)
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class TokenBucketThrottler(_BaseThrottler):
+    """
+    A throttler that limits the rate of a coroutine with token buckets.
+
+    Unlike ThrottledResource, idle time is not wasted: up to `burst` calls
+    can be made at once after a pause. Calls are grouped by recipient and
+    recipients are served in round-robin order, so a single busy recipient
+    can't delay everyone else. Every recipient can additionally be limited
+    with its own bucket.
+
+    :param rate: The maximum average amount of calls per second.
+    :type rate: float
+
+    :param func_to_throttle: The coroutine function that needs to be throttled.
+    :type func_to_throttle: Coroutine
+
+    :param burst: The maximum amount of calls that can be made at once.
+        Defaults to 1.
+    :type burst: int
+
+    :param per_recipient_rate: The maximum average amount of calls per
+        second for a single recipient. Defaults to None (no limit).
+    :type per_recipient_rate: float | None
+
+    :param per_recipient_burst: The maximum amount of calls that can be made
+        at once for a single recipient. Defaults to 1.
+    :type per_recipient_burst: int
+
+    :param max_in_flight: The maximum amount of calls executed at once.
+        Defaults to None (no limit).
+    :type max_in_flight: int | None
+
+    :param max_queue_size: The maximum amount of queued calls of all of the
+        recipients. Defaults to None (no limit).
+    :type max_queue_size: int | None
+
+    :param overflow_policy: What to do with a new call when the queue is
+        full. Defaults to "block".
+    :type overflow_policy: OverflowPolicy
+
+    :param rate_controller: The controller that adapts the rate of the
+        global bucket to the messenger's rate limit errors. Defaults to None.
+    :type rate_controller: AdaptiveRateController | None
+
+    :ivar _bucket: The global token bucket.
+    :ivar _buckets: The token buckets of the recipients.
+    :ivar _queues: The pending calls grouped by recipient.
+    :ivar _ready: The recipients with pending calls in round-robin order.
+    :ivar _task: The asyncio task that runs the throttled coroutine.
+
+    Methods:
+        start(self): Starts the work loop task.
+        stop(self): Stops the work loop task.
+        query(self, params): Adds a new request to the recipient's queue and
+            returns the result.
+        stats(self): Returns the current queue depth, in-flight requests and
+            wait times.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        func_to_throttle: Coroutine,
+        burst: int = 1,
+        per_recipient_rate: float | None = None,
+        per_recipient_burst: int = 1,
+        max_in_flight: int | None = None,
+        max_queue_size: int | None = None,
+        overflow_policy: OverflowPolicy = "block",
+        rate_controller: AdaptiveRateController | None = None,
+    ) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("Can't use negative values")
+        if per_recipient_rate != None and (
+            per_recipient_rate <= 0 or per_recipient_burst < 1
+        ):
+            raise ValueError("Can't use negative values")
+        super().__init__(
+            func_to_throttle=func_to_throttle,
+            max_in_flight=max_in_flight,
+            max_queue_size=max_queue_size,
+            overflow_policy=overflow_policy,
+            rate_controller=rate_controller,
+        )
+        self._bucket = _TokenBucket(rate=rate, burst=burst)
+        self._per_recipient_rate = per_recipient_rate
+        self._per_recipient_burst = per_recipient_burst
+        self._buckets: Dict[Any, _TokenBucket] = {}
+        self._queues: Dict[Any, Deque[_QueuedRequest]] = {}
+        self._ready: Deque[Any] = deque()
+        self._wakeup: asyncio.Event | None = None
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _get_recipient(self, params) -> Any:
+        return getattr(params, "user_messenger_id", None)
+
+    def _put(self, request: _QueuedRequest, first: bool = False) -> None:
+        recipient = self._get_recipient(request.params)
+        queue = self._queues.get(recipient)
+        if queue is None:
+            queue = self._queues[recipient] = deque()
+            if first:
+                self._ready.appendleft(recipient)
+            else:
+                self._ready.append(recipient)
+        if first:
+            queue.appendleft(request)
         else:
-            future.set_result(result)
+            queue.append(request)
+        self._get_wakeup().set()
+
+    def _pop_oldest(self) -> _QueuedRequest | None:
+        if not self._queues:
+            return None
+        recipient = min(
+            self._queues, key=lambda key: self._queues[key][0].queued_at
+        )
+        return self._pop(recipient=recipient)
+
+    def _pop(self, recipient: Any) -> _QueuedRequest:
+        queue = self._queues[recipient]
+        request = queue.popleft()
+        if not queue:
+            del self._queues[recipient]
+            self._ready.remove(recipient)
+        return request
+
+    def _get_recipient_bucket(self, recipient: Any) -> _TokenBucket | None:
+        if self._per_recipient_rate == None:
+            return None
+        bucket = self._buckets.get(recipient)
+        if bucket is None:
+            bucket = self._buckets[recipient] = _TokenBucket(
+                rate=self._per_recipient_rate,
+                burst=self._per_recipient_burst,
+            )
+        return bucket
+
+    def _prune_buckets(self, now: float) -> None:
+        for recipient in [
+            recipient
+            for recipient, bucket in self._buckets.items()
+            if recipient not in self._queues and bucket.is_full(now)
+        ]:
+            del self._buckets[recipient]
+
+    async def _wait(self, timeout: float | None = None) -> None:
+        wakeup = self._get_wakeup()
+        wakeup.clear()
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _next_recipient(self, now: float) -> Tuple[Any, float]:
+        min_delay = None
+        for _ in range(len(self._ready)):
+            recipient = self._ready[0]
+            bucket = self._get_recipient_bucket(recipient)
+            delay = bucket.delay(now) if bucket != None else 0.0
+            if delay == 0:
+                return recipient, 0.0
+            self._ready.rotate(-1)
+            min_delay = delay if min_delay == None else min(min_delay, delay)
+        return None, min_delay
 
     async def _work_loop(self):
         """
-        Executes a loop that waits for incoming requests from the queue
-        and passes them to _single_response().
+        Waits for the global and the recipients' buckets and passes the
+        pending requests to _single_response() in round-robin order.
         """
         while True:
-            future, params = await self._queue.get()
-            asyncio.create_task(self._single_response(params, future))
-            self._queue.task_done()
-            await asyncio.sleep(self._delay)
+            if not self._ready:
+                self._prune_buckets(now=time.monotonic())
+                await self._wait()
+                continue
+            await self._wait_for_rate_controller()
+            if not self._ready:
+                continue
+            if self._rate_controller != None:
+                self._bucket.rate = self._rate_controller.rate
+            now = time.monotonic()
+            delay = self._bucket.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            recipient, delay = self._next_recipient(now)
+            if delay > 0:
+                await self._wait(timeout=delay)
+                continue
+            request = self._pop(recipient=recipient)
+            if recipient in self._queues:
+                self._ready.rotate(-1)
+            if request.future.done():
+                self._release_queue_slot(request=request)
+                continue
+            self._bucket.take(amount=request.cost)
+            bucket = self._get_recipient_bucket(recipient)
+            if bucket != None:
+                bucket.take(amount=request.cost)
+            await self._dispatch(request)
@@ -0,0 +1,369 @@
+import atexit
+import functools
+import json
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+)
+
+from pybotterfly.base_config import BaseConfig
+
+MEMORY_MAX_SPANS = 10000
+
+_trace_id: ContextVar[str | None] = ContextVar(
+    "pybotterfly_trace_id", default=None
+)
+
+
+def new_trace_id() -> str:
+    """
+    Returns a new random trace ID.
+
+    :rtype: str
+    """
+    return uuid.uuid4().hex
+
+
+def get_trace_id() -> str | None:
+    """
+    Returns the trace ID of the message being processed in the current
+    context, or None if the message isn't traced.
+
+    :rtype: str | None
+    """
+    return _trace_id.get()
+
+
+@contextmanager
+def use_trace_id(trace_id: str | None) -> Iterator[None]:
+    """
+    Sets the trace ID of the current context. Returns created in the
+    context (by the page coroutine too) get the trace ID.
+
+    :param trace_id: The trace ID of the message.
+    :type trace_id: str | None
+    """
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+@dataclass()
+class Span:
+    """
+    A timed step of processing a message.
+
+    :param trace_id: The trace ID of the message.
+    :type trace_id: str
+
+    :param name: The name of the step.
+    :type name: str
+
+    :param start: The start time (a Unix timestamp in seconds).
+    :type start: float
+
+    :param end: The end time (a Unix timestamp in seconds).
+    :type end: float
+
+    :param attributes: The details of the step (the messenger, the stage,
+        the error raised, etc.). Defaults to {}.
+    :type attributes: Dict[str, Any]
+    """
+
+    trace_id: str
+    name: str
+    start: float
+    end: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """
+        The duration (in seconds) of the step.
+
+        :rtype: float
+        """
+        return self.end - self.start
+
+
+class BaseSpanExporter(ABC):
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InMemorySpanExporter(BaseSpanExporter):
+    """
+    Keeps the latest spans in memory.
+
+    :param max_spans: The maximum amount of spans kept, the oldest ones are
+        dropped. Defaults to MEMORY_MAX_SPANS.
+    :type max_spans: int
+    """
+
+    def __init__(self, max_spans: int = MEMORY_MAX_SPANS) -> None:
+        if max_spans <= 0:
+            raise ValueError("Can't use negative values")
+        self._spans: Deque[Span] = deque(maxlen=max_spans)
+
+    def export(self, span: Span) -> None:
+        self._spans.append(span)
+
+    @property
+    def spans(self) -> List[Span]:
+        """
+        The kept spans in the order they ended.
+
+        :rtype: List[Span]
+        """
+        return list(self._spans)
+
+    def get_trace(self, trace_id: str) -> List[Span]:
+        """
+        Returns the spans of a message in the order they started.
+
+        :param trace_id: The trace ID of the message.
+        :type trace_id: str
+
+        :rtype: List[Span]
+        """
+        return sorted(
+            (span for span in self._spans if span.trace_id == trace_id),
+            key=lambda span: span.start,
+        )
+
+    def clear(self) -> None:
+        """
+        Drops the kept spans.
+        """
+        self._spans.clear()
+
+
+class FileSpanExporter(BaseSpanExporter):
+    """
+    Appends the spans to a file as JSON lines. The file is buffered and is
+    flushed when the exporter is closed (at the exit of the interpreter).
+
+    :param path: The path of the file.
+    :type path: str
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "a", encoding="utf-8")
+        atexit.register(self.close)
+
+    def export(self, span: Span) -> None:
+        if self._file.closed:
+            return
+        self._file.write(
+            json.dumps(
+                {
+                    "trace_id": span.trace_id,
+                    "name": span.name,
+                    "start": span.start,
+                    "end": span.end,
+                    "duration": span.duration,
+                    "attributes": span.attributes,
+                },
+                ensure_ascii=False,
+                default=repr,
+            )
+            + "\n"
+        )
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+
+class Tracer:
+    """
+    Records the spans of traced messages to an exporter. Spans are recorded
+    only for messages with a trace ID.
+
+    :param exporter: The exporter to send the spans to. Defaults to None
+        (an InMemorySpanExporter).
+    :type exporter: BaseSpanExporter | None
+
+    :ivar exporter: The exporter the spans are sent to. Can be replaced at
+        any time.
+    :vartype exporter: BaseSpanExporter
+    """
+
+    def __init__(self, exporter: BaseSpanExporter | None = None) -> None:
+        self.exporter = (
+            exporter if exporter != None else InMemorySpanExporter()
+        )
+        # Durations are measured with perf_counter and converted to Unix
+        # timestamps with a fixed offset
+        self._epoch_offset = time.time() - time.perf_counter()
+
+    def record(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        trace_id: str | None = None,
+        **attributes,
+    ) -> None:
+        """
+        Records a span.
+
+        :param name: The name of the step.
+        :type name: str
+
+        :param start: The start time (`time.perf_counter()`).
+        :type start: float
+
+        :param end: The end time (`time.perf_counter()`).
+        :type end: float
+
+        :param trace_id: The trace ID of the message. Defaults to None (the
+            trace ID of the current context).
+        :type trace_id: str | None
+
+        :param attributes: The details of the step.
+        """
+        trace_id = trace_id if trace_id != None else _trace_id.get()
+        if trace_id == None:
+            return
+        self.exporter.export(
+            Span(
+                trace_id=trace_id,
+                name=name,
+                start=start + self._epoch_offset,
+                end=end + self._epoch_offset,
+                attributes=attributes,
+            )
+        )
+
+    @contextmanager
+    def span(
+        self, name: str, trace_id: str | None = None, **attributes
+    ) -> Iterator[None]:
+        """
+        Records a span of the code run in the context. An exception raised
+        in the context is recorded in the `error` attribute.
+
+        :param name: The name of the step.
+        :type name: str
+
+        :param trace_id: The trace ID of the message. Defaults to None (the
+            trace ID of the current context).
+        :type trace_id: str | None
+
+        :param attributes: The details of the step.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as err:
+            attributes["error"] = repr(err)
+            raise
+        finally:
+            self.record(
+                name,
+                start=start,
+                end=time.perf_counter(),
+                trace_id=trace_id,
+                **attributes,
+            )
+
+
+_default_exporter = InMemorySpanExporter()
+tracer = Tracer(exporter=_default_exporter)
+
+
+def get_tracer(config: BaseConfig = BaseConfig) -> Tracer | None:
+    """
+    Returns the tracer the framework records its spans with, or None if
+    `TRACING` isn't set, so the components skip the measurements. Spans are
+    exported to `TRACE_FILE` if it's set, otherwise they are kept in memory
+    until `tracer.exporter` is replaced.
+
+    :param config: An instance of the BaseConfig class.
+    :type config: BaseConfig
+
+    :rtype: Tracer | None
+    """
+    if not config.TRACING:
+        return None
+    if config.TRACE_FILE != None and tracer.exporter is _default_exporter:
+        tracer.exporter = FileSpanExporter(path=config.TRACE_FILE)
+    return tracer
+
+
+def trace_span(
+    tracer: Tracer | None,
+    name: str,
+    trace_id: str | None = None,
+    **attributes,
+) -> ContextManager:
+    """
+    Returns `tracer.span`, or a context that does nothing if tracing is
+    off.
+
+    :param tracer: The tracer or None.
+    :type tracer: Tracer | None
+
+    :param name: The name of the step.
+    :type name: str
+
+    :param trace_id: The trace ID of the message. Defaults to None (the
+        trace ID of the current context).
+    :type trace_id: str | None
+
+    :param attributes: The details of the step.
+
+    :rtype: ContextManager
+    """
+    if tracer == None:
+        return nullcontext()
+    return tracer.span(name, trace_id=trace_id, **attributes)
+
+
+def traced(
+    func: Callable[..., Awaitable], tracer: Tracer, name: str, **attributes
+) -> Callable[..., Awaitable]:
+    """
+    Wraps the coroutine function, so every call is recorded as a span of
+    the traced message of the current context.
+
+    :param func: The coroutine function.
+    :type func: Callable[..., Awaitable]
+
+    :param tracer: The tracer to record the spans with.
+    :type tracer: Tracer
+
+    :param name: The name of the spans.
+    :type name: str
+
+    :param attributes: The details of the spans.
+
+    :rtype: Callable[..., Awaitable]
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with tracer.span(name, **attributes):
+            return await func(*args, **kwargs)
+
+    return wrapper
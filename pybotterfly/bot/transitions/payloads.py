@@ -1,10 +1,10 @@
 import inspect
 from dataclasses import dataclass, field
 from collections import Counter
-from typing import Coroutine, List, Tuple, Union, Dict, Any
+from typing import Coroutine, List, Tuple, Union, Dict, Any, FrozenSet
 
 from pybotterfly.base_config import BaseConfig
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
 
 
 @dataclass()
@@ -165,6 +165,64 @@ class Classification:
         return self_dict
 
 
+@dataclass()
+class _PayloadsGroup:
+    """
+    Payloads of a classification with the same set of keys and the same
+    trigger keys, indexed by the values of their triggers.
+
+    :param trigger_keys: Short keys of the triggers in the order of the
+        values in the index.
+    :type trigger_keys: Tuple[str, ...]
+
+    :param payloads: Payloads indexed by the short values of their
+        triggers.
+    :type payloads: Dict[Tuple[str, ...], Payload]
+    """
+
+    trigger_keys: Tuple[str, ...]
+    payloads: Dict[Tuple[str, ...], Payload] = field(default_factory=dict)
+
+
+@dataclass()
+class _PayloadTemplate:
+    """
+    The precompiled form of a payload dictionary.
+
+    :param pairs: Constant key-value pairs of the main value and the
+        triggers.
+    :type pairs: Tuple[Tuple[str, str], ...]
+
+    :param data_keys: Pairs of the output key and the key of the entry
+        dictionary the data is taken from.
+    :type data_keys: Tuple[Tuple[str, str], ...]
+    """
+
+    pairs: Tuple[Tuple[str, str], ...]
+    data_keys: Tuple[Tuple[str, str], ...]
+
+    def fill(self, entry_dict: dict | None = None) -> dict:
+        """
+        Builds the payload dictionary with the data from the entry
+        dictionary. Data is set to 0 if no entry dictionary is given.
+
+        :param entry_dict: The dictionary to take the data from.
+        :type entry_dict: dict | None
+
+        :return: The payload dictionary.
+        :rtype: dict
+        """
+        payload_dict = dict(self.pairs)
+        for key, entry_key in self.data_keys:
+            payload_dict[key] = (
+                entry_dict.get(entry_key) if entry_dict != None else 0
+            )
+        return payload_dict
+
+
+_PayloadsIndex = Dict[Tuple[str, FrozenSet[str]], List[_PayloadsGroup]]
+
+
 class Rules:
     def __init__(self) -> None:
         self.rules: List[ShortenedItem] = []
@@ -204,6 +262,14 @@ class Payloads(Rules):
             str, Coroutine, str | int, str | int, str | int, str | int
         ] = []
         self._rules_applied: bool = False
+        self._short_index: _PayloadsIndex = {}
+        self._full_index: _PayloadsIndex = {}
+        self._key_aliases: Dict[str, Dict[str, str]] = {}
+        self._value_aliases: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self._short_templates: Dict[int, _PayloadTemplate] = {}
+        self._full_templates: Dict[int, _PayloadTemplate] = {}
+        self._shortened_cache: Dict[Tuple[Tuple[Any, Any], ...], dict] = {}
+        self._error_payload_dict: dict | None = None
         super().__init__()
 
     def apply_rules(self) -> None:
@@ -279,11 +345,7 @@ class Payloads(Rules):
                 and list_of_triggers == existing_payload.triggers
                 and list_of_data_items == existing_payload.data
             ):
-                self._logger.log(
-                    log=Log(
-                        level="INFO", text=(f"Removed payload: '{payload}'")
-                    )
-                )
+                self._logger.emit("INFO", "Removed payload: '%s'", payload)
                 classification.payloads.pop(num)
                 return
         error_str = f"Payload '{payload}' not found"
@@ -382,14 +444,10 @@ class Payloads(Rules):
             )
             raise ValueError(error_str)
         if self._rules_applied:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=(
-                        f"Added payload: "
-                        f"{self._convert_payload_to_dict(entry_payload=new_payload)}"
-                    ),
-                )
+            self._logger.emit(
+                "INFO",
+                "Added payload: %s",
+                self._convert_payload_to_dict(entry_payload=new_payload),
             )
         return new_payload
 
@@ -406,27 +464,28 @@ class Payloads(Rules):
 
         if not self._compiled:
             return payload_dict
-        payload_main_key, payload_main_value = list(payload_dict.items())[0]
+        try:
+            cache_key = tuple(payload_dict.items())
+            shortened_dict = self._shortened_cache.get(cache_key)
+        except TypeError:
+            cache_key, shortened_dict = None, None
+        if shortened_dict != None:
+            return dict(shortened_dict)
+        payload_main_key = next(iter(payload_dict), None)
         if (
             payload_main_key != self.main_key.item
             and payload_main_key != self.main_key.short_item
         ):
             return self._return_error_payload_dict()
-        needed_classification = self._get_needed_classification(
-            payload_main_value=payload_main_value, short=False
-        )
-        if needed_classification == None:
-            return self._return_error_payload_dict()
-        needed_payload = self._get_needed_payload(
-            classification=needed_classification, payload_dict=payload_dict
-        )
+        needed_payload = self._get_full_payload(payload_dict=payload_dict)
         if needed_payload == None:
             return self._return_error_payload_dict()
-        result_dict = self._convert_payload_to_dict(
-            entry_payload=needed_payload,
-            entry_dict=payload_dict,
-            is_short=True,
+        result_dict = self._short_templates[id(needed_payload)].fill(
+            entry_dict=payload_dict
         )
+        if cache_key != None and needed_payload.data == []:
+            self._shortened_cache[cache_key] = result_dict
+            return dict(result_dict)
         return result_dict
 
     def add_error_payload(self, payload: str, to_stage: Coroutine):
@@ -455,9 +514,7 @@ class Payloads(Rules):
             payload=payload, from_stage="any", to_stage=to_stage
         )
         self._error_payload = error_payload
-        self._logger.log(
-            log=Log(level="INFO", text=(f"Added error payload: '{payload}'"))
-        )
+        self._logger.emit("INFO", "Added error payload: '%s'", payload)
 
     def compile(self) -> None:
         """
@@ -484,13 +541,15 @@ class Payloads(Rules):
             raise RuntimeError(error_str)
         if self._compiled:
             raise RuntimeError("Payloads have already been compiled")
+        self._build_index()
         self._compiled = True
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"[SUCCESS] Payloads compiled successfully\n"),
-                starts_with=f"\n",
-            )
+        self._error_payload_dict = self.shortener(
+            self._convert_payload_to_dict(entry_payload=self._error_payload)
+        )
+        self._logger.emit(
+            "INFO",
+            "[SUCCESS] Payloads compiled successfully\n",
+            starts_with=f"\n",
         )
 
     def get_all_source_stages(self) -> List[str]:
@@ -563,8 +622,13 @@ class Payloads(Rules):
         )
 
     def _return_payload_dict(self, payload: Payload, entry_dict: dict) -> dict:
-        full_dict = self._convert_payload_to_dict(
-            entry_payload=payload, entry_dict=entry_dict, is_short=False
+        full_template = self._full_templates.get(id(payload))
+        full_dict = (
+            full_template.fill(entry_dict=entry_dict)
+            if full_template != None
+            else self._convert_payload_to_dict(
+                entry_payload=payload, entry_dict=entry_dict, is_short=False
+            )
         )
         output_keys_list = [
             "dst",
@@ -582,83 +646,152 @@ class Payloads(Rules):
         ]
         return dict(zip(output_keys_list, output_data_list))
 
-    def _get_needed_payload(
-        self, classification: Classification, payload_dict: dict
-    ) -> Payload:
-        payload_dict_keys = [key for key, _ in payload_dict.items()]
-        for payload in classification.payloads:
-            if (
-                self._validate_payload_length(
-                    payload=payload, payload_dict=payload_dict
-                )
-                and self._validate_payload_triggers(
-                    payload=payload,
-                    payload_dict=payload_dict,
-                    payload_dict_keys=payload_dict_keys,
+    def _build_index(self) -> None:
+        self._short_index = {}
+        self._full_index = {}
+        self._key_aliases = {}
+        self._value_aliases = {}
+        self._short_templates = {}
+        self._full_templates = {}
+        self._shortened_cache = {}
+        for classification in self.classes:
+            main_value = classification.main_value
+            key_aliases = self._key_aliases.setdefault(main_value.item, {})
+            for payload in classification.payloads:
+                self._short_templates[id(payload)] = self._build_template(
+                    payload=payload, is_short=True
                 )
-                and self._validate_payload_data(
-                    payload=payload,
-                    payload_dict_keys=payload_dict_keys,
+                self._full_templates[id(payload)] = self._build_template(
+                    payload=payload, is_short=False
                 )
-            ):
-                return payload
-        return None
+                keys = [trigger.key for trigger in payload.triggers]
+                keys += payload.data
+                for key in keys:
+                    key_aliases.setdefault(key.item, key.short_item)
+                    key_aliases.setdefault(key.short_item, key.short_item)
+                for trigger in payload.triggers:
+                    value_aliases = self._value_aliases.setdefault(
+                        (main_value.item, trigger.key.short_item), {}
+                    )
+                    value_aliases.setdefault(
+                        trigger.value.item, trigger.value.short_item
+                    )
+                    value_aliases.setdefault(
+                        trigger.value.short_item, trigger.value.short_item
+                    )
+                signature = frozenset(key.short_item for key in keys)
+                for index, indexed_main_value in (
+                    (self._short_index, main_value.short_item),
+                    (self._full_index, main_value.item),
+                ):
+                    self._add_to_index(
+                        index=index,
+                        main_value=indexed_main_value,
+                        signature=signature,
+                        payload=payload,
+                    )
 
-    def _validate_payload_data(
-        self,
-        payload: Payload,
-        payload_dict_keys: List[str],
-    ) -> bool:
-        for data_item in payload.data:
-            if (
-                data_item.item not in payload_dict_keys
-                and data_item.short_item not in payload_dict_keys
-            ):
-                return False
-        return True
+    def _build_template(
+        self, payload: Payload, is_short: bool
+    ) -> _PayloadTemplate:
+        items = [(payload.main_key, payload.main_value)]
+        items += [(trigger.key, trigger.value) for trigger in payload.triggers]
+        pairs = tuple(
+            (
+                (key.short_item, value.short_item)
+                if is_short
+                else (key.item, value.item)
+            )
+            for key, value in items
+        )
+        data_keys = tuple(
+            (
+                (data_item.short_item, data_item.item)
+                if is_short
+                else (data_item.item, data_item.short_item)
+            )
+            for data_item in payload.data
+        )
+        return _PayloadTemplate(pairs=pairs, data_keys=data_keys)
 
-    def _validate_payload_triggers(
+    def _add_to_index(
         self,
+        index: _PayloadsIndex,
+        main_value: str,
+        signature: FrozenSet[str],
         payload: Payload,
-        payload_dict: dict,
-        payload_dict_keys: List[str],
-    ) -> bool:
-        for trigger in payload.triggers:
-            if (
-                trigger.key.item not in payload_dict_keys
-                and trigger.key.short_item not in payload_dict_keys
-            ):
-                return False
-            if (
-                payload_dict.get(trigger.key.item) != trigger.value.item
-                and payload_dict.get(trigger.key.item)
-                != trigger.value.short_item
-                and payload_dict.get(trigger.key.short_item)
-                != trigger.value.item
-                and payload_dict.get(trigger.key.short_item)
-                != trigger.value.short_item
-            ):
-                return False
-        return True
-
-    def _validate_payload_length(
-        self, payload: Payload, payload_dict: dict
-    ) -> bool:
-        if len(list(payload_dict.items())) == 1 + len(payload.triggers) + len(
-            payload.data
-        ):
-            return True
-        return False
+    ) -> None:
+        trigger_keys = tuple(
+            trigger.key.short_item for trigger in payload.triggers
+        )
+        groups = index.setdefault((main_value, signature), [])
+        for group in groups:
+            if group.trigger_keys == trigger_keys:
+                break
+        else:
+            group = _PayloadsGroup(trigger_keys=trigger_keys)
+            groups.append(group)
+        group.payloads.setdefault(
+            tuple(trigger.value.short_item for trigger in payload.triggers),
+            payload,
+        )
 
-    async def _get_payload(self, entry_dict: dict) -> Payload:
-        payload_main_value = self._get_payload_main_value(entry_dict)
-        needed_classification = self._get_needed_classification(
-            payload_main_value=payload_main_value, short=True
+    def _find_in_index(
+        self, index: _PayloadsIndex, main_value: Any, entry_dict: dict
+    ) -> Payload | None:
+        keys = iter(entry_dict)
+        next(keys, None)
+        try:
+            groups = index.get((main_value, frozenset(keys)))
+        except TypeError:
+            return None
+        if groups is None:
+            return None
+        for group in groups:
+            try:
+                payload = group.payloads.get(
+                    tuple(entry_dict[key] for key in group.trigger_keys)
+                )
+            except TypeError:
+                continue
+            if payload is not None:
+                return payload
+        return None
+
+    def _get_full_payload(self, payload_dict: dict) -> Payload | None:
+        main_value = next(iter(payload_dict.values()))
+        try:
+            key_aliases = self._key_aliases.get(main_value)
+        except TypeError:
+            return None
+        if key_aliases is None:
+            return None
+        normalized_dict = {}
+        for num, (key, value) in enumerate(payload_dict.items()):
+            if num == 0:
+                normalized_dict[key] = value
+                continue
+            short_key = key_aliases.get(key, key)
+            value_aliases = self._value_aliases.get((main_value, short_key))
+            if value_aliases is not None:
+                try:
+                    value = value_aliases.get(value, value)
+                except TypeError:
+                    pass
+            normalized_dict[short_key] = value
+        if len(normalized_dict) != len(payload_dict):
+            return None
+        return self._find_in_index(
+            index=self._full_index,
+            main_value=main_value,
+            entry_dict=normalized_dict,
         )
-        if needed_classification is None:
-            return self._return_error_payload()
-        needed_reference = self._get_needed_reference(
-            entry_dict, needed_classification
+
+    async def _get_payload(self, entry_dict: dict) -> Payload:
+        needed_reference = self._find_in_index(
+            index=self._short_index,
+            main_value=self._get_payload_main_value(entry_dict),
+            entry_dict=entry_dict,
         )
         if needed_reference is None:
             return self._return_error_payload()
@@ -667,46 +800,6 @@ class Payloads(Rules):
     def _get_payload_main_value(self, entry_dict: dict) -> str:
         return list(entry_dict.values())[0]
 
-    def _get_needed_classification(
-        self, payload_main_value: str, short: bool = True
-    ) -> Classification:
-        for classification in self.classes:
-            if short:
-                if classification.main_value.short_item == payload_main_value:
-                    return classification
-            else:
-                if classification.main_value.item == payload_main_value:
-                    return classification
-        return None
-
-    def _get_needed_reference(
-        self, entry_dict: dict, needed_classification: Classification
-    ) -> Payload:
-        for payload in needed_classification.payloads:
-            if self._is_valid_payload(entry_dict, payload):
-                return payload
-        return None
-
-    def _is_valid_payload(self, entry_dict: dict, payload: Payload) -> bool:
-        triggers_short_keys = [
-            trigger.key.short_item for trigger in payload.triggers
-        ]
-        data_short_keys = [key.short_item for key in payload.data]
-        entry_payload_keys = [key for key, _ in entry_dict.items()]
-        if len(entry_payload_keys) != 1 + len(triggers_short_keys) + len(
-            data_short_keys
-        ):
-            return False
-        for key in triggers_short_keys + data_short_keys:
-            if key not in entry_payload_keys:
-                return False
-        for trigger in payload.triggers:
-            if trigger.value.short_item != entry_dict.get(
-                trigger.key.short_item
-            ):
-                return False
-        return True
-
     def _convert_payload_to_dict(
         self,
         entry_payload: Payload,
@@ -745,9 +838,9 @@ class Payloads(Rules):
         return self._error_payload
 
     def _return_error_payload_dict(self) -> dict:
-        self._logger.log(
-            log=Log(level="WARNING", text=(f"Input resulted as an error"))
-        )
+        self._logger.emit("WARNING", "Input resulted as an error")
+        if self._error_payload_dict != None:
+            return dict(self._error_payload_dict)
         return self.shortener(
             self._convert_payload_to_dict(entry_payload=self._error_payload)
         )
@@ -910,12 +1003,11 @@ class Payloads(Rules):
         for num, classification in enumerate(self.classes):
             if classification.payloads == []:
                 self.classes.pop(num)
-                self._logger.log(
-                    log=Log(
-                        level="INFO",
-                        text=(
-                            f"Classification '{classification.main_value.item}' "
-                            "was removed due to empty Payloads list"
-                        ),
-                    )
+                self._logger.emit(
+                    "INFO",
+                    (
+                        "Classification '%s' was removed due to empty "
+                        "Payloads list"
+                    ),
+                    classification.main_value.item,
                 )
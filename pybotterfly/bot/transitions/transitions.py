@@ -1,13 +1,29 @@
 import inspect
+import time
 from emoji import replace_emoji
 from dataclasses import dataclass, field, is_dataclass
-from typing import Coroutine, List
+from types import MappingProxyType
+from typing import (
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Mapping,
+    Tuple,
+)
 
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.returns.message import Returns
 from pybotterfly.bot.struct import MessageStruct
 from pybotterfly.bot.transitions.payloads import Payloads
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+from pybotterfly.bot.metrics import get_metrics
+from pybotterfly.bot.tracing import get_tracer
+
+
+def _target_name(func: Coroutine) -> str:
+    return getattr(func, "__qualname__", repr(func))
 
 
 @dataclass(init=False)
@@ -64,6 +80,67 @@ class Transition:
     to_access_level: str | None = None
 
 
+@dataclass()
+class _AccessIndex:
+    """
+    Transitions of a single trigger indexed by the access level. Keeps the
+    first transition (in the order of addition) available to every access
+    level.
+
+    :param by_access_level: The first transition available to the access
+        level together with its position among the stage transitions.
+    :type by_access_level: Dict[str, Tuple[int, Transition]]
+
+    :param any_level: The first transition available to any access level
+        together with its position among the stage transitions.
+    :type any_level: Tuple[int, Transition] | None
+    """
+
+    by_access_level: Dict[str, Tuple[int, Transition]] = field(
+        default_factory=dict
+    )
+    any_level: Tuple[int, Transition] | None = None
+
+    def add(self, position: int, transition: Transition) -> None:
+        if transition.access_level == ["any"]:
+            if self.any_level is None:
+                self.any_level = (position, transition)
+            return
+        for access_level in transition.access_level:
+            self.by_access_level.setdefault(
+                access_level, (position, transition)
+            )
+
+    def get(self, access_level: str) -> Tuple[int, Transition] | None:
+        found = self.by_access_level.get(access_level)
+        if found is None:
+            return self.any_level
+        if self.any_level is not None and self.any_level[0] < found[0]:
+            return self.any_level
+        return found
+
+
+@dataclass()
+class _StageIndex:
+    """
+    Compiled transitions of a single stage.
+
+    :param triggers: Text transitions indexed by the lowercased trigger.
+    :type triggers: Mapping[str, _AccessIndex]
+
+    :param file_triggers: File transitions bucketed by the file extension.
+        Every bucket keeps the order of addition.
+    :type file_triggers: Mapping[str, Tuple[Tuple[int, Transition], ...]]
+
+    :param default: The default transition of the stage.
+    :type default: Transition | None
+    """
+
+    triggers: Mapping[str, _AccessIndex]
+    file_triggers: Mapping[str, Tuple[Tuple[int, Transition], ...]]
+    default: Transition | None
+
+
 @dataclass()
 class Transitions:
     """
@@ -100,10 +177,20 @@ class Transitions:
             logger if logger != None else DefaultLogger(config=config)
         )
         self._compiled = False
-        if self.payloads == None:
-            self._logger.log(
-                log=Log(level="INFO", text=(f"Payloads aren't added"))
+        self._index: Mapping[str, _StageIndex] = MappingProxyType({})
+        metrics = get_metrics(config=config)
+        self._page_seconds = (
+            metrics.histogram(
+                "pybotterfly_page_seconds",
+                "Time (in seconds) of running the page of a transition",
+                labels=("messenger", "stage", "target"),
             )
+            if metrics != None
+            else None
+        )
+        self._tracer = get_tracer(config=config)
+        if self.payloads == None:
+            self._logger.emit("INFO", "Payloads aren't added")
 
     def add_transition(
         self,
@@ -174,9 +261,7 @@ class Transitions:
             self.transitions.append(new_transition)
         else:
             self.transitions.append(new_transition)
-        self._logger.log(
-            log=Log(level="INFO", text=(f"Added transition: {new_transition}"))
-        )
+        self._logger.emit("INFO", "Added transition: %s", new_transition)
 
     def add_error_return(self, error_func: Coroutine) -> None:
         """
@@ -189,11 +274,8 @@ class Transitions:
         :returns: None
         """
         self.error_return = error_func
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"Added error transition return: {error_func}"),
-            )
+        self._logger.emit(
+            "INFO", "Added error transition return: %s", error_func
         )
 
     def compile(self) -> None:
@@ -209,13 +291,12 @@ class Transitions:
         self._add_none_transition_to_all_stages()
         self._checks()
         self.transitions.sort(key=lambda src: src.from_stage)
+        self._index = self._build_index()
         self._compiled = True
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"[SUCCESS] Transitions compiled successfully\n"),
-                starts_with=f"\n",
-            )
+        self._logger.emit(
+            "INFO",
+            "[SUCCESS] Transitions compiled successfully\n",
+            starts_with=f"\n",
         )
 
     async def run(
@@ -228,6 +309,9 @@ class Transitions:
         user_stage_changer: Coroutine | None,
         user_access_level_changer: Coroutine | None,
         user_file_saver: Coroutine | None = None,
+        file_resolver: (
+            Callable[[MessageStruct], Awaitable[None]] | None
+        ) = None,
     ) -> Returns:
         """
         Runs the state machine with the given input message, and returns the
@@ -259,6 +343,13 @@ class Transitions:
             the database.
         :type user_file_saver: Coroutine | None
 
+        :param file_resolver: A coroutine that downloads the files of the
+            message sent as references. Called only if a file transition
+            matches the message. If none of the files were downloaded, the
+            default transition of the stage is used. Defaults to None.
+        :type file_resolver: Callable[[MessageStruct], Awaitable[None]]
+            | None
+
         :return: The output of the state machine.
         :rtype: Returns
         """
@@ -282,6 +373,7 @@ class Transitions:
                 user_stage_changer=user_stage_changer,
                 user_access_level_changer=user_access_level_changer,
                 user_file_saver=user_file_saver,
+                file_resolver=file_resolver,
             )
             return return_func
         elif message.payload != None:
@@ -306,39 +398,35 @@ class Transitions:
         user_stage_changer: Coroutine,
         user_access_level_changer: Coroutine | None,
         user_file_saver: Coroutine | None = None,
+        file_resolver: (
+            Callable[[MessageStruct], Awaitable[None]] | None
+        ) = None,
     ):
         message.text = replace_emoji(message.text, replace="")
-        stage_transitions = await self._get_transitions_by_stage(
-            stage=user_stage
+        needed_transition = self._find_transition(
+            message=message,
+            user_stage=user_stage,
+            user_access_level=user_access_level,
         )
-        needed_transition = None
-        for transition in stage_transitions:
-            if not (
-                user_access_level in transition.access_level
-                or transition.access_level == ["any"]
-            ):
-                continue
-            if not (
-                (transition.trigger == message.text.lower())
-                or (
-                    is_dataclass(transition.trigger)
-                    and bool(len(message.files))
-                    and bool(
-                        sum(
-                            [
-                                int(True)
-                                for message_file in message.files
-                                if message_file.ext
-                                in transition.trigger.extensions
-                            ]
-                        )
-                        == len(message.files)
-                    )
+        if (
+            needed_transition != None
+            and file_resolver != None
+            and is_dataclass(needed_transition.trigger)
+            and bool(len(message.files))
+        ):
+            await file_resolver(message)
+            if not message.files:
+                # The file page would get an empty text instead of files
+                self._logger.emit(
+                    "WARNING",
+                    (
+                        "None of the files of the message were downloaded, "
+                        "using the default transition of '%s': %s"
+                    ),
+                    user_stage,
+                    message.failed_files,
                 )
-            ):
-                continue
-            needed_transition = transition
-            break
+                needed_transition = None
         if needed_transition == None:
             needed_transition = await self._get_none_transition_by_stage(
                 stage=user_stage
@@ -365,9 +453,16 @@ class Transitions:
         message.text = await self._convert_message_file_to_dict(
             message=message, transition=needed_transition
         )
+        start_time = time.perf_counter()
         answer = await needed_transition.to_stage(
             user_messenger_id, user_messenger, message.text
         )
+        self._record_page(
+            start_time=start_time,
+            user_messenger=user_messenger,
+            user_stage=user_stage,
+            target=needed_transition.to_stage,
+        )
         return answer
 
     async def _fetch_payload_transition(
@@ -387,11 +482,18 @@ class Transitions:
             user_access_level=user_access_level,
             user_stage=user_stage,
         )
+        start_time = time.perf_counter()
         needed_func = await output_dict.get("dst")(
             user_messenger_id,
             user_messenger,
             output_dict.get("full_dict"),
         )
+        self._record_page(
+            start_time=start_time,
+            user_messenger=user_messenger,
+            user_stage=user_stage,
+            target=output_dict.get("dst"),
+        )
         await self._change_user_stage(
             to_stage_id=output_dict.get("to_stage_id"),
             user_stage_changer=user_stage_changer,
@@ -406,6 +508,31 @@ class Transitions:
         )
         return needed_func
 
+    def _record_page(
+        self,
+        start_time: float,
+        user_messenger: str,
+        user_stage: str,
+        target: Coroutine,
+    ) -> None:
+        if self._page_seconds == None and self._tracer == None:
+            return
+        end_time = time.perf_counter()
+        target_name = _target_name(func=target)
+        if self._page_seconds != None:
+            self._page_seconds.observe(
+                end_time - start_time, user_messenger, user_stage, target_name
+            )
+        if self._tracer != None:
+            self._tracer.record(
+                "page",
+                start=start_time,
+                end=end_time,
+                messenger=user_messenger,
+                stage=user_stage,
+                target=target_name,
+            )
+
     async def _change_user_access_level(
         self,
         to_access_level: str | None,
@@ -545,14 +672,72 @@ class Transitions:
                 )
                 raise ValueError(error_str)
 
-    async def _get_transitions_by_stage(self, stage: str) -> List[Transition]:
-        return [
-            transition
-            for transition in self.transitions
-            if transition.from_stage == stage
-        ]
+    def _build_index(self) -> Mapping[str, _StageIndex]:
+        stages: Dict[str, List[Transition]] = {}
+        for transition in self.transitions:
+            stages.setdefault(transition.from_stage, []).append(transition)
+        index = {}
+        for stage, stage_transitions in stages.items():
+            triggers: Dict[str, _AccessIndex] = {}
+            file_triggers: Dict[str, List[Tuple[int, Transition]]] = {}
+            default = None
+            for position, transition in enumerate(stage_transitions):
+                if transition.trigger is None:
+                    if default is None:
+                        default = transition
+                elif is_dataclass(transition.trigger):
+                    for ext in transition.trigger.extensions:
+                        file_triggers.setdefault(ext, []).append(
+                            (position, transition)
+                        )
+                else:
+                    triggers.setdefault(
+                        transition.trigger, _AccessIndex()
+                    ).add(position=position, transition=transition)
+            index[stage] = _StageIndex(
+                triggers=MappingProxyType(triggers),
+                file_triggers=MappingProxyType(
+                    {
+                        ext: tuple(bucket)
+                        for ext, bucket in file_triggers.items()
+                    }
+                ),
+                default=default,
+            )
+        return MappingProxyType(index)
+
+    def _find_transition(
+        self,
+        message: MessageStruct,
+        user_stage: str,
+        user_access_level: str,
+    ) -> Transition | None:
+        stage_index = self._index.get(user_stage)
+        if stage_index is None:
+            return None
+        found = None
+        access_index = stage_index.triggers.get(message.text.lower())
+        if access_index is not None:
+            found = access_index.get(access_level=user_access_level)
+        if message.files:
+            bucket = stage_index.file_triggers.get(message.files[0].ext, ())
+            for position, transition in bucket:
+                if found is not None and found[0] < position:
+                    break
+                if not (
+                    user_access_level in transition.access_level
+                    or transition.access_level == ["any"]
+                ):
+                    continue
+                if all(
+                    message_file.ext in transition.trigger.extensions
+                    for message_file in message.files
+                ):
+                    found = (position, transition)
+                    break
+        return found[1] if found is not None else None
 
     async def _get_none_transition_by_stage(self, stage: str) -> Transition:
-        for transition in self.transitions:
-            if transition.trigger == None and transition.from_stage == stage:
-                return transition
+        stage_index = self._index.get(stage)
+        if stage_index is not None:
+            return stage_index.default
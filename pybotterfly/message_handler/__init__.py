@@ -1,2 +1,4 @@
 from . import message_handler
 from . import struct
+from . import state_cache
+from . import batch_loader
@@ -0,0 +1,119 @@
+import asyncio
+from typing import Any, Dict, List, Set, Tuple
+
+from pybotterfly.message_handler.struct import Func
+
+_UserKey = Tuple[Any, str]
+
+
+class BatchLoader:
+    """
+    Groups concurrent lookups of users' states into batched calls of
+    `getter_many`.
+
+    Lookups made within the same iteration of the event loop are collected
+    and passed to `getter_many` at once as a list of
+    (user_messenger_id, user_messenger) tuples. `getter_many` should return
+    a dictionary with these tuples as keys. Users missing from the result
+    are fetched with the single `getter`. Concurrent lookups of the same
+    user share the result.
+
+    :param func: The getters of the state. `func.getter_many` must be set.
+    :type func: Func
+
+    :param max_batch_size: The maximum amount of users passed to a single
+        `getter_many` call. Defaults to 500.
+    :type max_batch_size: int
+    """
+
+    def __init__(self, func: Func, max_batch_size: int = 500) -> None:
+        if func.getter_many == None:
+            raise ValueError("'getter_many' isn't set")
+        if max_batch_size <= 0:
+            raise ValueError("Can't use negative values")
+        self._func = func
+        self._max_batch_size = max_batch_size
+        self._queued: Dict[_UserKey, asyncio.Future] = {}
+        self._scheduled = False
+        # The event loop keeps weak references to tasks only
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def getter(self, user_messenger_id: Any, user_messenger: str) -> Any:
+        """
+        Returns the user's state. The lookup is batched with the other
+        lookups made at the same time.
+
+        :param user_messenger_id: The ID of the user in the messenger.
+        :type user_messenger_id: Any
+
+        :param user_messenger: The messenger of the user.
+        :type user_messenger: str
+
+        :return: The state of the user.
+        :rtype: Any
+        """
+        key = (user_messenger_id, user_messenger)
+        future = self._queued.get(key)
+        if future == None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._queued[key] = future
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._dispatch)
+        return await asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        queued, self._queued = self._queued, {}
+        self._scheduled = False
+        keys = list(queued)
+        for start in range(0, len(keys), self._max_batch_size):
+            batch = {
+                key: queued[key]
+                for key in keys[start : start + self._max_batch_size]
+            }
+            task = asyncio.create_task(self._load(batch=batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        """
+        Starts the collected lookups and waits for all of the running
+        `getter_many` calls, so no lookup is left waiting.
+        """
+        if self._queued:
+            self._dispatch()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _load(self, batch: Dict[_UserKey, asyncio.Future]) -> None:
+        try:
+            results = await self._func.getter_many(users=list(batch))
+        except Exception as err:
+            self._fail(futures=list(batch.values()), err=err)
+            return
+        missing: List[_UserKey] = []
+        for key, future in batch.items():
+            if key in results:
+                if not future.done():
+                    future.set_result(results[key])
+            else:
+                missing.append(key)
+        await asyncio.gather(
+            *(self._load_one(key=key, future=batch[key]) for key in missing)
+        )
+
+    async def _load_one(self, key: _UserKey, future: asyncio.Future) -> None:
+        try:
+            value = await self._func.getter(key[0], key[1])
+        except Exception as err:
+            self._fail(futures=[future], err=err)
+        else:
+            if not future.done():
+                future.set_result(value)
+
+    def _fail(self, futures: List[asyncio.Future], err: Exception) -> None:
+        for future in futures:
+            if not future.done():
+                future.set_exception(err)
+                future.exception()
@@ -1,11 +1,27 @@
-from typing import Coroutine
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Coroutine, List
 
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.returns.message import Returns
 from pybotterfly.bot.struct import MessageStruct
 from pybotterfly.bot.transitions.transitions import Transitions
 from pybotterfly.message_handler.struct import Func
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.message_handler.state_cache import StateCache
+from pybotterfly.message_handler.batch_loader import BatchLoader
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+from pybotterfly.bot.metrics import Metrics, get_metrics, timed
+from pybotterfly.bot.tracing import Tracer, get_tracer, traced
+
+
+@dataclass()
+class _TimedFunc:
+    """
+    A user's state getter and setter which durations are recorded to the
+    metrics and the traces.
+    """
+
+    getter: Callable[..., Awaitable]
+    setter: Callable[..., Awaitable]
 
 
 class MessageHandler:
@@ -29,6 +45,9 @@ class MessageHandler:
                 ‘user_messenger_id’ and ‘user_messenger’ args.
             - .setter - a coroutine to change user’s stage. Should contain
                 'to_stage_id', ‘user_messenger_id’ and ‘user_messenger’ args.
+            - .getter_many - [Optional] a coroutine to get stages of many
+                users at once. Concurrent lookups are batched into a single
+                call.
         :type user_stage: Func
 
         :param user_access_level: Dataclass that contains:
@@ -37,6 +56,8 @@ class MessageHandler:
             - .setter - a coroutine to change user’s access level. Should
                 contain 'to_access_level', ‘user_messenger_id’ and
                 ‘user_messenger’ args.
+            - .getter_many - [Optional] a coroutine to get access levels of
+                many users at once.
         :type user_access_level: Func | None
 
         :param user_file_saver: A coroutine that saves user’s file to
@@ -45,7 +66,8 @@ class MessageHandler:
             'user_messenger' args.
         :type user_file_saver: Coroutine | None
 
-        :param base_config: An instance of the BaseConfig class.
+        :param base_config: An instance of the BaseConfig class. Users'
+            stages and access levels are cached if `STATE_CACHE` is set.
         :type base_config: BaseConfig
 
         :param logger: An instance of the BaseLogger class that represents
@@ -64,32 +86,121 @@ class MessageHandler:
         self._logger = (
             logger if logger != None else DefaultLogger(config=base_config)
         )
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"Added user stage getter: {user_stage.getter}"),
-            )
+        self._logger.emit(
+            "INFO", "Added user stage getter: %s", user_stage.getter
         )
         if self._user_access_level:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=(
-                        f"Added user access level getter: "
-                        f"{user_access_level.getter}"
-                    ),
-                )
+            self._logger.emit(
+                "INFO",
+                "Added user access level getter: %s",
+                user_access_level.getter,
             )
         if self._user_file_saver:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=(f"Added user file saver: {user_file_saver}"),
-                )
+            self._logger.emit(
+                "INFO", "Added user file saver: %s", user_file_saver
             )
         self._checks()
+        self._batch_loaders: List[BatchLoader] = []
+        self._state_caches: List[StateCache] = []
+        self._user_stage_state = self._get_state_func(func=user_stage)
+        self._user_access_level_state = (
+            self._get_state_func(func=user_access_level)
+            if user_access_level != None
+            else None
+        )
+        metrics = get_metrics(config=base_config)
+        tracer = get_tracer(config=base_config)
+        if metrics != None or tracer != None:
+            self._user_stage_state = self._get_timed_func(
+                func=self._user_stage_state,
+                state="stage",
+                metrics=metrics,
+                tracer=tracer,
+            )
+            if self._user_access_level_state != None:
+                self._user_access_level_state = self._get_timed_func(
+                    func=self._user_access_level_state,
+                    state="access_level",
+                    metrics=metrics,
+                    tracer=tracer,
+                )
+
+    def _get_timed_func(
+        self,
+        func: Func | StateCache,
+        state: str,
+        metrics: Metrics | None,
+        tracer: Tracer | None,
+    ) -> _TimedFunc:
+        getter, setter = func.getter, func.setter
+        if metrics != None:
+            getter = timed(
+                func=getter,
+                series=metrics.histogram(
+                    "pybotterfly_state_getter_seconds",
+                    "Time (in seconds) of getting a user's state",
+                    labels=("state",),
+                ).labels(state),
+            )
+            setter = timed(
+                func=setter,
+                series=metrics.histogram(
+                    "pybotterfly_state_setter_seconds",
+                    "Time (in seconds) of changing a user's state",
+                    labels=("state",),
+                ).labels(state),
+            )
+        if tracer != None:
+            getter = traced(
+                func=getter, tracer=tracer, name="state.get", state=state
+            )
+            setter = traced(
+                func=setter, tracer=tracer, name="state.set", state=state
+            )
+        return _TimedFunc(getter=getter, setter=setter)
 
-    async def get(self, message_class: MessageStruct) -> Returns:
+    def _get_state_func(self, func: Func) -> Func | StateCache:
+        if func.getter_many != None:
+            batch_loader = BatchLoader(
+                func=func, max_batch_size=self._config.STATE_BATCH_SIZE
+            )
+            self._batch_loaders.append(batch_loader)
+            func = Func(getter=batch_loader.getter, setter=func.setter)
+        if not self._config.STATE_CACHE:
+            return func
+        state_cache = StateCache(
+            func=func,
+            max_size=self._config.STATE_CACHE_SIZE,
+            ttl=self._config.STATE_CACHE_TTL,
+            flush_interval=self._config.STATE_FLUSH_INTERVAL,
+            config=self._config,
+            logger=self._logger,
+        )
+        self._state_caches.append(state_cache)
+        return state_cache
+
+    async def flush(self) -> None:
+        """
+        Waits for the running batched lookups and writes the cached changes
+        of users' stages and access levels. Does nothing if neither is
+        used.
+
+        :returns: None
+        :rtype: NoneType
+        """
+        for batch_loader in self._batch_loaders:
+            await batch_loader.close()
+        for state_cache in self._state_caches:
+            await state_cache.close()
+
+    async def get(
+        self,
+        message_class: MessageStruct,
+        attachments: Awaitable | None = None,
+        file_resolver: (
+            Callable[[MessageStruct], Awaitable[None]] | None
+        ) = None,
+    ) -> Returns:
         """
         Retrieves a Returns instance by running the Transitions instance
         according to the provided message data and user stage data.
@@ -97,28 +208,42 @@ class MessageHandler:
         :param message_class: An instance of the Message_struct class.
         :type message_class: Message_struct
 
+        :param attachments: An awaitable that completes when the files of
+            the message are received. User's data is fetched while the
+            files are still being received. Defaults to None.
+        :type attachments: Awaitable | None
+
+        :param file_resolver: A coroutine that downloads the files of the
+            message sent as references. Called only if a file transition
+            matches the message. Defaults to None.
+        :type file_resolver: Callable[[MessageStruct], Awaitable[None]]
+            | None
+
         :returns: An instance of the Returns class.
         :rtype: Returns
         """
-        user_stage = await self._user_stage.getter(
+        user_stage = await self._user_stage_state.getter(
             message_class.user_id, message_class.messenger
         )
         user_access_level = "any"
         user_access_level_setter = None
-        if self._user_access_level != None:
-            user_access_level = await self._user_access_level.getter(
+        if self._user_access_level_state != None:
+            user_access_level = await self._user_access_level_state.getter(
                 message_class.user_id, message_class.messenger
             )
-            user_access_level_setter = self._user_access_level.setter
+            user_access_level_setter = self._user_access_level_state.setter
+        if attachments != None:
+            await attachments
         return_cls = await self._transitions.run(
             message=message_class,
             user_messenger_id=message_class.user_id,
             user_messenger=message_class.messenger,
             user_stage=user_stage,
-            user_stage_changer=self._user_stage.setter,
+            user_stage_changer=self._user_stage_state.setter,
             user_access_level=user_access_level,
             user_access_level_changer=user_access_level_setter,
             user_file_saver=self._user_file_saver,
+            file_resolver=file_resolver,
         )
         return_cls = await self._shorten_inline_buttons(return_func=return_cls)
         return return_cls
@@ -165,10 +290,8 @@ class MessageHandler:
                 arg=["file_name", "file_extension", "file_tag", "file_bytes"],
                 func=self._user_file_saver,
             )
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(f"[SUCCESS] Message handler's checks passed\n"),
-                starts_with=f"\n",
-            )
+        self._logger.emit(
+            "INFO",
+            "[SUCCESS] Message handler's checks passed\n",
+            starts_with=f"\n",
         )
@@ -0,0 +1,203 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Tuple
+
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.message_handler.struct import Func
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+
+_UserKey = Tuple[Any, str]
+
+
+@dataclass()
+class _CachedState:
+    value: Any
+    expires_at: float
+
+
+class StateCache:
+    """
+    An in-process write-behind cache around the getter and the setter of
+    a user's state (stage or access level).
+
+    Read values are kept in an LRU cache for `ttl` seconds. Written values
+    are returned by the getter right away and are written with the setter
+    every `flush_interval` seconds. Several writes of the same user within
+    a flush interval are coalesced into the last one.
+
+    :param func: The getter and the setter of the state.
+    :type func: Func
+
+    :param max_size: The maximum amount of cached users. Defaults to 10000.
+    :type max_size: int
+
+    :param ttl: The time (in seconds) a read value stays valid. Defaults
+        to 60.
+    :type ttl: float
+
+    :param flush_interval: The time (in seconds) between writes of the
+        changed values. The values are written right away if 0. Defaults
+        to 1.
+    :type flush_interval: float
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+    """
+
+    def __init__(
+        self,
+        func: Func,
+        max_size: int = 10000,
+        ttl: float = 60.0,
+        flush_interval: float = 1.0,
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+    ) -> None:
+        if max_size <= 0 or ttl < 0 or flush_interval < 0:
+            raise ValueError("Can't use negative values")
+        self._func = func
+        self._max_size = max_size
+        self._ttl = ttl
+        self._flush_interval = flush_interval
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        self._states: OrderedDict[_UserKey, _CachedState] = OrderedDict()
+        self._pending: Dict[_UserKey, Dict[str, Any]] = {}
+        self._writing: Dict[_UserKey, Dict[str, Any]] = {}
+        self._loading: Dict[_UserKey, asyncio.Future] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock: asyncio.Lock | None = None
+
+    async def getter(self, user_messenger_id: Any, user_messenger: str) -> Any:
+        """
+        Returns the user's state. Values that weren't written yet are
+        returned before the cached and the stored ones.
+
+        :param user_messenger_id: The ID of the user in the messenger.
+        :type user_messenger_id: Any
+
+        :param user_messenger: The messenger of the user.
+        :type user_messenger: str
+
+        :return: The state of the user.
+        :rtype: Any
+        """
+        key = (user_messenger_id, user_messenger)
+        values = self._pending.get(key) or self._writing.get(key)
+        if values != None:
+            return self._get_value(values)
+        state = self._states.get(key)
+        if state != None and state.expires_at > time.monotonic():
+            self._states.move_to_end(key)
+            return state.value
+        loading = self._loading.get(key)
+        if loading != None:
+            return await asyncio.shield(loading)
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        try:
+            value = await self._func.getter(user_messenger_id, user_messenger)
+        except Exception as err:
+            loading.set_exception(err)
+            loading.exception()
+            raise
+        finally:
+            self._loading.pop(key, None)
+        loading.set_result(value)
+        if key not in self._pending and key not in self._writing:
+            self._store(key=key, value=value)
+        return value
+
+    async def setter(
+        self, user_messenger_id: Any, user_messenger: str, **values
+    ) -> None:
+        """
+        Changes the user's state. The new state is written with the setter
+        on the next flush.
+
+        :param user_messenger_id: The ID of the user in the messenger.
+        :type user_messenger_id: Any
+
+        :param user_messenger: The messenger of the user.
+        :type user_messenger: str
+
+        :param values: The new state as the keyword argument of the setter
+            (for example `to_stage_id`).
+        """
+        key = (user_messenger_id, user_messenger)
+        self._store(key=key, value=self._get_value(values))
+        if self._flush_interval == 0:
+            await self._write(key=key, values=values)
+            return
+        self._pending[key] = values
+        self._start_flushing()
+
+    async def flush(self) -> None:
+        """
+        Writes all of the changed states with the setter.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._writing, self._pending = self._pending, {}
+            try:
+                for key, values in list(self._writing.items()):
+                    try:
+                        await self._write(key=key, values=values)
+                    except Exception as err:
+                        self._pending.setdefault(key, values)
+                        self._logger.emit(
+                            "ERROR",
+                            "Failed to write state of user %s (%s): %r",
+                            key[0],
+                            key[1],
+                            err,
+                        )
+            finally:
+                self._writing = {}
+
+    async def close(self) -> None:
+        """
+        Stops the periodic flushing and writes all of the changed states.
+        """
+        if self._flush_task != None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def _get_value(self, values: Dict[str, Any]) -> Any:
+        return next(iter(values.values()))
+
+    def _store(self, key: _UserKey, value: Any) -> None:
+        self._states[key] = _CachedState(
+            value=value, expires_at=time.monotonic() + self._ttl
+        )
+        self._states.move_to_end(key)
+        while len(self._states) > self._max_size:
+            self._states.popitem(last=False)
+
+    async def _write(self, key: _UserKey, values: Dict[str, Any]) -> None:
+        await self._func.setter(
+            **values, user_messenger_id=key[0], user_messenger=key[1]
+        )
+
+    def _start_flushing(self) -> None:
+        if self._flush_task == None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+            if not self._pending:
+                return
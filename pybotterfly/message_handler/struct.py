@@ -7,6 +7,7 @@ from typing import Coroutine
 class Func:
     getter: Coroutine
     setter: Coroutine
+    getter_many: Coroutine | None = None
 
     def __post_init__(self) -> None:
         self._checks()
@@ -19,6 +20,8 @@ class Func:
         for arg in main_args:
             self.args_check(arg, self.getter)
             self.args_check(arg, self.setter)
+        if self.getter_many != None:
+            self.args_check("users", self.getter_many)
 
     def args_check(self, arg: str, func: Coroutine) -> None:
         if arg not in inspect.getfullargspec(func)[0]:
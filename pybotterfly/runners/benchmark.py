@@ -0,0 +1,694 @@
+import argparse
+import asyncio
+import dataclasses
+import gc
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Literal, Tuple
+
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.bot.converters import (
+    BaseCodec,
+    BinaryCodec,
+    PickleJsonCodec,
+    decode_message,
+    encode_message,
+)
+from pybotterfly.bot.logger import DefaultLogger
+from pybotterfly.bot.metrics import HdrHistogram
+from pybotterfly.bot.reply.reply_division import MessengersDivision
+from pybotterfly.bot.returns.buttons import InlineButtons
+from pybotterfly.bot.returns.message import Return, Returns
+from pybotterfly.bot.struct import File, MessageStruct
+from pybotterfly.bot.transitions.payloads import Payloads
+from pybotterfly.bot.transitions.transitions import FileTrigger, Transitions
+from pybotterfly.message_handler.message_handler import MessageHandler
+from pybotterfly.message_handler.struct import Func
+from pybotterfly.server.server import Server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MESSAGE_KINDS = ("text", "payload", "file")
+STAGE = "benchmark"
+CODECS: Dict[str, BaseCodec | None] = {
+    "binary": BinaryCodec(),
+    "pickle": PickleJsonCodec(),
+    "none": None,
+}
+# Result fields compared with a baseline and whether a higher value is better
+COMPARED_FIELDS = {
+    "throughput": True,
+    "p50": False,
+    "p99": False,
+    "p999": False,
+    "max_rss_mb": False,
+}
+
+
+class _ProductionConfig(BaseConfig):
+    DEBUG_STATE = False
+
+
+@dataclass()
+class BenchmarkSettings:
+    """
+    The load the benchmark drives the server with.
+
+    :param concurrency: The amount of messages processed at once. Every
+        sender sends the next message as soon as the previous one is
+        answered. Defaults to 50.
+    :type concurrency: int
+
+    :param users: The amount of users the messages are sent from. Messages
+        of a user are processed in order, so fewer users means more
+        contention. Defaults to 1000.
+    :type users: int
+
+    :param duration: The time (in seconds) the load is measured for.
+        Defaults to 10.
+    :type duration: float
+
+    :param warmup: The time (in seconds) the load is sent before the
+        measurement. Defaults to 1.
+    :type warmup: float
+
+    :param mix: The weights of the message kinds: "text" messages (a text
+        trigger or the default transition), "payload" callbacks of inline
+        buttons and "file" messages. Defaults to 8:1:1.
+    :type mix: Dict[str, float]
+
+    :param file_size: The size (in bytes) of the attached files. Defaults
+        to 64 KiB.
+    :type file_size: int
+
+    :param reply_delay: The time (in seconds) the stub replier takes to
+        send a reply, like a messenger API call. Defaults to 0.
+    :type reply_delay: float
+
+    :param state_delay: The time (in seconds) the in-memory state getter
+        and setter take, like a database call. Defaults to 0.
+    :type state_delay: float
+
+    :param replies_per_second: The rate limit of the stub messenger.
+        Defaults to 1000000 (effectively unlimited).
+    :type replies_per_second: float
+
+    :param codec: The wire format every message is encoded to and decoded
+        from before it's processed, "none" to pass the messages as they
+        are. Defaults to "binary".
+    :type codec: Literal["binary", "pickle", "none"]
+
+    :param trace_memory: Whether the peak of the memory allocated during
+        the measurement is traced. Slows the benchmark down considerably.
+        Defaults to False.
+    :type trace_memory: bool
+
+    :param seed: The seed of the message generator. Defaults to None.
+    :type seed: int | None
+    """
+
+    concurrency: int = 50
+    users: int = 1000
+    duration: float = 10.0
+    warmup: float = 1.0
+    mix: Dict[str, float] = field(
+        default_factory=lambda: {"text": 8, "payload": 1, "file": 1}
+    )
+    file_size: int = 64 * 1024
+    reply_delay: float = 0.0
+    state_delay: float = 0.0
+    replies_per_second: float = 1_000_000
+    codec: Literal["binary", "pickle", "none"] = "binary"
+    trace_memory: bool = False
+    seed: int | None = None
+
+    def __post_init__(self) -> None:
+        if (
+            self.concurrency <= 0
+            or self.users <= 0
+            or self.duration <= 0
+            or self.warmup < 0
+            or self.file_size < 0
+            or self.reply_delay < 0
+            or self.state_delay < 0
+            or self.replies_per_second <= 0
+            or any(weight < 0 for weight in self.mix.values())
+            or sum(self.mix.values()) <= 0
+        ):
+            raise ValueError("Can't use negative values")
+        unknown_kinds = set(self.mix) - set(MESSAGE_KINDS)
+        if unknown_kinds:
+            raise ValueError(f"Unknown message kinds: {sorted(unknown_kinds)}")
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown codec: '{self.codec}'")
+
+
+@dataclass()
+class BenchmarkResult:
+    """
+    The measurements of a benchmark run. Latencies are the times (in
+    seconds) from passing a message to the server until all of its replies
+    are sent.
+
+    :param messages: The amount of processed messages.
+    :type messages: int
+
+    :param errors: The amount of messages that raised an error.
+    :type errors: int
+
+    :param replies: The amount of sent replies.
+    :type replies: int
+
+    :param duration: The measured time (in seconds).
+    :type duration: float
+
+    :param throughput: The processed messages per second.
+    :type throughput: float
+
+    :param mean: The mean latency.
+    :type mean: float
+
+    :param p50: The median latency.
+    :type p50: float
+
+    :param p99: The 99th percentile of the latency.
+    :type p99: float
+
+    :param p999: The 99.9th percentile of the latency.
+    :type p999: float
+
+    :param max: The maximum latency.
+    :type max: float
+
+    :param max_rss_mb: The peak resident memory (in MiB) of the process,
+        None if the OS doesn't report it.
+    :type max_rss_mb: float | None
+
+    :param traced_peak_mb: The peak of the memory (in MiB) allocated during
+        the measurement, None if it wasn't traced.
+    :type traced_peak_mb: float | None
+    """
+
+    messages: int
+    errors: int
+    replies: int
+    duration: float
+    throughput: float
+    mean: float
+    p50: float
+    p99: float
+    p999: float
+    max: float
+    max_rss_mb: float | None = None
+    traced_peak_mb: float | None = None
+
+    def format(self) -> str:
+        """
+        Returns the result as a human readable table.
+
+        :rtype: str
+        """
+        lines = [
+            f"messages      {self.messages} ({self.errors} errors, "
+            f"{self.replies} replies) in {self.duration:.2f} s",
+            f"throughput    {self.throughput:.1f} messages/s",
+            f"latency mean  {self.mean * 1000:.3f} ms",
+            f"latency p50   {self.p50 * 1000:.3f} ms",
+            f"latency p99   {self.p99 * 1000:.3f} ms",
+            f"latency p99.9 {self.p999 * 1000:.3f} ms",
+            f"latency max   {self.max * 1000:.3f} ms",
+        ]
+        if self.max_rss_mb != None:
+            lines.append(f"max RSS       {self.max_rss_mb:.1f} MiB")
+        if self.traced_peak_mb != None:
+            lines.append(f"traced peak   {self.traced_peak_mb:.1f} MiB")
+        return "\n".join(lines)
+
+
+class _Bench:
+    """
+    The bot the benchmark runs: a single stage with a text trigger, a
+    default transition, a file transition and a payload transition,
+    in-memory users' stages and a stub messenger.
+    """
+
+    def __init__(
+        self, settings: BenchmarkSettings, base_config: BaseConfig
+    ) -> None:
+        self._settings = settings
+        self._config = base_config
+        self._stages: Dict[Tuple[int, str], str] = {}
+        self.replies = 0
+        logger = DefaultLogger(config=base_config)
+        payloads = Payloads(config=base_config, logger=logger)
+        payloads.add_error_payload(
+            payload="type:error_input", to_stage=self._text_page
+        )
+        payloads.add_payload(
+            payload="type:benchmark/action:open/id:",
+            from_stage=STAGE,
+            to_stage=self._payload_page,
+        )
+        payloads.apply_rules()
+        payloads.compile()
+        transitions = Transitions(
+            payloads=payloads, config=base_config, logger=logger
+        )
+        transitions.add_error_return(self._text_page)
+        transitions.add_transition("hello", STAGE, self._hello_page)
+        transitions.add_transition(
+            FileTrigger(extensions=".png"), STAGE, self._file_page
+        )
+        transitions.add_transition(None, STAGE, self._text_page)
+        transitions.compile()
+        self._message_handler = MessageHandler(
+            transitions=transitions,
+            user_stage=Func(getter=self._get_stage, setter=self._set_stage),
+            base_config=base_config,
+            logger=logger,
+        )
+        self._messengers = MessengersDivision(
+            config=base_config, logger=logger
+        )
+        self._messengers.register_messenger(
+            trigger="tg",
+            reply_func=self._reply,
+            messages_per_second=settings.replies_per_second,
+            throttler="token_bucket",
+            burst=max(int(settings.replies_per_second), 1),
+        )
+        self._messengers.compile()
+        self.server = Server(
+            messengers=self._messengers,
+            message_handler=self._message_handler,
+            base_config=base_config,
+            logger=logger,
+        )
+        self._payload = payloads.shortener(
+            {"type": "benchmark", "action": "open", "id": 1}
+        )
+        self._file_bytes = os.urandom(settings.file_size)
+        self._codec = CODECS[settings.codec]
+
+    def new_message(self, rnd: random.Random) -> MessageStruct:
+        kind = rnd.choices(
+            list(self._settings.mix), weights=list(self._settings.mix.values())
+        )[0]
+        message = MessageStruct(
+            user_id=rnd.randrange(self._settings.users), messenger="tg"
+        )
+        if kind == "payload":
+            message.payload = dict(self._payload)
+        elif kind == "file":
+            message.files.append(
+                File(
+                    name="benchmark",
+                    ext=".png",
+                    tag="photo",
+                    file_bytes=self._file_bytes,
+                )
+            )
+        else:
+            message.text = "hello" if rnd.random() < 0.5 else "some text"
+        return message
+
+    async def process(self, message: MessageStruct) -> None:
+        if self._codec != None:
+            message = decode_message(
+                encode_message(message, codec=self._codec), codec=self._codec
+            )
+        await self.server.handle_message(message=message, addr="benchmark")
+
+    async def _get_stage(self, user_messenger_id: int, user_messenger: str):
+        if self._settings.state_delay:
+            await asyncio.sleep(self._settings.state_delay)
+        return self._stages.get((user_messenger_id, user_messenger), STAGE)
+
+    async def _set_stage(
+        self, to_stage_id: str, user_messenger_id: int, user_messenger: str
+    ) -> None:
+        if self._settings.state_delay:
+            await asyncio.sleep(self._settings.state_delay)
+        self._stages[(user_messenger_id, user_messenger)] = to_stage_id
+
+    async def _reply(self, return_message: Return) -> None:
+        if self._settings.reply_delay:
+            await asyncio.sleep(self._settings.reply_delay)
+        self.replies += 1
+
+    async def _text_page(
+        self, user_messenger_id: int, user_messenger: str, message
+    ) -> Returns:
+        returns = Returns()
+        await returns.add_return(
+            user_messenger_id=user_messenger_id,
+            user_messenger=user_messenger,
+            text=f"Echo: {message}",
+        )
+        return returns
+
+    async def _hello_page(
+        self, user_messenger_id: int, user_messenger: str, message
+    ) -> Returns:
+        returns = Returns()
+        await returns.add_return(
+            user_messenger_id=user_messenger_id,
+            user_messenger=user_messenger,
+            text="Hello",
+        )
+        return returns
+
+    async def _payload_page(
+        self, user_messenger_id: int, user_messenger: str, message
+    ) -> Returns:
+        keyboard = InlineButtons(config=self._config)
+        keyboard.add_button(
+            label="Open",
+            color="primary",
+            payload={"type": "benchmark", "action": "open", "id": 2},
+        )
+        keyboard.confirm()
+        returns = Returns()
+        await returns.add_return(
+            user_messenger_id=user_messenger_id,
+            user_messenger=user_messenger,
+            text="Opened",
+            inline_keyboard=keyboard,
+        )
+        return returns
+
+    async def _file_page(
+        self, user_messenger_id: int, user_messenger: str, message
+    ) -> Returns:
+        returns = Returns()
+        await returns.add_return(
+            user_messenger_id=user_messenger_id,
+            user_messenger=user_messenger,
+            text=f"Received {len(message['files'])} files",
+        )
+        await returns.add_return(
+            user_messenger_id=user_messenger_id,
+            user_messenger=user_messenger,
+            text="Thanks",
+        )
+        return returns
+
+
+async def _run(
+    settings: BenchmarkSettings, base_config: BaseConfig
+) -> BenchmarkResult:
+    bench = _Bench(settings=settings, base_config=base_config)
+    await bench.server.start()
+    histogram = HdrHistogram()
+    counters = {"messages": 0, "errors": 0}
+    measuring = False
+    deadline = time.perf_counter() + settings.warmup
+
+    async def sender(num: int) -> None:
+        rnd = random.Random(
+            None if settings.seed == None else settings.seed + num
+        )
+        while time.perf_counter() < deadline:
+            message = bench.new_message(rnd=rnd)
+            start = time.perf_counter()
+            try:
+                await bench.process(message=message)
+            except Exception:
+                failed = True
+            else:
+                failed = False
+            if not measuring:
+                continue
+            if failed:
+                counters["errors"] += 1
+                continue
+            histogram.observe(time.perf_counter() - start)
+            counters["messages"] += 1
+
+    try:
+        if settings.warmup > 0:
+            await asyncio.gather(
+                *(sender(num) for num in range(settings.concurrency))
+            )
+        gc.collect()
+        if settings.trace_memory:
+            tracemalloc.start()
+        measuring = True
+        replies_before = bench.replies
+        start_time = time.perf_counter()
+        deadline = start_time + settings.duration
+        await asyncio.gather(
+            *(sender(num) for num in range(settings.concurrency))
+        )
+        duration = time.perf_counter() - start_time
+        traced_peak_mb = None
+        if settings.trace_memory:
+            traced_peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    finally:
+        await bench.server.close()
+    return BenchmarkResult(
+        messages=counters["messages"],
+        errors=counters["errors"],
+        replies=bench.replies - replies_before,
+        duration=duration,
+        throughput=counters["messages"] / duration,
+        mean=histogram.sum / histogram.count if histogram.count else 0.0,
+        p50=histogram.percentile(0.5),
+        p99=histogram.percentile(0.99),
+        p999=histogram.percentile(0.999),
+        max=histogram.max,
+        max_rss_mb=_max_rss_mb(),
+        traced_peak_mb=traced_peak_mb,
+    )
+
+
+def _max_rss_mb() -> float | None:
+    if resource == None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def run_benchmark(
+    settings: BenchmarkSettings | None = None,
+    base_config: BaseConfig = _ProductionConfig,
+) -> BenchmarkResult:
+    """
+    Drives a Server with generated messages and measures it. The server
+    runs in the process with stub repliers and in-memory users' stages,
+    so only the framework itself is measured: the codec, the dispatcher,
+    the message handler, the transitions, the throttlers and the
+    coalescing.
+
+    :param settings: The load to drive the server with. Defaults to None
+        (BenchmarkSettings with its default values).
+    :type settings: BenchmarkSettings | None
+
+    :param base_config: The configuration of the server. Logging is
+        measured too, so use the production settings. Defaults to
+        BaseConfig without `DEBUG_STATE`.
+    :type base_config: BaseConfig
+
+    :rtype: BenchmarkResult
+    """
+    settings = settings if settings != None else BenchmarkSettings()
+    return asyncio.run(_run(settings=settings, base_config=base_config))
+
+
+def save_baseline(
+    result: BenchmarkResult, settings: BenchmarkSettings, path: str
+) -> None:
+    """
+    Saves the result with its settings as a baseline to compare later runs
+    with.
+
+    :param result: The result of the run.
+    :type result: BenchmarkResult
+
+    :param settings: The settings of the run.
+    :type settings: BenchmarkSettings
+
+    :param path: The path of the JSON file.
+    :type path: str
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "settings": dataclasses.asdict(settings),
+                "result": dataclasses.asdict(result),
+            },
+            file,
+            indent=2,
+        )
+
+
+def compare_with_baseline(
+    result: BenchmarkResult,
+    settings: BenchmarkSettings,
+    path: str,
+    tolerance: float = 0.1,
+) -> List[str]:
+    """
+    Compares the result with a saved baseline.
+
+    :param result: The result of the run.
+    :type result: BenchmarkResult
+
+    :param settings: The settings of the run.
+    :type settings: BenchmarkSettings
+
+    :param path: The path of the baseline saved by `save_baseline`.
+    :type path: str
+
+    :param tolerance: The share a value may get worse by before it's
+        considered a regression. Defaults to 0.1.
+    :type tolerance: float
+
+    :return: The descriptions of the regressions, empty if there are none.
+    :rtype: List[str]
+
+    :raises ValueError: If the baseline was made with other settings.
+    """
+    if tolerance < 0:
+        raise ValueError("Can't use negative values")
+    with open(path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    if baseline["settings"] != dataclasses.asdict(settings):
+        raise ValueError("The baseline was made with other settings")
+    regressions = []
+    for field_name, higher_is_better in COMPARED_FIELDS.items():
+        old = baseline["result"].get(field_name)
+        new = getattr(result, field_name)
+        if old == None or new == None or old == 0:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(
+                f"{field_name} regressed by {abs(change):.1%}: "
+                f"{old:.6g} -> {new:.6g}"
+            )
+    return regressions
+
+
+def _load_config(reference: str) -> BaseConfig:
+    module_name, _, attribute = reference.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _parse_args(argv: List[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m pybotterfly.runners.benchmark",
+        description=(
+            "Drives a PyBotterfly server with generated messages and "
+            "reports its throughput, latency and memory."
+        ),
+    )
+    defaults = BenchmarkSettings()
+    parser.add_argument(
+        "--concurrency", type=int, default=defaults.concurrency
+    )
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--duration", type=float, default=defaults.duration)
+    parser.add_argument("--warmup", type=float, default=defaults.warmup)
+    parser.add_argument(
+        "--mix",
+        default=",".join(
+            f"{kind}={weight:g}" for kind, weight in defaults.mix.items()
+        ),
+        help="Weights of the message kinds, e.g. text=8,payload=1,file=1",
+    )
+    parser.add_argument("--file-size", type=int, default=defaults.file_size)
+    parser.add_argument(
+        "--reply-delay", type=float, default=defaults.reply_delay
+    )
+    parser.add_argument(
+        "--state-delay", type=float, default=defaults.state_delay
+    )
+    parser.add_argument(
+        "--replies-per-second",
+        type=float,
+        default=defaults.replies_per_second,
+    )
+    parser.add_argument(
+        "--codec", choices=tuple(CODECS), default=defaults.codec
+    )
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--config",
+        help="The config of the server as module:attribute",
+    )
+    parser.add_argument("--save", help="Save the result as a baseline")
+    parser.add_argument("--compare", help="Compare with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> int:
+    """
+    Runs the benchmark from the command line.
+
+    :param argv: The command line arguments. Defaults to None (sys.argv).
+    :type argv: List[str] | None
+
+    :return: The exit code, 1 if the result regressed from the baseline,
+        2 if the baseline was made with other settings.
+    :rtype: int
+    """
+    args = _parse_args(argv)
+    mix = {}
+    for item in args.mix.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight)
+    settings = BenchmarkSettings(
+        concurrency=args.concurrency,
+        users=args.users,
+        duration=args.duration,
+        warmup=args.warmup,
+        mix=mix,
+        file_size=args.file_size,
+        reply_delay=args.reply_delay,
+        state_delay=args.state_delay,
+        replies_per_second=args.replies_per_second,
+        codec=args.codec,
+        trace_memory=args.trace_memory,
+        seed=args.seed,
+    )
+    base_config = (
+        _load_config(args.config) if args.config != None else _ProductionConfig
+    )
+    result = run_benchmark(settings=settings, base_config=base_config)
+    print(result.format())
+    if args.save != None:
+        save_baseline(result=result, settings=settings, path=args.save)
+    if args.compare != None:
+        try:
+            regressions = compare_with_baseline(
+                result=result,
+                settings=settings,
+                path=args.compare,
+                tolerance=args.tolerance,
+            )
+        except ValueError as err:
+            print(err)
+            return 2
+        for regression in regressions:
+            print(regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,88 @@
 import asyncio
+import time
 from io import BytesIO
-from datetime import datetime
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.struct import File, MessageStruct
-from pybotterfly.bot.converters import str_to_dict, file_to_string
+from pybotterfly.bot.converters import BaseCodec, str_to_dict
+from pybotterfly.bot.downloaders import DownloadError
 from pybotterfly.server.server_func import send_to_server
-from pybotterfly.bot.logger import Log, DefaultLogger, BaseLogger
+from pybotterfly.server.connection import ConnectionsPool
+from pybotterfly.server.router import ServersRouter
+from pybotterfly.server.durable_queue import DurableQueue
+from pybotterfly.server.struct import ServersList
+from pybotterfly.bot.metrics import get_metrics
+from pybotterfly.bot.tracing import get_tracer, new_trace_id, trace_span
+from pybotterfly.bot.logger import DefaultLogger, BaseLogger
 
 # Tg async library
 from aiogram import types, executor, Dispatcher
+from aiogram.utils.exceptions import TelegramAPIError
+from aiohttp import ClientError
 
 
 class TgClient:
     def __init__(
         self,
         dispatcher: Dispatcher,
-        local_ip: str,
-        local_port: int,
+        local_ip: str | None,
+        local_port: int | None,
         base_config: BaseConfig,
         logger: BaseLogger | None,
+        codec: BaseCodec | None = None,
+        servers: ServersList | None = None,
     ) -> None:
         self._dp = dispatcher
         self._local_ip = local_ip
         self._local_port = local_port
         self._config = base_config
+        self._codec = codec
         self._logger = (
             logger if logger != None else DefaultLogger(config=base_config)
         )
+        self._router = (
+            ServersRouter(
+                servers=servers,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if servers != None
+            else None
+        )
+        self._connections = (
+            ConnectionsPool(
+                local_ip=local_ip,
+                local_port=local_port,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if base_config.PERSISTENT_CONNECTION and servers == None
+            else None
+        )
+        self._queue = (
+            DurableQueue(
+                directory=base_config.DURABLE_QUEUE_DIR,
+                send=self._deliver,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if base_config.DURABLE_QUEUE_DIR != None
+            else None
+        )
+        metrics = get_metrics(config=base_config)
+        self._send_seconds = (
+            metrics.histogram(
+                "pybotterfly_client_send_seconds",
+                "Time (in seconds) of passing a message to the server or "
+                "the durable queue",
+                labels=("messenger",),
+            ).labels("tg")
+            if metrics != None
+            else None
+        )
+        self._tracer = get_tracer(config=base_config)
         self._dp.callback_query_handler()(self.callback_message_handler)
         self._dp.message_handler(content_types=types.ContentTypes.DOCUMENT)(
             self.file_handler
@@ -35,7 +91,6 @@ class TgClient:
             self.photo_handler
         )
         self._dp.message_handler()(self.message_handler)
-        self._started = False
 
     async def callback_message_handler(
         self,
@@ -45,36 +100,70 @@ class TgClient:
             user_id=query.from_user.id,
             messenger="tg",
             payload=str_to_dict(string=query.data),
+            trace_id=self._new_trace_id(),
         )
         await self.server_sender(message_struct=message_struct)
 
     async def photo_handler(self, message: types.Message) -> None:
         message_struct = MessageStruct(
-            user_id=message.from_id, messenger="tg", text=message.text
+            user_id=message.from_id,
+            messenger="tg",
+            text=message.text,
+            trace_id=self._new_trace_id(),
         )
         if message.photo != []:
-            file_in_io = BytesIO()
-            await message.photo[-1].download(destination_file=file_in_io)
-            message_struct.files.append(
-                File(
-                    name=message.photo[-1].file_unique_id,
-                    tag="photo",
-                    ext=".png",
-                    file_bytes=file_to_string(file_in_io.getvalue()),
+            photo = message.photo[-1]
+            try:
+                with trace_span(
+                    self._tracer,
+                    "client.download",
+                    trace_id=message_struct.trace_id,
+                    messenger="tg",
+                ):
+                    file_bytes = await self._download(
+                        message_file=photo, name=f"{photo.file_unique_id}.png"
+                    )
+            except DownloadError as err:
+                self._report_failed_file(
+                    message_struct=message_struct, err=err
+                )
+            else:
+                message_struct.files.append(
+                    File(
+                        name=photo.file_unique_id,
+                        tag="photo",
+                        ext=".png",
+                        file_bytes=file_bytes,
+                        reference=photo.file_id,
+                    )
                 )
-            )
         await self.server_sender(message_struct=message_struct)
 
     async def file_handler(self, message: types.Message) -> None:
         message_struct = MessageStruct(
-            user_id=message.from_id, messenger="tg", text=message.text
+            user_id=message.from_id,
+            messenger="tg",
+            text=message.text,
+            trace_id=self._new_trace_id(),
         )
         if message.document != None:
-            message_file = await self._file_downloader(
-                message_file=message.document
-            )
-            if message_file != None:
-                message_struct.files.append(message_file)
+            try:
+                with trace_span(
+                    self._tracer,
+                    "client.download",
+                    trace_id=message_struct.trace_id,
+                    messenger="tg",
+                ):
+                    message_file = await self._file_downloader(
+                        message_file=message.document
+                    )
+            except DownloadError as err:
+                self._report_failed_file(
+                    message_struct=message_struct, err=err
+                )
+            else:
+                if message_file != None:
+                    message_struct.files.append(message_file)
         await self.server_sender(message_struct=message_struct)
 
     async def _file_downloader(
@@ -83,102 +172,124 @@ class TgClient:
         doc_ext = f".{str(message_file.file_name).split('.')[-1]}".lower()
         if doc_ext not in self._config.ALLOWED_FILE_EXTENSIONS_LIST:
             return
-        if message_file.file_size >= 50 * 1024 * 1024:
-            self._logger.log(
-                log=Log(
-                    level="ERROR",
-                    text=(
-                        f"Skipping file with size: "
-                        f"{message_file.file_size}"
-                    ),
-                )
-            )
-            return
-        file_in_io = BytesIO()
-        await message_file.download(destination_file=file_in_io)
+        file_bytes = await self._download(
+            message_file=message_file, name=message_file.file_name
+        )
         return File(
             name=f"{message_file.file_name}",
             tag="document",
             ext=doc_ext,
-            file_bytes=file_to_string(file_in_io.getvalue()),
+            file_bytes=file_bytes,
+            reference=message_file.file_id,
         )
 
+    async def _download(
+        self,
+        message_file: types.document.Document | types.PhotoSize,
+        name: str,
+    ) -> bytes | None:
+        max_size = min(
+            self._config.DOWNLOAD_MAX_SIZE,
+            self._config.DOWNLOAD_MESSAGE_MAX_SIZE,
+        )
+        if (
+            message_file.file_size != None
+            and message_file.file_size > max_size
+        ):
+            raise DownloadError(
+                f"{name}: file with size {message_file.file_size} "
+                f"exceeds {max_size} bytes"
+            )
+        if self._config.LAZY_FILES:
+            return None
+        file_in_io = BytesIO()
+        try:
+            await message_file.download(destination_file=file_in_io)
+        except (TelegramAPIError, ClientError, asyncio.TimeoutError) as err:
+            raise DownloadError(f"{name}: {err!r}") from err
+        return file_in_io.getvalue()
+
+    def _report_failed_file(
+        self, message_struct: MessageStruct, err: DownloadError
+    ) -> None:
+        self._logger.emit("ERROR", "Skipping file: %s", err)
+        message_struct.failed_files.append(str(err))
+
     async def message_handler(self, message: types.Message) -> None:
         message_struct = MessageStruct(
-            user_id=message.from_id, messenger="tg", text=message.text
+            user_id=message.from_id,
+            messenger="tg",
+            text=message.text,
+            trace_id=self._new_trace_id(),
         )
         await self.server_sender(message_struct=message_struct)
 
+    def _new_trace_id(self) -> str | None:
+        return new_trace_id() if self._tracer != None else None
+
     async def server_sender(self, message_struct: MessageStruct) -> None:
+        start_time = time.perf_counter()
+        with trace_span(
+            self._tracer,
+            "client.send",
+            trace_id=message_struct.trace_id,
+            messenger="tg",
+        ):
+            if self._queue != None:
+                await self._queue.put(message=message_struct)
+            else:
+                await self._deliver(message_struct=message_struct)
+        if self._send_seconds != None:
+            self._send_seconds.observe(time.perf_counter() - start_time)
+
+    async def _deliver(self, message_struct: MessageStruct) -> None:
+        if self._router != None:
+            await self._router.send(message=message_struct)
+            return
+        if self._connections != None:
+            await self._connections.send(message=message_struct)
+            return
         await send_to_server(
             message=message_struct,
             local_ip=self._local_ip,
             local_port=self._local_port,
+            codec=self._codec,
         )
 
-    async def test_messages_rate(self, test_id: int, messages_amount: int):
-        self._started = True
-        test_start_time = datetime.now()
-        if not self._config.DEBUG_STATE:
-            error_str = "Failed to run test (running not in Debug mode)"
-            raise RuntimeError(error_str)
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=f"Rate test started at {test_start_time}",
-            )
+    def start_tg_client(self) -> None:
+        self._logger.emit(
+            "INFO",
+            "TG listening started%s",
+            " in Debug mode" if self._config.DEBUG_STATE else "",
         )
-        for num in range(1, messages_amount + 1):
-            message_struct = MessageStruct(
-                user_id=test_id, messenger="tg", text=f"TEST_MESSAGE_n{num}"
-            )
-            await self.server_sender(message_struct=message_struct)
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(
-                    f"Rate test to {test_id} with {messages_amount} messages "
-                    f"finished in "
-                    f"{(datetime.now() - test_start_time).total_seconds()} "
-                    f"seconds"
-                ),
-            )
+        executor.start_polling(
+            self._dp,
+            skip_updates=True,
+            on_startup=self._on_startup,
+            on_shutdown=self._on_shutdown,
         )
 
-    def start_tg_client(self) -> None:
-        if self._started:
-            self._logger.log(
-                log=Log(
-                    level="ERROR",
-                    text="Ensure not to run test",
-                )
-            )
-            return
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(
-                    f"TG listening started"
-                    f"{' in Debug mode' if self._config.DEBUG_STATE else ''}"
-                ),
-            )
-        )
-        executor.start_polling(self._dp, skip_updates=True)
+    async def _on_startup(self, dispatcher: Dispatcher) -> None:
+        if self._queue != None:
+            self._queue.start()
 
-    def run_test(self, test_id: int, messages_amount: int) -> None:
-        asyncio.run(
-            self.test_messages_rate(
-                test_id=test_id, messages_amount=messages_amount
-            )
-        )
+    async def _on_shutdown(self, dispatcher: Dispatcher) -> None:
+        if self._queue != None:
+            await self._queue.close()
+        if self._router != None:
+            await self._router.close()
+        if self._connections != None:
+            await self._connections.close()
 
 
 def start_tg_client(
     dispatcher: Dispatcher,
-    handler_ip: str,
-    handler_port: int,
+    handler_ip: str | None = None,
+    handler_port: int | None = None,
     base_config: BaseConfig = BaseConfig,
     logger: BaseLogger | None = None,
+    codec: BaseCodec | None = None,
+    servers: ServersList | None = None,
 ) -> None:
     """
     Starts a Telegram client that listens for incoming messages and forwards
@@ -191,11 +302,11 @@ def start_tg_client(
     :type dispatcher: Dispatcher
 
     :param handler_ip: The IP address to use to connect to the Telegram server.
-    :type handler_ip: str
+    :type handler_ip: str | None
 
     :param handler_port: The port number to use to connect to the Telegram
         server.
-    :type handler_port: int
+    :type handler_port: int | None
 
     :param base_config: The configuration options to use for the Telegram
         client. Defaults to `BaseConfig`.
@@ -205,85 +316,40 @@ def start_tg_client(
         base logger for the bot.
     :type logger: BaseLogger
 
-    :return: None
-    :rtype: NoneType
-    """
-
-    tg_client = _get_tg_client(
-        dispatcher=dispatcher,
-        handler_ip=handler_ip,
-        handler_port=handler_port,
-        base_config=base_config,
-        logger=logger,
-    )
-    tg_client.start_tg_client()
-
-
-def run_test(
-    test_id: int,
-    messages_amount: int,
-    dispatcher: Dispatcher,
-    handler_ip: str,
-    handler_port: int,
-    base_config: BaseConfig = BaseConfig,
-    logger: BaseLogger | None = None,
-) -> None:
-    """
-    Runs a test for the Telegram client by sending `messages_amount` messages
-    to the specified `dispatcher` and checking for the expected response. The
-    test is identified by `test_id`. The client connects to the Telegram server
-    using the provided `handler_ip` and `handler_port` and uses the given
-    `base_config`.
-
-    :param test_id: The ID of the test to be run.
-    :type test_id: int
+    :param codec: The codec to encode messages to the server with.
+        Defaults to BinaryCodec.
+    :type codec: BaseCodec
 
-    :param messages_amount: The number of messages to send to the `dispatcher`.
-    :type messages_amount: int
-
-    :param dispatcher: The `Dispatcher` instance to send messages to.
-    :type dispatcher: Dispatcher
-
-    :param handler_ip: The IP address to use to connect to the Telegram server.
-    :type handler_ip: str
-
-    :param handler_port: The port number to use to connect to the Telegram
-        server.
-    :type handler_port: int
-
-    :param base_config: The configuration options to use for the Telegram
-        client. Defaults to `BaseConfig`.
-    :type base_config: BaseConfig
-
-    :param logger: An instance of the BaseLogger class that represents the
-        base logger for the bot.
-    :type logger: BaseLogger
+    :param servers: The servers to send messages to instead of
+        `handler_ip`:`handler_port`. Users are spread between the servers
+        by consistent hashing and moved to the next servers while theirs
+        are unavailable.
+    :type servers: ServersList | None
 
     :return: None
     :rtype: NoneType
     """
 
-    if messages_amount <= 0:
-        raise ValueError("Messages amount must be greater than 0")
-    if messages_amount > 50:
-        raise ValueError("Messages amount must be less than 50")
-
     tg_client = _get_tg_client(
         dispatcher=dispatcher,
         handler_ip=handler_ip,
         handler_port=handler_port,
         base_config=base_config,
         logger=logger,
+        codec=codec,
+        servers=servers,
     )
-    tg_client.run_test(test_id=test_id, messages_amount=messages_amount)
+    tg_client.start_tg_client()
 
 
 def _get_tg_client(
     dispatcher: Dispatcher,
-    handler_ip: str,
-    handler_port: int,
+    handler_ip: str | None,
+    handler_port: int | None,
     base_config: BaseConfig,
     logger: BaseLogger | None = None,
+    codec: BaseCodec | None = None,
+    servers: ServersList | None = None,
 ) -> TgClient:
     """
     Returns a new Tg_client instance with the specified configuration options.
@@ -294,11 +360,11 @@ def _get_tg_client(
 
     :param handler_ip: A string that represents the IP address of the bot's
         message handler.
-    :type handler_ip: str
+    :type handler_ip: str | None
 
     :param handler_port: An integer that represents the port number of the
         bot's message handler.
-    :type handler_port: int
+    :type handler_port: int | None
 
     :param base_config: An instance of the BaseConfig class that represents the
         base configuration options for the bot.
@@ -308,13 +374,29 @@ def _get_tg_client(
         base logger for the bot.
     :type logger: BaseLogger
 
+    :param codec: The codec to encode messages to the server with.
+        Defaults to BinaryCodec.
+    :type codec: BaseCodec
+
+    :param servers: The servers to send messages to instead of
+        `handler_ip`:`handler_port`. Users are spread between the servers
+        by consistent hashing and moved to the next servers while theirs
+        are unavailable.
+    :type servers: ServersList | None
+
     :returns: A new Tg_client instance with the specified configuration options.
     :rtype: Tg_client
     """
+    if servers == None and (handler_ip == None or handler_port == None):
+        raise ValueError(
+            "Either 'handler_ip' and 'handler_port' or 'servers' must be set"
+        )
     return TgClient(
         dispatcher=dispatcher,
         local_ip=handler_ip,
         local_port=handler_port,
         base_config=base_config,
         logger=logger,
+        codec=codec,
+        servers=servers,
     )
@@ -1,14 +1,25 @@
 import json
 import asyncio
+import time
 import re
-from datetime import datetime
+from typing import List, Tuple
 
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.struct import File, MessageStruct
-from pybotterfly.bot.downloaders import download_file
-from pybotterfly.bot.converters import file_to_string
+from pybotterfly.bot.downloaders import (
+    Downloader,
+    DownloadBudget,
+    DownloadError,
+)
+from pybotterfly.bot.converters import BaseCodec
 from pybotterfly.server.server_func import send_to_server
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.server.connection import ConnectionsPool
+from pybotterfly.server.router import ServersRouter
+from pybotterfly.server.durable_queue import DurableQueue
+from pybotterfly.server.struct import ServersList
+from pybotterfly.bot.metrics import get_metrics
+from pybotterfly.bot.tracing import get_tracer, new_trace_id, trace_span
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
 
 # Vk async library
 from vkbottle import GroupEventType
@@ -20,19 +31,66 @@ class VkClient:
     def __init__(
         self,
         handler: Bot,
-        local_ip: str,
-        local_port: int,
+        local_ip: str | None,
+        local_port: int | None,
         base_config: BaseConfig,
         logger: BaseLogger | None,
+        codec: BaseCodec | None = None,
+        servers: ServersList | None = None,
     ) -> None:
         self._bot = handler
         self._local_ip = local_ip
         self._local_port = local_port
         self._config = base_config
+        self._codec = codec
         self._logger = (
             logger if logger != None else DefaultLogger(config=base_config)
         )
-        self._testing = False
+        self._router = (
+            ServersRouter(
+                servers=servers,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if servers != None
+            else None
+        )
+        self._connections = (
+            ConnectionsPool(
+                local_ip=local_ip,
+                local_port=local_port,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if base_config.PERSISTENT_CONNECTION and servers == None
+            else None
+        )
+        self._queue = (
+            DurableQueue(
+                directory=base_config.DURABLE_QUEUE_DIR,
+                send=self._deliver,
+                config=base_config,
+                logger=self._logger,
+                codec=codec,
+            )
+            if base_config.DURABLE_QUEUE_DIR != None
+            else None
+        )
+        self._downloader = Downloader(config=base_config, logger=self._logger)
+        metrics = get_metrics(config=base_config)
+        self._send_seconds = (
+            metrics.histogram(
+                "pybotterfly_client_send_seconds",
+                "Time (in seconds) of passing a message to the server or "
+                "the durable queue",
+                labels=("messenger",),
+            ).labels("vk")
+            if metrics != None
+            else None
+        )
+        self._tracer = get_tracer(config=base_config)
         self._bot.on.raw_event(
             GroupEventType.MESSAGE_EVENT, dataclass=MessageEvent
         )(self.handle_callback_event)
@@ -42,13 +100,12 @@ class VkClient:
         user_id = int(event.object.user_id)
         payload = event.object.payload
         message = MessageStruct(
-            user_id=user_id, messenger="vk", payload=payload
-        )
-        await send_to_server(
-            message=message,
-            local_ip=self._local_ip,
-            local_port=self._local_port,
+            user_id=user_id,
+            messenger="vk",
+            payload=payload,
+            trace_id=self._new_trace_id(),
         )
+        await self.server_sender(message_struct=message)
 
     async def handle_message_event(self, event: Message):
         payload = None
@@ -56,66 +113,144 @@ class VkClient:
             payload = json.loads(event.payload)
             if payload == {"command": "start"}:
                 payload = None
-        files = []
-        for message_file in event.attachments:
-            if message_file.doc != None:
-                doc_file = await self._file_downloader(
-                    message_file=message_file.doc
-                )
-                if doc_file != None:
-                    files.append(doc_file)
-            if message_file.photo != None:
-                photo_file = await self._photo_downloader(
-                    message_file=message_file
-                )
-                if photo_file != None:
-                    files.append(photo_file)
         message = MessageStruct(
             user_id=int(event.from_id),
             messenger="vk",
             text=event.text,
             payload=payload,
+            trace_id=self._new_trace_id(),
         )
-        if bool(len(files)):
-            message.files = files
+        if event.attachments:
+            with trace_span(
+                self._tracer,
+                "client.download",
+                trace_id=message.trace_id,
+                messenger="vk",
+            ):
+                message.files, message.failed_files = await self._get_files(
+                    attachments=event.attachments
+                )
+        await self.server_sender(message_struct=message)
+
+    async def _get_files(
+        self, attachments: list
+    ) -> Tuple[List[File], List[str]]:
+        """
+        Downloads the attachments of a message concurrently. The downloads
+        are bounded by the downloader pool and share the size budget of the
+        message. An attachment that couldn't be downloaded doesn't stop the
+        others, it's reported with the reason instead.
+
+        :param attachments: The attachments of the message.
+        :type attachments: list
+
+        :return: The downloaded files in the order of the attachments and
+            the descriptions of the attachments that failed.
+        :rtype: Tuple[List[File], List[str]]
+        """
+        budget = DownloadBudget(
+            max_size=self._config.DOWNLOAD_MESSAGE_MAX_SIZE
+        )
+        downloads = []
+        for message_file in attachments:
+            if message_file.doc != None:
+                downloads.append(
+                    self._file_downloader(
+                        message_file=message_file.doc, budget=budget
+                    )
+                )
+            if message_file.photo != None:
+                downloads.append(
+                    self._photo_downloader(
+                        message_file=message_file, budget=budget
+                    )
+                )
+        files = []
+        failed_files = []
+        for result in await asyncio.gather(*downloads, return_exceptions=True):
+            if isinstance(result, DownloadError):
+                self._logger.emit("ERROR", "Skipping file: %s", result)
+                failed_files.append(str(result))
+            elif isinstance(result, BaseException):
+                raise result
+            elif result != None:
+                files.append(result)
+        return files, failed_files
+
+    def _new_trace_id(self) -> str | None:
+        return new_trace_id() if self._tracer != None else None
+
+    async def server_sender(self, message_struct: MessageStruct) -> None:
+        start_time = time.perf_counter()
+        with trace_span(
+            self._tracer,
+            "client.send",
+            trace_id=message_struct.trace_id,
+            messenger="vk",
+        ):
+            if self._queue != None:
+                await self._queue.put(message=message_struct)
+            else:
+                await self._deliver(message_struct=message_struct)
+        if self._send_seconds != None:
+            self._send_seconds.observe(time.perf_counter() - start_time)
+
+    async def _deliver(self, message_struct: MessageStruct) -> None:
+        if self._router != None:
+            await self._router.send(message=message_struct)
+            return
+        if self._connections != None:
+            await self._connections.send(message=message_struct)
+            return
         await send_to_server(
-            message=message,
+            message=message_struct,
             local_ip=self._local_ip,
             local_port=self._local_port,
+            codec=self._codec,
         )
 
-    async def _file_downloader(self, message_file: DocsDoc) -> File | None:
+    async def _file_downloader(
+        self, message_file: DocsDoc, budget: DownloadBudget
+    ) -> File | None:
         if (
             f".{message_file.ext}"
             not in self._config.ALLOWED_FILE_EXTENSIONS_LIST
         ):
             return
-        if message_file.size >= 50 * 1024 * 1024:
-            self._logger.log(
-                log=Log(
-                    level="ERROR",
-                    text=f"Skipping file with size: {message_file.size}",
-                )
+        if message_file.size >= self._config.DOWNLOAD_MAX_SIZE:
+            raise DownloadError(
+                f"{message_file.title}: file with size {message_file.size} "
+                f"exceeds {self._config.DOWNLOAD_MAX_SIZE} bytes"
+            )
+        if message_file.size > budget.remaining:
+            raise DownloadError(
+                f"{message_file.title}: file with size {message_file.size} "
+                f"exceeds the size budget of the message"
+            )
+        file_bytes = None
+        if not self._config.LAZY_FILES:
+            file_bytes = await self._download(
+                url=message_file.url, name=message_file.title, budget=budget
             )
-            return
-        file_bytes = await download_file(message_file.url)
         return File(
             name=message_file.title.split(".")[0],
             tag="document",
             ext=f".{message_file.ext}".lower(),
-            file_bytes=file_to_string(file_bytes),
+            file_bytes=file_bytes,
+            reference=message_file.url,
         )
 
-    async def _photo_downloader(self, message_file) -> File:
+    async def _photo_downloader(
+        self, message_file, budget: DownloadBudget
+    ) -> File | None:
         file_url = message_file.photo.sizes[-5].url
         photo_ext = str(
             re.search(pattern=r"\.(jpg|jpeg|png)", string=file_url).group(0)
         ).lower()
         if photo_ext not in self._config.ALLOWED_FILE_EXTENSIONS_LIST:
             return
-        file_bytes = await download_file(file_url)
-        return File(
-            name=str(
+        photo_name = (
+            str(
                 re.search(
                     pattern=r"(\w+|\d+)\.(jpg|jpeg|png)",
                     string=file_url,
@@ -123,75 +258,61 @@ class VkClient:
             )
             .split(".jpg")[0]
             .split(".jpeg")[0]
-            .split(".png")[0],
+            .split(".png")[0]
+        )
+        file_bytes = None
+        if not self._config.LAZY_FILES:
+            file_bytes = await self._download(
+                url=file_url, name=f"{photo_name}{photo_ext}", budget=budget
+            )
+        return File(
+            name=photo_name,
             tag="photo",
             ext=photo_ext,
-            file_bytes=file_to_string(file_bytes),
+            file_bytes=file_bytes,
+            reference=file_url,
         )
 
+    async def _download(
+        self, url: str, name: str, budget: DownloadBudget
+    ) -> bytes:
+        try:
+            return await self._downloader.download(url=url, budget=budget)
+        except DownloadError as err:
+            raise DownloadError(f"{name}: {err}") from err
+
     def start_vk_bot(self):
-        if self._testing:
-            self._logger.log(
-                log=Log(level="ERROR", text="Ensure not to run test")
-            )
-            raise RuntimeError
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(
-                    f"VK listening started"
-                    f"{' in Debug mode' if self._config.DEBUG_STATE else ''}"
-                ),
-            )
+        self._logger.emit(
+            "INFO",
+            "VK listening started%s",
+            " in Debug mode" if self._config.DEBUG_STATE else "",
         )
+        if self._queue != None:
+            self._bot.loop_wrapper.on_startup.append(self._start_queue())
+        self._bot.loop_wrapper.on_shutdown.append(self._on_shutdown())
         self._bot.run_forever()
 
-    async def test_messages(self, test_id: int, messages_amount: int):
-        test_start_time = datetime.now()
-        if not self._config.DEBUG_STATE:
-            error_str = "Failed to run test (running not in Debug mode)"
-            raise RuntimeError(error_str)
-        self._logger.log(
-            log=Log(
-                level="INFO", text=f"Rate test started at {test_start_time}"
-            )
-        )
-        for num in range(1, messages_amount + 1):
-            message_struct = MessageStruct(
-                user_id=test_id, messenger="vk", text=f"TEST_MESSAGE_n{num}"
-            )
-            await send_to_server(
-                message=message_struct,
-                local_ip=self._local_ip,
-                local_port=self._local_port,
-            )
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(
-                    f"Rate test to {test_id} with {messages_amount} messages "
-                    f"finished in "
-                    f"{(datetime.now() - test_start_time).total_seconds()} "
-                    f"seconds"
-                ),
-            )
-        )
+    async def _start_queue(self) -> None:
+        self._queue.start()
 
-    def run_test(self, test_id: int, messages_amount: int) -> None:
-        self._testing = True
-        asyncio.run(
-            self.test_messages(
-                test_id=test_id, messages_amount=messages_amount
-            )
-        )
+    async def _on_shutdown(self) -> None:
+        if self._queue != None:
+            await self._queue.close()
+        if self._router != None:
+            await self._router.close()
+        if self._connections != None:
+            await self._connections.close()
+        await self._downloader.close()
 
 
 def start_vk_client(
     handler: Bot,
-    handler_ip: str,
-    handler_port: int,
+    handler_ip: str | None = None,
+    handler_port: int | None = None,
     base_config: BaseConfig = BaseConfig,
     logger: BaseLogger | None = None,
+    codec: BaseCodec | None = None,
+    servers: ServersList | None = None,
 ) -> None:
     """
     Initialize and start a VK client bot.
@@ -201,11 +322,11 @@ def start_vk_client(
 
     :param handler_ip: The local IP address of the handler that will
         receive incoming messages
-    :type handler_ip: str
+    :type handler_ip: str | None
 
     :param handler_port: The local port number of the handler that will
         receive incoming messages
-    :type handler_port: int
+    :type handler_port: int | None
 
     :param base_config: BaseConfig object containing VK API settings
     :type base_config: BaseConfig, optional
@@ -214,88 +335,51 @@ def start_vk_client(
         base logger for the bot.
     :type logger: BaseLogger
 
-    :return: None
-    :rtype: NoneType
-    """
-
-    vk_client = _get_vk_client(
-        handler=handler,
-        handler_ip=handler_ip,
-        handler_port=handler_port,
-        base_config=base_config,
-        logger=logger,
-    )
-    vk_client.start_vk_bot()
-
+    :param codec: The codec to encode messages to the server with.
+        Defaults to BinaryCodec.
+    :type codec: BaseCodec
 
-def run_test(
-    test_id: int,
-    messages_amount: int,
-    handler: Bot,
-    handler_ip: str,
-    handler_port: int,
-    base_config: BaseConfig = BaseConfig,
-    logger: BaseLogger | None = None,
-) -> None:
-    """
-    Runs a load test on the specified `handler` using the specified
-    VK client. Sends `messages_amount` messages to the handler and waits
-    for them to be processed.
-
-    :param test_id: The ID of the test being run.
-    :type test_id: int
-
-    :param messages_amount: The number of messages to send to the
-        handler.
-    :type messages_amount: int
-
-    :param handler: The bot handler to test.
-    :type handler: Bot
-
-    :param handler_ip: The IP address on which to run the handler.
-    :type handler_ip: str
-
-    :param handler_port: The port on which to run the handler.
-    :type handler_port: int
-
-    :param base_config: The base configuration to use for the VK client,
-        defaults to `BaseConfig`.
-    :type base_config: BaseConfig, optional
-
-    :param logger: An instance of the BaseLogger class that represents the
-        base logger for the bot.
-    :type logger: BaseLogger
+    :param servers: The servers to send messages to instead of
+        `handler_ip`:`handler_port`. Users are spread between the servers
+        by consistent hashing and moved to the next servers while theirs
+        are unavailable.
+    :type servers: ServersList | None
 
     :return: None
     :rtype: NoneType
     """
 
-    if messages_amount <= 0:
-        raise ValueError("Messages amount must be greater than 0")
-    if messages_amount > 50:
-        raise ValueError("Messages amount must be less than 50")
-
     vk_client = _get_vk_client(
         handler=handler,
         handler_ip=handler_ip,
         handler_port=handler_port,
         base_config=base_config,
         logger=logger,
+        codec=codec,
+        servers=servers,
     )
-    vk_client.run_test(test_id=test_id, messages_amount=messages_amount)
+    vk_client.start_vk_bot()
 
 
 def _get_vk_client(
     handler: Bot,
-    handler_ip: str,
-    handler_port: int,
+    handler_ip: str | None,
+    handler_port: int | None,
     base_config: BaseConfig,
     logger: BaseLogger | None = None,
+    codec: BaseCodec | None = None,
+    servers: ServersList | None = None,
 ):
+    if servers == None and (handler_ip == None or handler_port == None):
+        raise ValueError(
+            "Either 'handler_ip' and 'handler_port' or 'servers' must be set"
+        )
     return VkClient(
         handler=handler,
         local_ip=handler_ip,
         local_port=handler_port,
         base_config=base_config,
         logger=logger,
+        codec=codec,
+        servers=servers,
     )
@@ -1,2 +1,7 @@
 from . import server
 from . import server_func
+from . import protocol
+from . import connection
+from . import dispatcher
+from . import router
+from . import durable_queue
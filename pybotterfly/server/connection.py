@@ -0,0 +1,292 @@
+import asyncio
+import itertools
+import zlib
+from typing import Dict, List, Tuple
+
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.bot.struct import MessageStruct
+from pybotterfly.bot.converters import BaseCodec, encode_message_parts
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+from pybotterfly.server.protocol import (
+    HANDSHAKE,
+    ACK_OK,
+    pack_frame_parts,
+    read_ack,
+)
+
+
+class ServerConnection:
+    """
+    A long-lived framed connection to the server.
+
+    Every message is sent as a length-prefixed frame with its own stream ID,
+    so several messages can be in flight on the same connection at once.
+    The server acknowledges every frame once the message is processed.
+    Messages that weren't acknowledged before the connection was lost are
+    sent again after reconnecting.
+
+    :param local_ip: The IP address of the server.
+    :type local_ip: str
+
+    :param local_port: The port number of the server.
+    :type local_port: int
+
+    :param max_in_flight: The maximum number of unacknowledged messages.
+        Senders wait when the limit is reached.
+    :type max_in_flight: int
+
+    :param codec: The codec to encode messages with. Defaults to
+        BinaryCodec.
+    :type codec: BaseCodec | None
+
+    :param retries: The amount of attempts to deliver a message.
+    :type retries: int
+
+    :param reconnect_delay: The delay (in seconds) before the first
+        reconnection attempt. Doubles with every failed attempt.
+    :type reconnect_delay: float
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger
+    """
+
+    def __init__(
+        self,
+        local_ip: str,
+        local_port: int,
+        max_in_flight: int,
+        logger: BaseLogger,
+        codec: BaseCodec | None = None,
+        retries: int = 5,
+        reconnect_delay: float = 0.1,
+    ) -> None:
+        self._local_ip = local_ip
+        self._local_port = local_port
+        self._max_in_flight = max_in_flight
+        self._retries = retries
+        self._reconnect_delay = reconnect_delay
+        self._logger = logger
+        self._codec = codec
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._ack_task: asyncio.Task | None = None
+        # Stream IDs of the unacknowledged messages with the writers they
+        # were sent through
+        self._pending: Dict[
+            int, Tuple[asyncio.StreamWriter, asyncio.Future]
+        ] = {}
+        self._stream_ids = itertools.count(1)
+        self._in_flight: asyncio.Semaphore | None = None
+        self._connect_lock: asyncio.Lock | None = None
+        self._available = True
+
+    @property
+    def in_flight(self) -> int:
+        """
+        The amount of unacknowledged messages on the connection.
+        """
+        return len(self._pending)
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether the last attempt to send a message through the connection
+        succeeded.
+        """
+        return self._available
+
+    async def send(self, message: MessageStruct) -> None:
+        """
+        Sends the message and waits for the server to acknowledge it.
+
+        :param message: The message to send.
+        :type message: MessageStruct
+
+        :raises ConnectionError: If the message couldn't be delivered after
+            all of the attempts.
+        """
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        parts = encode_message_parts(message, codec=self._codec)
+        async with self._in_flight:
+            delay = self._reconnect_delay
+            for attempt in range(1, self._retries + 1):
+                try:
+                    await self._send_once(parts=parts)
+                    self._available = True
+                    return
+                except (ConnectionError, OSError) as err:
+                    self._available = False
+                    self._logger.emit(
+                        "WARNING",
+                        (
+                            "Failed to deliver message to %s:%s (attempt %s): "
+                            "%r"
+                        ),
+                        self._local_ip,
+                        self._local_port,
+                        attempt,
+                        err,
+                    )
+                    await asyncio.sleep(delay)
+                    delay *= 2
+        raise ConnectionError(
+            f"Server {self._local_ip}:{self._local_port} is unreachable"
+        )
+
+    async def close(self) -> None:
+        """
+        Closes the connection. Unacknowledged messages are failed.
+        """
+        if self._writer is not None:
+            self._reset(writer=self._writer)
+
+    async def _send_once(self, parts: List[bytes]) -> None:
+        writer = await self._ensure_connected()
+        stream_id = next(self._stream_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[stream_id] = (writer, future)
+        try:
+            writer.writelines(
+                pack_frame_parts(stream_id=stream_id, parts=parts)
+            )
+            await writer.drain()
+            status = await future
+        except (ConnectionError, OSError):
+            self._reset(writer=writer)
+            raise
+        finally:
+            self._pending.pop(stream_id, None)
+        if status != ACK_OK:
+            raise ValueError(f"Server rejected the message (status {status})")
+
+    async def _ensure_connected(self) -> asyncio.StreamWriter:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self._writer
+            reader, writer = await asyncio.open_connection(
+                self._local_ip, self._local_port
+            )
+            writer.write(HANDSHAKE)
+            self._reader, self._writer = reader, writer
+            self._ack_task = asyncio.create_task(
+                self._ack_loop(reader=reader, writer=writer)
+            )
+            return writer
+
+    async def _ack_loop(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                ack = await read_ack(reader)
+                if ack is None:
+                    break
+                stream_id, status = ack
+                pending = self._pending.get(stream_id)
+                if pending is not None and not pending[1].done():
+                    pending[1].set_result(status)
+        finally:
+            self._reset(writer=writer)
+
+    def _reset(self, writer: asyncio.StreamWriter) -> None:
+        """
+        Closes the connection of the writer and fails the messages sent
+        through it. The current connection is left alone if the writer is
+        an older one, so a sender never tears down a connection another
+        sender has just established.
+        """
+        writer.close()
+        if writer is self._writer:
+            if (
+                self._ack_task is not None
+                and self._ack_task is not asyncio.current_task()
+            ):
+                self._ack_task.cancel()
+            self._ack_task = None
+            self._reader, self._writer = None, None
+        for pending_writer, future in self._pending.values():
+            if pending_writer is writer and not future.done():
+                future.set_exception(ConnectionResetError("Connection lost"))
+
+
+class ConnectionsPool:
+    """
+    A pool of persistent connections to the server. Messages of a user are
+    always sent through the same connection, chosen by the hash of
+    (messenger, user_id), so the server receives them in order. If that
+    connection is unavailable, the least loaded available one is used.
+
+    :param local_ip: The IP address of the server.
+    :type local_ip: str
+
+    :param local_port: The port number of the server.
+    :type local_port: int
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+
+    :param codec: The codec to encode messages with. Defaults to
+        BinaryCodec.
+    :type codec: BaseCodec | None
+    """
+
+    def __init__(
+        self,
+        local_ip: str,
+        local_port: int,
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+        codec: BaseCodec | None = None,
+    ) -> None:
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        if config.SERVER_CONNECTIONS <= 0:
+            raise ValueError("Can't use negative values")
+        self._connections: List[ServerConnection] = [
+            ServerConnection(
+                local_ip=local_ip,
+                local_port=local_port,
+                max_in_flight=config.MAX_IN_FLIGHT_MESSAGES,
+                logger=self._logger,
+                codec=codec,
+            )
+            for _ in range(config.SERVER_CONNECTIONS)
+        ]
+
+    async def send(self, message: MessageStruct) -> None:
+        """
+        Sends the message through the connection of its user.
+
+        :param message: The message to send.
+        :type message: MessageStruct
+        """
+        key = f"{message.messenger}:{message.user_id}".encode()
+        connection = self._connections[
+            zlib.crc32(key) % len(self._connections)
+        ]
+        if not connection.available:
+            connection = min(
+                self._connections,
+                key=lambda connection: (
+                    not connection.available,
+                    connection.in_flight,
+                ),
+            )
+        await connection.send(message=message)
+
+    async def close(self) -> None:
+        """
+        Closes all of the connections of the pool.
+        """
+        for connection in self._connections:
+            await connection.close()
@@ -0,0 +1,195 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List
+
+
+class DispatcherClosedError(RuntimeError):
+    """
+    Raised when a job is dispatched to a closing dispatcher.
+    """
+
+
+@dataclass()
+class _Job:
+    func: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+
+
+@dataclass()
+class DispatcherStats:
+    """
+    A snapshot of the state of a dispatcher.
+
+    :param workers: The amount of workers of the dispatcher.
+    :type workers: int
+
+    :param busy_workers: The amount of workers processing a job.
+    :type busy_workers: int
+
+    :param queued: The amount of jobs in all of the shards, including the
+        running ones.
+    :type queued: int
+
+    :param shards: The amount of shards with waiting or running jobs.
+    :type shards: int
+    """
+
+    workers: int
+    busy_workers: int
+    queued: int
+    shards: int
+
+
+class Dispatcher:
+    """
+    Runs jobs on a bounded pool of workers, one job of the same key at a
+    time.
+
+    Jobs are sharded by key into serial queues. Jobs of the same key run in
+    the order they were dispatched and never at the same time, while jobs
+    of different keys run in parallel on up to `workers` workers. Shards
+    with waiting jobs are served in turn.
+
+    :param workers: The maximum amount of jobs running at once.
+    :type workers: int
+    """
+
+    def __init__(self, workers: int) -> None:
+        if workers <= 0:
+            raise ValueError("Can't use negative values")
+        self._workers_amount = workers
+        self._shards: Dict[Hashable, Deque[_Job]] = {}
+        self._ready: asyncio.Queue | None = None
+        self._workers: List[asyncio.Task] = []
+        self._busy_workers = 0
+        self._closing = False
+
+    @property
+    def stats(self) -> DispatcherStats:
+        """
+        The current stats of the dispatcher.
+        """
+        return DispatcherStats(
+            workers=self._workers_amount,
+            busy_workers=self._busy_workers,
+            queued=sum(len(jobs) for jobs in self._shards.values()),
+            shards=len(self._shards),
+        )
+
+    def queue_depth(self, key: Hashable) -> int:
+        """
+        Returns the amount of jobs of the shard, including the running one.
+
+        :param key: The key of the shard.
+        :type key: Hashable
+
+        :rtype: int
+        """
+        jobs = self._shards.get(key)
+        return len(jobs) if jobs != None else 0
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        """
+        Returns the amount of jobs of every active shard, including the
+        running ones.
+
+        :rtype: Dict[Hashable, int]
+        """
+        return {key: len(jobs) for key, jobs in self._shards.items()}
+
+    def start(self) -> None:
+        """
+        Starts the workers.
+        """
+        if self._workers:
+            return
+        self._ready = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._work_loop())
+            for _ in range(self._workers_amount)
+        ]
+
+    async def close(self, timeout: float | None = None) -> None:
+        """
+        Stops accepting jobs, waits for the queued ones to finish and stops
+        the workers. Jobs that didn't finish within the timeout are
+        cancelled.
+
+        :param timeout: The maximum time (in seconds) to wait for the
+            queued jobs. Defaults to None (no limit).
+        :type timeout: float | None
+        """
+        self._closing = True
+        futures = [
+            job.future for jobs in self._shards.values() for job in jobs
+        ]
+        if futures and self._workers:
+            await asyncio.wait(futures, timeout=timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for jobs in self._shards.values():
+            for job in jobs:
+                job.future.cancel()
+        self._shards = {}
+        self._closing = False
+
+    async def dispatch(
+        self, key: Hashable, func: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Queues the job in the shard of the key and waits for its result.
+
+        :param key: The key of the shard, for example (messenger, user_id).
+        :type key: Hashable
+
+        :param func: A function that returns the awaitable of the job.
+        :type func: Callable[[], Awaitable[Any]]
+
+        :return: The result of the job.
+        :rtype: Any
+
+        :raises DispatcherClosedError: If the dispatcher is closing.
+        """
+        if self._closing:
+            raise DispatcherClosedError("Dispatcher is closing")
+        self.start()
+        job = _Job(
+            func=func, future=asyncio.get_running_loop().create_future()
+        )
+        jobs = self._shards.get(key)
+        if jobs == None:
+            self._shards[key] = deque([job])
+            self._ready.put_nowait(key)
+        else:
+            jobs.append(job)
+        return await job.future
+
+    async def _work_loop(self) -> None:
+        while True:
+            key = await self._ready.get()
+            jobs = self._shards[key]
+            job = jobs[0]
+            self._busy_workers += 1
+            try:
+                if not job.future.done():
+                    result = await job.func()
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as err:
+                if not job.future.done():
+                    job.future.set_exception(err)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._busy_workers -= 1
+                jobs.popleft()
+                if jobs:
+                    self._ready.put_nowait(key)
+                elif self._shards.get(key) is jobs:
+                    del self._shards[key]
@@ -0,0 +1,523 @@
+import asyncio
+import bisect
+import os
+import struct
+import zlib
+from typing import Awaitable, BinaryIO, Callable, Dict, List, Set, Tuple
+
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.bot.struct import MessageStruct
+from pybotterfly.bot.converters import (
+    BaseCodec,
+    decode_message,
+    encode_message_parts,
+)
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+
+# Length and crc32 of the record
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".log"
+COMMIT_FILE_NAME = "commit"
+DEAD_LETTER_FILE_NAME = "dead_letter"
+MAX_RETRY_DELAY = 5.0
+
+_Record = Tuple[int, bytes]
+_QueuedMessage = Tuple[int, bytes, MessageStruct]
+
+
+class SegmentLog:
+    """
+    An append-only log of records split into segment files.
+
+    Every record gets an offset, the sequence number of the record in the
+    log. Records are written with their length and crc32, appends are made
+    durable with a single fsync per `fsync_interval`, and the log is
+    truncated to the last valid record when it's opened. A new segment is
+    started when the current one reaches `segment_size` bytes. Segments
+    are deleted once all of their records are committed.
+
+    :param directory: The directory of the segment files. It's created if
+        it doesn't exist.
+    :type directory: str
+
+    :param segment_size: The size (in bytes) of a segment. Defaults to
+        64 MB.
+    :type segment_size: int
+
+    :param fsync_interval: The time (in seconds) appends are collected for
+        before being synced to the disk together. Defaults to 0.005.
+    :type fsync_interval: float
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = 64 * 1024 * 1024,
+        fsync_interval: float = 0.005,
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+    ) -> None:
+        if segment_size <= 0 or fsync_interval < 0:
+            raise ValueError("Can't use negative values")
+        self._directory = directory
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        os.makedirs(directory, exist_ok=True)
+        self._committed_offset = self._read_commit()
+        self._segments: List[int] = []
+        self._next_offset = self._committed_offset
+        self._recover()
+        self._durable_offset = self._next_offset
+        self._file: BinaryIO = open(self._get_path(self._segments[-1]), "ab")
+        self._active_size = self._file.tell()
+        self._rolled_files: List[BinaryIO] = []
+        self._waiters: List[asyncio.Future] = []
+        self._sync_task: asyncio.Task | None = None
+        self._read_file: BinaryIO | None = None
+        self._read_base: int | None = None
+        self._read_offset = self._committed_offset
+
+    @property
+    def committed_offset(self) -> int:
+        """
+        The offset of the first record that isn't committed.
+        """
+        return self._committed_offset
+
+    @property
+    def durable_offset(self) -> int:
+        """
+        The offset of the first record that isn't synced to the disk.
+        """
+        return self._durable_offset
+
+    async def append(self, data: bytes) -> int:
+        """
+        Appends the record and waits until it's synced to the disk.
+
+        :param data: The record.
+        :type data: bytes
+
+        :return: The offset of the record.
+        :rtype: int
+        """
+        if self._active_size >= self._segment_size:
+            self._roll()
+        offset = self._next_offset
+        self._file.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)))
+        self._file.write(data)
+        self._next_offset += 1
+        self._active_size += RECORD_HEADER.size + len(data)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._sync_task == None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_loop())
+        await waiter
+        return offset
+
+    def read(self, max_records: int) -> List[_Record]:
+        """
+        Reads the next durable records. Every call continues where the
+        previous one stopped, starting from the committed offset.
+
+        :param max_records: The maximum amount of records to read.
+        :type max_records: int
+
+        :return: A list of (offset, record) tuples.
+        :rtype: List[Tuple[int, bytes]]
+        """
+        records = []
+        while (
+            len(records) < max_records
+            and self._read_offset < self._durable_offset
+        ):
+            if self._read_file == None:
+                self._open_reader()
+            header = self._read_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                if self._read_offset not in self._segments:
+                    raise RuntimeError(
+                        f"Record {self._read_offset} is missing from the log"
+                    )
+                self._close_reader()
+                continue
+            length, _ = RECORD_HEADER.unpack(header)
+            records.append((self._read_offset, self._read_file.read(length)))
+            self._read_offset += 1
+        return records
+
+    def commit(self, offset: int) -> None:
+        """
+        Marks the records before the offset as processed. Segments that
+        contain only processed records are deleted.
+
+        :param offset: The offset of the first unprocessed record.
+        :type offset: int
+        """
+        if offset <= self._committed_offset:
+            return
+        self._committed_offset = offset
+        commit_path = os.path.join(self._directory, COMMIT_FILE_NAME)
+        with open(f"{commit_path}.tmp", "w") as commit_file:
+            commit_file.write(str(offset))
+        os.replace(f"{commit_path}.tmp", commit_path)
+        while len(self._segments) > 1 and self._segments[1] <= offset:
+            base = self._segments.pop(0)
+            if self._read_base == base:
+                self._close_reader()
+            os.remove(self._get_path(base))
+
+    async def close(self) -> None:
+        """
+        Syncs the appended records and closes the files of the log.
+        """
+        if self._sync_task != None:
+            await self._sync_task
+        self._close_reader()
+        for segment in self._rolled_files:
+            segment.close()
+        self._rolled_files = []
+        self._file.close()
+
+    def _get_path(self, base: int) -> str:
+        return os.path.join(self._directory, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    def _read_commit(self) -> int:
+        commit_path = os.path.join(self._directory, COMMIT_FILE_NAME)
+        if not os.path.exists(commit_path):
+            return 0
+        with open(commit_path) as commit_file:
+            return int(commit_file.read())
+
+    def _recover(self) -> None:
+        bases = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self._directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for index, base in enumerate(bases):
+            path = self._get_path(base)
+            next_base = bases[index + 1] if index + 1 < len(bases) else None
+            if next_base != None and next_base <= self._committed_offset:
+                os.remove(path)
+                continue
+            records, valid_size = self._scan(path=path)
+            if valid_size != os.path.getsize(path):
+                self._logger.emit(
+                    "WARNING",
+                    "Truncating damaged segment %s after %s records",
+                    path,
+                    records,
+                )
+                with open(path, "r+b") as segment:
+                    segment.truncate(valid_size)
+            self._segments.append(base)
+            self._next_offset = base + records
+            if next_base != None and self._next_offset != next_base:
+                # The records after a damaged one can't be read in order
+                for later_base in bases[index + 1 :]:
+                    os.remove(self._get_path(later_base))
+                break
+        if self._next_offset < self._committed_offset:
+            for base in self._segments:
+                os.remove(self._get_path(base))
+            self._segments = []
+            self._next_offset = self._committed_offset
+        if not self._segments:
+            self._segments.append(self._next_offset)
+            open(self._get_path(self._next_offset), "ab").close()
+
+    def _scan(self, path: str) -> Tuple[int, int]:
+        records = 0
+        valid_size = 0
+        with open(path, "rb") as segment:
+            while True:
+                header = segment.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                data = segment.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+                records += 1
+                valid_size += RECORD_HEADER.size + length
+        return records, valid_size
+
+    def _open_reader(self) -> None:
+        index = bisect.bisect_right(self._segments, self._read_offset) - 1
+        self._read_base = self._segments[index]
+        self._read_file = open(self._get_path(self._read_base), "rb")
+        for _ in range(self._read_offset - self._read_base):
+            length, _ = RECORD_HEADER.unpack(
+                self._read_file.read(RECORD_HEADER.size)
+            )
+            self._read_file.seek(length, os.SEEK_CUR)
+
+    def _close_reader(self) -> None:
+        if self._read_file != None:
+            self._read_file.close()
+        self._read_file = None
+        self._read_base = None
+
+    async def _sync_loop(self) -> None:
+        while self._waiters:
+            await asyncio.sleep(self._fsync_interval)
+            waiters, self._waiters = self._waiters, []
+            files, self._rolled_files = self._rolled_files, []
+            files.append(self._file)
+            durable_offset = self._next_offset
+            try:
+                for segment in files:
+                    segment.flush()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._sync_files, files
+                )
+            except OSError as err:
+                self._rolled_files = files[:-1] + self._rolled_files
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(err)
+                continue
+            for segment in files[:-1]:
+                segment.close()
+            self._durable_offset = durable_offset
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def _sync_files(self, files: List[BinaryIO]) -> None:
+        for segment in files:
+            os.fsync(segment.fileno())
+        if len(files) > 1:
+            # New segment files are durable once the directory is synced
+            directory = os.open(self._directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def _roll(self) -> None:
+        self._file.flush()
+        self._rolled_files.append(self._file)
+        self._segments.append(self._next_offset)
+        self._file = open(self._get_path(self._next_offset), "ab")
+        self._active_size = 0
+
+
+class DurableQueue:
+    """
+    A durable queue of messages to the server.
+
+    `put` returns once the message is synced to the disk, so runners don't
+    wait for the server. A consumer task delivers the queued messages with
+    `send`, the messages of a user one after another in order, and commits
+    them once the server acknowledges them. Messages that couldn't be
+    delivered are retried with a growing delay, and messages left in the
+    queue are delivered after a restart. Messages the server rejected are
+    moved to the `DEAD_LETTER_FILE_NAME` file of the directory, in the
+    format of the segments.
+
+    :param directory: The directory of the queue.
+    :type directory: str
+
+    :param send: A coroutine function that delivers a message to the
+        server and returns once the server acknowledged it.
+    :type send: Callable[[MessageStruct], Awaitable[None]]
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+
+    :param codec: The codec to store messages with. Defaults to
+        BinaryCodec.
+    :type codec: BaseCodec | None
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        send: Callable[[MessageStruct], Awaitable[None]],
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+        codec: BaseCodec | None = None,
+    ) -> None:
+        self._send = send
+        self._codec = codec
+        self._batch_size = config.MAX_IN_FLIGHT_MESSAGES
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        self._log = SegmentLog(
+            directory=directory,
+            segment_size=config.DURABLE_QUEUE_SEGMENT_SIZE,
+            fsync_interval=config.DURABLE_QUEUE_FSYNC_INTERVAL,
+            config=config,
+            logger=self._logger,
+        )
+        self._dead_letter_path = os.path.join(directory, DEAD_LETTER_FILE_NAME)
+        self._consumer: asyncio.Task | None = None
+        self._appended: asyncio.Event | None = None
+        self._drained: asyncio.Event | None = None
+
+    @property
+    def size(self) -> int:
+        """
+        The amount of queued messages that aren't delivered yet.
+        """
+        return self._log.durable_offset - self._log.committed_offset
+
+    def start(self) -> None:
+        """
+        Starts delivering the queued messages.
+        """
+        if self._consumer != None and not self._consumer.done():
+            return
+        self._appended = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._consumer = asyncio.create_task(self._consume_loop())
+
+    async def put(self, message: MessageStruct) -> None:
+        """
+        Adds the message to the queue and waits until it's synced to the
+        disk.
+
+        :param message: The message to deliver to the server.
+        :type message: MessageStruct
+        """
+        self.start()
+        await self._log.append(
+            b"".join(encode_message_parts(message, codec=self._codec))
+        )
+        self._drained.clear()
+        self._appended.set()
+
+    async def join(self) -> None:
+        """
+        Waits until all of the queued messages are delivered.
+        """
+        self.start()
+        await self._drained.wait()
+
+    async def close(self) -> None:
+        """
+        Stops delivering messages and closes the queue. Undelivered
+        messages stay in the queue.
+        """
+        if self._consumer != None:
+            self._consumer.cancel()
+            await asyncio.gather(self._consumer, return_exceptions=True)
+            self._consumer = None
+        await self._log.close()
+
+    async def _consume_loop(self) -> None:
+        while True:
+            self._appended.clear()
+            records = self._log.read(max_records=self._batch_size)
+            if not records:
+                self._drained.set()
+                await self._appended.wait()
+                continue
+            await self._deliver(records=records)
+
+    async def _deliver(self, records: List[_Record]) -> None:
+        delivered: Set[int] = set()
+        # Messages of a user are delivered one after another, so the server
+        # gets them in order, while messages of different users are sent
+        # at once
+        users: Dict[Tuple[str, int], List[_QueuedMessage]] = {}
+        for offset, data in records:
+            try:
+                message = decode_message(data, codec=self._codec)
+            except Exception as err:
+                self._dead_letter(offset=offset, data=data, err=err)
+                delivered.add(offset)
+                continue
+            users.setdefault((message.messenger, message.user_id), []).append(
+                (offset, data, message)
+            )
+        delay = 0.1
+        remaining = len(records)
+        while True:
+            await asyncio.gather(
+                *(
+                    self._deliver_user(messages=messages, delivered=delivered)
+                    for messages in users.values()
+                )
+            )
+            undelivered = [
+                offset for offset, _ in records if offset not in delivered
+            ]
+            # The commit never passes an undelivered message
+            self._log.commit(
+                undelivered[0] if undelivered else records[-1][0] + 1
+            )
+            if not undelivered:
+                return
+            if len(undelivered) < remaining:
+                # The server is reachable, only the failed messages wait
+                delay = 0.1
+            remaining = len(undelivered)
+            self._logger.emit(
+                "WARNING",
+                (
+                    "Failed to deliver %s queued messages, retrying in %s "
+                    "seconds"
+                ),
+                len(undelivered),
+                delay,
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    async def _deliver_user(
+        self, messages: List[_QueuedMessage], delivered: Set[int]
+    ) -> None:
+        for offset, data, message in messages:
+            if offset in delivered:
+                continue
+            try:
+                await self._send(message)
+            except (ConnectionError, OSError):
+                # The later messages of the user wait for this one
+                return
+            except Exception as err:
+                self._dead_letter(offset=offset, data=data, err=err)
+            delivered.add(offset)
+
+    def _dead_letter(self, offset: int, data: bytes, err: Exception) -> None:
+        self._logger.emit(
+            "ERROR",
+            "Moving queued message %s to %s: %r",
+            offset,
+            self._dead_letter_path,
+            err,
+        )
+        try:
+            with open(self._dead_letter_path, "ab") as dead_letter:
+                dead_letter.write(
+                    RECORD_HEADER.pack(len(data), zlib.crc32(data))
+                )
+                dead_letter.write(data)
+        except OSError as write_err:
+            self._logger.emit(
+                "ERROR",
+                "Failed to write queued message %s to %s, dropping it: %r",
+                offset,
+                self._dead_letter_path,
+                write_err,
+            )
@@ -0,0 +1,239 @@
+import asyncio
+import struct
+import tempfile
+from dataclasses import dataclass, field
+from typing import Any, List, Tuple
+
+from pybotterfly.bot.converters import (
+    BaseCodec,
+    BinaryCodec,
+    DeferredBuffers,
+    get_codec,
+)
+
+HANDSHAKE = b"PBF\x01"
+FRAME_HEADER = struct.Struct(">QI")
+ACK = struct.Struct(">QB")
+READ_CHUNK_SIZE = 2**16
+
+ACK_OK = 0
+ACK_ERROR = 1
+
+
+class FrameError(ConnectionError):
+    """
+    Raised when a frame is malformed and the rest of the connection can't
+    be read.
+    """
+
+
+def pack_frame_parts(stream_id: int, parts: List[bytes]) -> List[bytes]:
+    """
+    Packs the parts of an encoded message into a length-prefixed frame
+    without joining them.
+
+    :param stream_id: The ID of the message inside of the connection.
+    :type stream_id: int
+
+    :param parts: The parts of the encoded message.
+    :type parts: List[bytes]
+
+    :return: The parts of the frame ready to be written to the connection.
+    :rtype: List[bytes]
+    """
+    length = sum(len(part) for part in parts)
+    return [FRAME_HEADER.pack(stream_id, length), *parts]
+
+
+async def read_frame_header(
+    reader: asyncio.StreamReader,
+) -> Tuple[int, int] | None:
+    """
+    Reads the header of a frame from the connection.
+
+    :param reader: The reader of the connection.
+    :type reader: asyncio.StreamReader
+
+    :return: A tuple of the stream ID and the length of the payload, or None
+        if the connection was closed between frames.
+    :rtype: Tuple[int, int] | None
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as err:
+        if err.partial == b"":
+            return None
+        raise
+    return FRAME_HEADER.unpack(header)
+
+
+@dataclass()
+class IncomingMessage:
+    """
+    A message which body was received and decoded, while its attachments
+    may still be waiting on the connection.
+
+    :param message: The decoded message.
+
+    :param buffer_lengths: The lengths of the attachments that weren't
+        received yet.
+    :type buffer_lengths: List[int]
+
+    :param deferred: The fields of the message that wait for the
+        attachments.
+    :type deferred: DeferredBuffers | None
+    """
+
+    message: Any
+    buffer_lengths: List[int] = field(default_factory=list)
+    deferred: DeferredBuffers | None = None
+
+
+async def read_message(
+    reader: asyncio.StreamReader, length: int, codec: BaseCodec | None = None
+) -> IncomingMessage:
+    """
+    Reads the beginning of the payload of a frame and decodes it. For the
+    binary codec only the body of the message is read, the attachments have
+    to be read with :func:`read_attachments` before reading the next frame.
+
+    :param reader: The reader of the connection.
+    :type reader: asyncio.StreamReader
+
+    :param length: The length of the payload.
+    :type length: int
+
+    :param codec: An additional codec to decode the message with.
+    :type codec: BaseCodec | None
+
+    :return: The decoded message.
+    :rtype: IncomingMessage
+
+    :raises FrameError: If the payload doesn't match its length.
+    :raises ValueError: If the payload was read but couldn't be decoded.
+    """
+    if length < 1:
+        raise FrameError("Empty frame")
+    head = await reader.readexactly(1)
+    try:
+        message_codec = get_codec(version=head[0], codec=codec)
+    except ValueError:
+        await skip(reader=reader, length=length - 1)
+        raise
+    if not isinstance(message_codec, BinaryCodec):
+        return IncomingMessage(
+            message=message_codec.decode(
+                head + await reader.readexactly(length - 1)
+            )
+        )
+    head += await reader.readexactly(message_codec.head_size(0) - 1)
+    head_size = message_codec.head_size(message_codec.buffers_amount(head))
+    if head_size > length:
+        raise FrameError("Malformed frame head")
+    head += await reader.readexactly(head_size - len(head))
+    body_length, buffer_lengths = message_codec.read_head(data=head)
+    if head_size + body_length + sum(buffer_lengths) != length:
+        raise FrameError("Frame length doesn't match its payload")
+    body = await reader.readexactly(body_length)
+    try:
+        message, deferred = message_codec.decode_deferred(body=body)
+    except Exception:
+        await skip(reader=reader, length=sum(buffer_lengths))
+        raise
+    return IncomingMessage(
+        message=message, buffer_lengths=buffer_lengths, deferred=deferred
+    )
+
+
+async def read_attachments(
+    reader: asyncio.StreamReader,
+    incoming: IncomingMessage,
+    spool_size: int,
+) -> None:
+    """
+    Reads the attachments of the message and sets them to the message.
+    Attachments larger than `spool_size` are received in chunks into a
+    temporary file and loaded with a single allocation once complete, so
+    the receive buffer never holds the whole attachment.
+
+    :param reader: The reader of the connection.
+    :type reader: asyncio.StreamReader
+
+    :param incoming: The message which attachments should be read.
+    :type incoming: IncomingMessage
+
+    :param spool_size: The size (in bytes) starting from which attachments
+        are spilled to a temporary file.
+    :type spool_size: int
+    """
+    buffers = []
+    for length in incoming.buffer_lengths:
+        if length < spool_size:
+            buffers.append(await reader.readexactly(length))
+            continue
+        with tempfile.TemporaryFile() as spool:
+            remaining = length
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, READ_CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(
+                        partial=b"", expected=remaining
+                    )
+                spool.write(chunk)
+                remaining -= len(chunk)
+            spool.seek(0)
+            buffers.append(spool.read(length))
+    if incoming.deferred is not None:
+        incoming.deferred.fill(buffers=buffers)
+        incoming.message = incoming.deferred.value
+
+
+async def skip(reader: asyncio.StreamReader, length: int) -> None:
+    """
+    Reads and drops the given amount of bytes from the connection.
+
+    :param reader: The reader of the connection.
+    :type reader: asyncio.StreamReader
+
+    :param length: The amount of bytes to drop.
+    :type length: int
+    """
+    while length > 0:
+        chunk = await reader.read(min(length, READ_CHUNK_SIZE))
+        if not chunk:
+            raise asyncio.IncompleteReadError(partial=b"", expected=length)
+        length -= len(chunk)
+
+
+def pack_ack(stream_id: int, status: int = ACK_OK) -> bytes:
+    """
+    Packs an acknowledgement of the received frame.
+
+    :param stream_id: The ID of the acknowledged message.
+    :type stream_id: int
+
+    :param status: The status of the acknowledged message. Defaults to ACK_OK.
+    :type status: int
+
+    :return: The acknowledgement ready to be written to the connection.
+    :rtype: bytes
+    """
+    return ACK.pack(stream_id, status)
+
+
+async def read_ack(reader: asyncio.StreamReader) -> Tuple[int, int] | None:
+    """
+    Reads a single acknowledgement from the connection.
+
+    :param reader: The reader of the connection.
+    :type reader: asyncio.StreamReader
+
+    :return: A tuple of the stream ID and the status, or None if the
+        connection was closed.
+    :rtype: Tuple[int, int] | None
+    """
+    try:
+        data = await reader.readexactly(ACK.size)
+    except asyncio.IncompleteReadError:
+        return None
+    return ACK.unpack(data)
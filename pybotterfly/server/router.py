@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import hashlib
+from typing import Dict, List, Set, Tuple
+
+from pybotterfly.base_config import BaseConfig
+from pybotterfly.bot.struct import MessageStruct
+from pybotterfly.bot.converters import BaseCodec
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
+from pybotterfly.server.struct import ServerData, ServersList
+from pybotterfly.server.server_func import send_to_server
+from pybotterfly.server.connection import ConnectionsPool
+from pybotterfly.server.protocol import HANDSHAKE
+
+_ServerKey = Tuple[str, int]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+    )
+
+
+class ServersRouter:
+    """
+    Routes messages to the servers of a `ServersList` by consistent hashing
+    on (messenger, user_id).
+
+    Every server is placed on a hash ring `virtual_nodes` times. A message
+    is sent to the first server clockwise from the hash of its user, so the
+    messages of a user always reach the same server, and adding or removing
+    a server only moves the users of its ring segments.
+
+    A server that fails to receive a message is marked as unavailable and
+    its users are sent to the next server on the ring. Unavailable servers
+    are checked every `health_check_interval` seconds and receive their
+    users back once they accept connections again.
+
+    :param servers: The servers to route messages to.
+    :type servers: ServersList
+
+    :param config: An instance of the BaseConfig class that represents the
+        base configuration options for the bot.
+    :type config: BaseConfig
+
+    :param logger: An instance of the BaseLogger class that represents the
+        base logger for the bot.
+    :type logger: BaseLogger | None
+
+    :param codec: The codec to encode messages with. Defaults to
+        BinaryCodec.
+    :type codec: BaseCodec | None
+    """
+
+    def __init__(
+        self,
+        servers: ServersList,
+        config: BaseConfig = BaseConfig,
+        logger: BaseLogger | None = None,
+        codec: BaseCodec | None = None,
+    ) -> None:
+        if config.SERVER_VIRTUAL_NODES <= 0:
+            raise ValueError("Can't use negative values")
+        if config.SERVER_HEALTH_CHECK_INTERVAL <= 0:
+            raise ValueError("Can't use negative values")
+        self._servers = servers
+        self._config = config
+        self._codec = codec
+        self._logger = (
+            logger if logger != None else DefaultLogger(config=config)
+        )
+        self._virtual_nodes = config.SERVER_VIRTUAL_NODES
+        self._health_check_interval = config.SERVER_HEALTH_CHECK_INTERVAL
+        self._ring_hashes: List[int] = []
+        self._ring_servers: List[ServerData] = []
+        self._ring_version: int | None = None
+        self._pools: Dict[_ServerKey, ConnectionsPool] = {}
+        self._unavailable: Set[_ServerKey] = set()
+        self._health_task: asyncio.Task | None = None
+
+    @property
+    def unavailable_servers(self) -> List[ServerData]:
+        """
+        The servers that are currently skipped because of failures.
+        """
+        return [
+            server
+            for server in self._servers.servers
+            if self._get_key(server) in self._unavailable
+        ]
+
+    def get_server(self, message: MessageStruct) -> ServerData:
+        """
+        Returns the server the message is sent to.
+
+        :param message: The message to route.
+        :type message: MessageStruct
+
+        :rtype: ServerData
+
+        :raises RuntimeError: If the servers list is empty.
+        """
+        return self._get_candidates(message=message)[0]
+
+    async def send(self, message: MessageStruct) -> None:
+        """
+        Sends the message to the server of its user. Unavailable servers
+        are skipped in favour of the next ones on the ring.
+
+        :param message: The message to send.
+        :type message: MessageStruct
+
+        :raises ConnectionError: If none of the servers received the
+            message.
+        """
+        last_error = None
+        for server in self._get_candidates(message=message):
+            try:
+                await self._send_to(server=server, message=message)
+            except (ConnectionError, OSError) as err:
+                last_error = err
+                self._mark_unavailable(server=server, err=err)
+                continue
+            self._mark_available(server=server)
+            return
+        raise ConnectionError(
+            "None of the servers is reachable"
+        ) from last_error
+
+    async def close(self) -> None:
+        """
+        Stops the health checks and closes the connections to the servers.
+        """
+        if self._health_task != None:
+            self._health_task.cancel()
+            self._health_task = None
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools = {}
+
+    def _get_key(self, server: ServerData) -> _ServerKey:
+        return (server.server_ip, server.server_port)
+
+    def _build_ring(self) -> None:
+        points = []
+        for server in self._servers.servers:
+            for node in range(self._virtual_nodes):
+                points.append(
+                    (
+                        _hash(
+                            f"{server.server_ip}:{server.server_port}#{node}"
+                        ),
+                        server,
+                    )
+                )
+        points.sort(key=lambda point: point[0])
+        self._ring_hashes = [point[0] for point in points]
+        self._ring_servers = [point[1] for point in points]
+        self._ring_version = self._servers._version
+
+    def _get_candidates(self, message: MessageStruct) -> List[ServerData]:
+        if self._ring_version != self._servers._version:
+            self._build_ring()
+        if not self._ring_servers:
+            raise RuntimeError("Servers list is empty")
+        position = bisect.bisect(
+            self._ring_hashes, _hash(f"{message.messenger}:{message.user_id}")
+        )
+        available = []
+        unavailable = []
+        seen = set()
+        for index in range(len(self._ring_servers)):
+            server = self._ring_servers[
+                (position + index) % len(self._ring_servers)
+            ]
+            key = self._get_key(server)
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in self._unavailable:
+                unavailable.append(server)
+            else:
+                available.append(server)
+            if len(seen) == len(self._servers.servers):
+                break
+        return available + unavailable
+
+    async def _send_to(
+        self, server: ServerData, message: MessageStruct
+    ) -> None:
+        if not self._config.PERSISTENT_CONNECTION:
+            await send_to_server(
+                message=message,
+                local_ip=server.server_ip,
+                local_port=server.server_port,
+                codec=self._codec,
+            )
+            return
+        key = self._get_key(server)
+        pool = self._pools.get(key)
+        if pool == None:
+            pool = ConnectionsPool(
+                local_ip=server.server_ip,
+                local_port=server.server_port,
+                config=self._config,
+                logger=self._logger,
+                codec=self._codec,
+            )
+            self._pools[key] = pool
+        await pool.send(message=message)
+
+    def _mark_unavailable(self, server: ServerData, err: Exception) -> None:
+        key = self._get_key(server)
+        if key in self._unavailable:
+            return
+        self._unavailable.add(key)
+        self._logger.emit(
+            "WARNING",
+            (
+                "Server %s:%s is unavailable, its users are sent "
+                "to the next servers: %r"
+            ),
+            server.server_ip,
+            server.server_port,
+            err,
+        )
+        if self._health_task == None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    def _mark_available(self, server: ServerData) -> None:
+        key = self._get_key(server)
+        if key not in self._unavailable:
+            return
+        self._unavailable.discard(key)
+        self._logger.emit(
+            "INFO",
+            "Server %s:%s is available again",
+            server.server_ip,
+            server.server_port,
+        )
+
+    async def _health_loop(self) -> None:
+        while self._unavailable:
+            await asyncio.sleep(self._health_check_interval)
+            for server in self.unavailable_servers:
+                if await self._check(server=server):
+                    self._mark_available(server=server)
+            current = {
+                self._get_key(server) for server in self._servers.servers
+            }
+            self._unavailable &= current
+
+    async def _check(self, server: ServerData) -> bool:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(server.server_ip, server.server_port),
+                timeout=self._health_check_interval,
+            )
+        except (asyncio.TimeoutError, OSError):
+            return False
+        writer.write(HANDSHAKE)
+        writer.write_eof()
+        writer.close()
+        return True
@@ -1,14 +1,41 @@
 import asyncio
+import multiprocessing
+import signal
+import socket
+import time
 from datetime import datetime
+from typing import Any, List, Set
 from pybotterfly.base_config import BaseConfig
 from pybotterfly.bot.converters import (
-    bytes_to_dataclass,
-    string_to_file,
+    BaseCodec,
+    decode_message,
 )
 from pybotterfly.bot.returns.message import Return
+from pybotterfly.bot.struct import MessageStruct
 from pybotterfly.bot.reply.reply_division import MessengersDivision
+from pybotterfly.bot.reply.coalescing import coalesce_returns, group_by_user
 from pybotterfly.message_handler.message_handler import MessageHandler
-from pybotterfly.bot.logger import Log, DefaultLogger, BaseLogger
+from pybotterfly.bot.logger import DefaultLogger, BaseLogger
+from pybotterfly.bot.downloaders import close_default_downloader
+from pybotterfly.bot.metrics import MetricsServer, get_metrics
+from pybotterfly.bot.tracing import get_tracer, trace_span, use_trace_id
+from pybotterfly.server.dispatcher import Dispatcher, DispatcherClosedError
+from pybotterfly.server.protocol import (
+    HANDSHAKE,
+    ACK_OK,
+    ACK_ERROR,
+    READ_CHUNK_SIZE,
+    read_frame_header,
+    read_message,
+    read_attachments,
+    skip,
+    pack_ack,
+)
+
+WORKER_SHUTDOWN_TIMEOUT = 10
+# Shorter than WORKER_SHUTDOWN_TIMEOUT, so workers finish draining before
+# they are killed
+DRAIN_TIMEOUT = 5
 
 
 class Server:
@@ -18,11 +45,40 @@ class Server:
         message_handler: MessageHandler,
         base_config: BaseConfig,
         logger: BaseLogger,
+        codec: BaseCodec | None = None,
     ) -> None:
         self._messengers = messengers
         self._message_handler = message_handler
         self._config = base_config
         self._logger = logger
+        self._codec = codec
+        self._dispatcher = Dispatcher(workers=base_config.DISPATCHER_WORKERS)
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._metrics = get_metrics(config=base_config)
+        self._tracer = get_tracer(config=base_config)
+        self._metrics_port = base_config.METRICS_PORT
+        if self._metrics != None:
+            self._requests = self._metrics.counter(
+                "pybotterfly_requests",
+                "Messages processed by the server",
+                labels=("messenger",),
+            )
+            self._request_errors = self._metrics.counter(
+                "pybotterfly_request_errors",
+                "Messages that resulted in an error",
+                labels=("messenger",),
+            )
+            self._handler_seconds = self._metrics.histogram(
+                "pybotterfly_handler_seconds",
+                "Time (in seconds) of getting the replies to a message",
+                labels=("messenger",),
+            )
+            self._request_seconds = self._metrics.histogram(
+                "pybotterfly_request_seconds",
+                "Time (in seconds) of processing a message and sending its "
+                "replies",
+                labels=("messenger",),
+            )
         self._check_errors()
 
     def _check_errors(self) -> None:
@@ -38,103 +94,446 @@ class Server:
         reader: asyncio.streams.StreamReader,
         writer: asyncio.streams.StreamWriter,
     ) -> None:
-        tasks = []
-        byte_array = bytearray()
+        try:
+            head = await reader.readexactly(len(HANDSHAKE))
+        except asyncio.IncompleteReadError as err:
+            head = err.partial
+        if head == HANDSHAKE:
+            await self._handle_persistent(reader=reader, writer=writer)
+        else:
+            await self._handle_oneshot(head=head, reader=reader, writer=writer)
+
+    async def _handle_oneshot(
+        self,
+        head: bytes,
+        reader: asyncio.streams.StreamReader,
+        writer: asyncio.streams.StreamWriter,
+    ) -> None:
+        byte_array = bytearray(head)
         while True:
-            data = await reader.read()
+            data = await reader.read(READ_CHUNK_SIZE)
             if not data:
                 break
             byte_array.extend(data)
+            if len(byte_array) > self._config.MAX_MESSAGE_SIZE:
+                self._logger.emit(
+                    "ERROR",
+                    "Message from %r exceeds %s bytes",
+                    writer.get_extra_info("peername"),
+                    self._config.MAX_MESSAGE_SIZE,
+                )
+                writer.close()
+                return
         if byte_array == bytearray():
-            self._logger.log(
-                log=Log(level="ERROR", text=(f"Received empty byte array"))
-            )
+            self._logger.emit("ERROR", "Received empty byte array")
             return
-        message_cls = bytes_to_dataclass(byte_array)
-        if message_cls.files != []:
-            for encoded_file in message_cls.files:
-                encoded_file.file_bytes = string_to_file(
-                    encoded_file.file_bytes
-                )
+        message_cls = decode_message(byte_array, codec=self._codec)
+        await self._dispatch(
+            message_cls=message_cls, addr=writer.get_extra_info("peername")
+        )
+        writer.close()
+
+    async def _handle_persistent(
+        self,
+        reader: asyncio.streams.StreamReader,
+        writer: asyncio.streams.StreamWriter,
+    ) -> None:
         addr = writer.get_extra_info("peername")
-        receive_time = datetime.now()
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                time=receive_time,
-                text=(f"Received {message_cls!r} from {addr!r}"),
+        in_flight = asyncio.Semaphore(self._config.MAX_IN_FLIGHT_MESSAGES)
+        tasks = set()
+        self._connections.add(writer)
+        try:
+            while True:
+                await in_flight.acquire()
+                header = await read_frame_header(reader)
+                if header is None:
+                    in_flight.release()
+                    break
+                stream_id, length = header
+                if length > self._config.MAX_MESSAGE_SIZE:
+                    in_flight.release()
+                    self._logger.emit(
+                        "ERROR",
+                        "Message from %r exceeds %s bytes",
+                        addr,
+                        self._config.MAX_MESSAGE_SIZE,
+                    )
+                    await skip(reader=reader, length=length)
+                    writer.write(
+                        pack_ack(stream_id=stream_id, status=ACK_ERROR)
+                    )
+                    continue
+                try:
+                    incoming = await read_message(
+                        reader=reader, length=length, codec=self._codec
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    in_flight.release()
+                    raise
+                except Exception as err:
+                    in_flight.release()
+                    self._logger.emit(
+                        "ERROR",
+                        "Failed to decode frame from %r: %r",
+                        addr,
+                        err,
+                    )
+                    writer.write(
+                        pack_ack(stream_id=stream_id, status=ACK_ERROR)
+                    )
+                    continue
+                attachments = None
+                if incoming.buffer_lengths:
+                    attachments = asyncio.get_running_loop().create_future()
+                task = asyncio.create_task(
+                    self._dispatch_and_ack(
+                        stream_id=stream_id,
+                        message_cls=incoming.message,
+                        addr=addr,
+                        writer=writer,
+                        attachments=attachments,
+                    )
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: in_flight.release())
+                if attachments is not None:
+                    try:
+                        await read_attachments(
+                            reader=reader,
+                            incoming=incoming,
+                            spool_size=self._config.SPOOL_FILE_SIZE,
+                        )
+                    except BaseException:
+                        attachments.set_exception(
+                            ConnectionResetError("Files weren't received")
+                        )
+                        raise
+                    attachments.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            self._logger.emit(
+                "WARNING", "Connection with %r was lost: %r", addr, err
             )
+        finally:
+            self._connections.discard(writer)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+    async def _dispatch_and_ack(
+        self,
+        stream_id: int,
+        message_cls: MessageStruct,
+        addr,
+        writer: asyncio.streams.StreamWriter,
+        attachments: asyncio.Future | None = None,
+    ) -> None:
+        """
+        Processes the message and acknowledges it only then, so a sender
+        never drops a message the server didn't process. Messages left
+        unprocessed on shutdown aren't acknowledged and are sent again by
+        the sender.
+        """
+        status = ACK_OK
+        try:
+            await self._dispatch(
+                message_cls=message_cls, addr=addr, attachments=attachments
+            )
+        except DispatcherClosedError:
+            return
+        except Exception as err:
+            self._logger.emit(
+                "ERROR",
+                "Failed to process %r from %r: %r",
+                message_cls,
+                addr,
+                err,
+            )
+            status = ACK_ERROR
+        if not writer.is_closing():
+            writer.write(pack_ack(stream_id=stream_id, status=status))
+
+    async def _dispatch(
+        self,
+        message_cls: MessageStruct,
+        addr,
+        attachments: asyncio.Future | None = None,
+    ) -> None:
+        """
+        Processes the message after the previous messages of the same user,
+        so the user's stage is never changed by two messages at once.
+        """
+        await self._dispatcher.dispatch(
+            key=(message_cls.messenger, message_cls.user_id),
+            func=lambda: self._process(
+                message_cls=message_cls, addr=addr, attachments=attachments
+            ),
         )
-        self._logger.log(
-            log=Log(
-                level="INFO",
+
+    async def _process(
+        self,
+        message_cls: MessageStruct,
+        addr,
+        attachments: asyncio.Future | None = None,
+    ) -> None:
+        with use_trace_id(message_cls.trace_id), trace_span(
+            self._tracer, "server.process", messenger=message_cls.messenger
+        ):
+            tasks = []
+            start_time = time.perf_counter()
+            receive_time = datetime.now()
+            self._logger.emit(
+                "INFO",
+                "Received %r from %r",
+                message_cls,
+                addr,
                 time=receive_time,
-                text=(f"Fetching {message_cls} started"),
             )
-        )
-        return_cls = await self._message_handler.get(message_class=message_cls)
-        self._logger.log(
-            log=Log(level="INFO", text=(f"Fetching {message_cls} finished"))
-        )
-        if not return_cls:
-            self._logger.log(
-                log=Log(
-                    level="ERROR",
-                    text=(
-                        f"An incorrect request resulted in an error. "
-                        f"Request skipped. Return_cls: {return_cls}"
+            self._logger.emit(
+                "INFO", "Fetching %s started", message_cls, time=receive_time
+            )
+            with trace_span(self._tracer, "message_handler.get"):
+                return_cls = await self._message_handler.get(
+                    message_class=message_cls,
+                    attachments=attachments,
+                    file_resolver=self._messengers.resolve_files,
+                )
+            self._logger.emit("INFO", "Fetching %s finished", message_cls)
+            if self._metrics != None:
+                self._handler_seconds.observe(
+                    time.perf_counter() - start_time, message_cls.messenger
+                )
+            if not return_cls:
+                if self._metrics != None:
+                    self._request_errors.inc(message_cls.messenger)
+                self._logger.emit(
+                    "ERROR",
+                    (
+                        "An incorrect request resulted in an error. "
+                        "Request skipped. Return_cls: %s"
                     ),
+                    return_cls,
+                )
+                return
+            for user_returns in group_by_user(returns=return_cls.returns):
+                if self._config.REPLY_COALESCE:
+                    user_returns = coalesce_returns(
+                        returns=user_returns,
+                        max_text_length=self._config.REPLY_MAX_TEXT_LENGTH,
+                        max_attachments=self._config.REPLY_MAX_ATTACHMENTS,
+                    )
+                task = asyncio.create_task(
+                    self._reply_in_order(returns=user_returns)
+                )
+                tasks.append(task)
+            await asyncio.gather(*tasks)
+            if self._metrics != None:
+                self._requests.inc(message_cls.messenger)
+                self._request_seconds.observe(
+                    time.perf_counter() - start_time, message_cls.messenger
                 )
-            )
-            return
-        for return_message in return_cls.returns:
-            task = asyncio.create_task(
-                self.replier(return_message=return_message)
-            )
-            tasks.append(task)
-        await asyncio.gather(*tasks)
-        writer.close()
+
+    async def _reply_in_order(self, returns: List[Return]) -> None:
+        for return_message in returns:
+            await self.replier(return_message=return_message)
 
     async def replier(self, return_message: Return):
         await self._messengers.get_func(return_message=return_message)
         if self._config.DEBUG_STATE:
-            self._logger.log(
-                log=Log(
-                    level="INFO",
-                    text=(
-                        f"Result message\n{' Output ':=^20}"
-                        f"\nUser_id: {return_message.user_messenger_id}"
-                        f"\nMessage: {return_message}"
-                        f"\n{'='*20}"
-                    ),
-                )
+            self._logger.emit(
+                "INFO",
+                (
+                    "Result message\n====== Output ======\nUser_id: %s"
+                    "\nMessage: %s\n===================="
+                ),
+                return_message.user_messenger_id,
+                return_message,
             )
 
-    async def main(self, local_ip: str, local_port: int) -> None:
-        for messenger in self._messengers._messengers_to_answer:
-            messenger._throttler.start()
+    async def start(self) -> None:
+        """
+        Starts the throttlers of the messengers and the dispatcher. Called
+        by :meth:`main` before the server starts listening.
+        """
+        self._messengers.start()
+        self._dispatcher.start()
+
+    async def close(self, timeout: float | None = None) -> None:
+        """
+        Waits for the queued messages to be processed, closes the
+        connections of the clients, the messengers and the message handler.
+        Called by :meth:`main` on shutdown.
+
+        :param timeout: The maximum time (in seconds) to wait for the queued
+            messages. Defaults to None (no limit).
+        :type timeout: float | None
+        """
+        await self._dispatcher.close(timeout=timeout)
+        # Senders send the unacknowledged messages again once their
+        # connections are closed
+        for writer in list(self._connections):
+            writer.close()
+        await self._messengers.close()
+        await close_default_downloader()
+        await self._message_handler.flush()
+
+    async def handle_message(
+        self, message: MessageStruct, addr: Any = None
+    ) -> None:
+        """
+        Processes a message as if it was received from a client, after the
+        previous messages of the same user. The server has to be started
+        with :meth:`start`.
+
+        :param message: The message to process.
+        :type message: MessageStruct
+
+        :param addr: The address of the sender, used in the logs. Defaults
+            to None.
+        :type addr: Any
+        """
+        await self._dispatch(message_cls=message, addr=addr)
+
+    async def main(
+        self, local_ip: str, local_port: int, reuse_port: bool = False
+    ) -> None:
+        await self.start()
         server = await asyncio.start_server(
             lambda reader, writer: self.handle_request(
                 reader=reader, writer=writer
             ),
             local_ip,
             local_port,
+            reuse_port=reuse_port or None,
         )
         addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=(
-                    f"Serving on {addrs}"
-                    f"{' in Debug mode' if self._config.DEBUG_STATE else ''}"
-                ),
+        metrics_server = None
+        if self._metrics != None and self._metrics_port != None:
+            metrics_server = MetricsServer(
+                metrics=self._metrics,
+                host=self._config.METRICS_HOST,
+                port=self._metrics_port,
+            )
+            await metrics_server.start()
+            self._logger.emit(
+                "INFO",
+                "Serving metrics on %s:%s",
+                self._config.METRICS_HOST,
+                self._metrics_port,
+            )
+        self._logger.emit(
+            "INFO",
+            "Serving on %s%s",
+            addrs,
+            " in Debug mode" if self._config.DEBUG_STATE else "",
+        )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close(timeout=DRAIN_TIMEOUT)
+            if metrics_server != None:
+                await metrics_server.close()
+
+    def start_server(
+        self, local_ip: str, local_port: int, reuse_port: bool = False
+    ) -> None:
+        asyncio.run(
+            self.main(
+                local_ip=local_ip, local_port=local_port, reuse_port=reuse_port
             )
         )
-        async with server:
-            await server.serve_forever()
 
-    def start_server(self, local_ip: str, local_port: int) -> None:
-        asyncio.run(self.main(local_ip=local_ip, local_port=local_port))
+    def _start_worker(
+        self, local_ip: str, local_port: int, worker: int = 0
+    ) -> None:
+        # Workers are stopped by the main process only
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self._metrics_port != None:
+            self._metrics_port += worker
+        try:
+            asyncio.run(
+                self._run_worker(local_ip=local_ip, local_port=local_port)
+            )
+        except asyncio.CancelledError:
+            pass
+
+    async def _run_worker(self, local_ip: str, local_port: int) -> None:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
+        await self.main(
+            local_ip=local_ip, local_port=local_port, reuse_port=True
+        )
+
+    def start_workers(
+        self, local_ip: str, local_port: int, workers: int
+    ) -> None:
+        """
+        Starts the server in several forked processes listening on the same
+        port. Incoming connections are distributed between the processes by
+        the OS. Each process runs its own event loop, throttlers and
+        dispatcher, while the messengers' rate limits are shared.
+
+        Messages of the same user are processed in order only within a
+        process, and the state cache of a process doesn't see the changes
+        made by the other ones.
+
+        :param local_ip: The IP address to listen on.
+        :type local_ip: str
+
+        :param local_port: The port to listen on.
+        :type local_port: int
+
+        :param workers: The amount of processes.
+        :type workers: int
+
+        :raises RuntimeError: If SO_REUSEPORT isn't supported by the OS.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Several workers require SO_REUSEPORT support")
+        if self._config.STATE_CACHE:
+            self._logger.emit(
+                "WARNING",
+                (
+                    "State cache is used by %s workers. A user's state "
+                    "changed by one worker may be stale in the other "
+                    "ones for up to %s seconds"
+                ),
+                workers,
+                self._config.STATE_CACHE_TTL,
+            )
+        self._messengers.share_rate_limits()
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(
+                target=self._start_worker,
+                kwargs={
+                    "local_ip": local_ip,
+                    "local_port": local_port,
+                    "worker": worker,
+                },
+                daemon=True,
+            )
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+            for process in processes:
+                process.join(timeout=max(deadline - time.monotonic(), 0))
+                if process.is_alive():
+                    process.kill()
+                    process.join()
 
 
 def run_server(
@@ -144,6 +543,8 @@ def run_server(
     local_port: int,
     base_config: BaseConfig = BaseConfig,
     logger: BaseLogger | None = None,
+    codec: BaseCodec | None = None,
+    workers: int = 1,
 ) -> None:
     """
     Starts the server and begins listening for incoming messages.
@@ -173,9 +574,21 @@ def run_server(
         base logger for the bot.
     :type logger: BaseLogger, optional
 
+    :param codec: An additional codec to decode incoming messages with.
+        Messages are decoded with the codec matching their version byte, so
+        the built-in codecs are always accepted.
+    :type codec: BaseCodec, optional
+
+    :param workers: The amount of server processes. Processes share the
+        port and the messengers' rate limits, each of them runs its own
+        event loop. Defaults to 1.
+    :type workers: int, optional
+
     :returns: None
     :rtype: NoneType
     """
+    if workers <= 0:
+        raise ValueError("Can't use negative values")
     if logger == None:
         logger = DefaultLogger(config=base_config)
     server = Server(
@@ -183,5 +596,11 @@ def run_server(
         message_handler=message_handler,
         base_config=base_config,
         logger=logger,
+        codec=codec,
+    )
+    if workers == 1:
+        server.start_server(local_ip=local_ip, local_port=local_port)
+        return
+    server.start_workers(
+        local_ip=local_ip, local_port=local_port, workers=workers
     )
-    server.start_server(local_ip=local_ip, local_port=local_port)
@@ -1,10 +1,13 @@
 import asyncio
 from pybotterfly.bot.struct import MessageStruct
-from pybotterfly.bot.converters import dataclass_to_bytes
+from pybotterfly.bot.converters import BaseCodec, encode_message_parts
 
 
 async def send_to_server(
-    message: MessageStruct, local_ip: str, local_port: int
+    message: MessageStruct,
+    local_ip: str,
+    local_port: int,
+    codec: BaseCodec | None = None,
 ) -> None:
     """
     Sends a message to a server at a specified IP address and port.
@@ -19,11 +22,15 @@ async def send_to_server(
     :param local_port: An integer that represents the port number of the server.
     :type local_port: int
 
+    :param codec: The codec to encode the message with. Defaults to
+        BinaryCodec.
+    :type codec: BaseCodec | None
+
     :returns: None
     :rtype: NoneType
     """
     _, writer = await asyncio.open_connection(local_ip, local_port)
-    writer.write(dataclass_to_bytes(message))
+    writer.writelines(encode_message_parts(message, codec=codec))
     await writer.drain()
     writer.write_eof()
     writer.close()
@@ -2,7 +2,7 @@ from typing import List
 from dataclasses import dataclass
 
 from pybotterfly.base_config import BaseConfig
-from pybotterfly.bot.logger import BaseLogger, Log, DefaultLogger
+from pybotterfly.bot.logger import BaseLogger, DefaultLogger
 
 
 @dataclass()
@@ -47,6 +47,7 @@ class ServersList:
     ) -> None:
         self.servers = servers
         self.config = config
+        self._version = 0
         self._logger = (
             logger if logger != None else DefaultLogger(config=config)
         )
@@ -64,9 +65,25 @@ class ServersList:
         if server in self.servers:
             raise RuntimeError("Server already exists.")
         self.servers.append(server)
-        self._logger.log(
-            log=Log(
-                level="INFO",
-                text=f"New server added to servers list: {server}",
-            )
+        self._version += 1
+        self._logger.emit(
+            "INFO", "New server added to servers list: %s", server
+        )
+
+    def remove_server(self, server: ServerData) -> None:
+        """
+        Removes a server from the list of servers.
+
+        :param server: Server data to be removed.
+        :type server: ServerData
+
+        :raises RuntimeError: If the server isn't in the list.
+        """
+
+        if server not in self.servers:
+            raise RuntimeError("Server doesn't exist.")
+        self.servers.remove(server)
+        self._version += 1
+        self._logger.emit(
+            "INFO", "Server removed from servers list: %s", server
         )
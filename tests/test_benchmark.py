@@ -0,0 +1,18 @@
+from pybotterfly.runners.benchmark import BenchmarkSettings, run_benchmark
+
+
+def test_run_benchmark():
+    result = run_benchmark(
+        settings=BenchmarkSettings(
+            concurrency=4,
+            users=10,
+            duration=0.2,
+            warmup=0.05,
+            file_size=2048,
+            seed=1,
+        )
+    )
+    assert result.messages > 0
+    assert result.errors == 0
+    assert result.replies >= result.messages
+    assert result.p50 <= result.p99 <= result.max
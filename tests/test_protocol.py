@@ -0,0 +1,71 @@
+import asyncio
+
+from pybotterfly.bot.converters import BinaryCodec
+from pybotterfly.bot.struct import File, MessageStruct
+from pybotterfly.server.protocol import (
+    pack_frame_parts,
+    read_attachments,
+    read_frame_header,
+    read_message,
+)
+
+LARGE = b"x" * 4096
+
+
+def _round_trip(obj, spool_size: int = 2**20):
+    async def run():
+        reader = asyncio.StreamReader()
+        for part in pack_frame_parts(
+            stream_id=1, parts=BinaryCodec().encode_parts(obj)
+        ):
+            reader.feed_data(part)
+        reader.feed_eof()
+        _, length = await read_frame_header(reader=reader)
+        incoming = await read_message(reader=reader, length=length)
+        await read_attachments(
+            reader=reader, incoming=incoming, spool_size=spool_size
+        )
+        assert await read_frame_header(reader=reader) == None
+        return incoming.message
+
+    return asyncio.run(run())
+
+
+def test_field_buffers():
+    message = MessageStruct(
+        user_id=1,
+        messenger="tg",
+        files=[File(name="a", ext="txt", tag="document", file_bytes=LARGE)],
+    )
+    assert _round_trip(message) == message
+
+
+def test_spooled_buffers():
+    message = MessageStruct(
+        user_id=1,
+        messenger="tg",
+        files=[File(name="a", ext="txt", tag="document", file_bytes=LARGE)],
+    )
+    assert _round_trip(message, spool_size=1024) == message
+
+
+def test_nested_buffers():
+    message = MessageStruct(
+        user_id=1,
+        messenger="tg",
+        payload={
+            "blob": LARGE,
+            "list": [b"small", LARGE + b"1", {"inner": LARGE + b"2"}],
+            LARGE: "large key",
+        },
+    )
+    assert _round_trip(message) == message
+
+
+def test_list_buffers():
+    value = [LARGE, [LARGE + b"1"], {"key": LARGE + b"2"}, b"small"]
+    assert _round_trip(value) == value
+
+
+def test_top_level_buffer():
+    assert _round_trip(LARGE) == LARGE